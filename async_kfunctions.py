@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Module to calculate kfunctions of all the files of a folder with asyncio.
+Reading files, calculating kfunctions, writing results and exporting plots
+run at the same time: reads, writes and plots in threads and kfunctions in
+worker processes, or in worker threads for many small files. Bounded
+queues between the stages keep the memory limited when the folder is
+large.
+
+"""
+import os
+import asyncio
+import fnmatch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from calculate_kfunctions import (
+    POOLS, ProcessIrradFile, _file_stem, _resample_depths,
+    _resample_lambdas, compute_kfunctions)
+
+
+def _read_file(file_name, path_file):
+    """
+    Read and validate a file of irradiances
+
+    Return
+    ------
+        df: pandas dataframe object
+            dataframe with irradiances
+    """
+    pirradf = ProcessIrradFile()
+
+    # open_file() exits on a missing file: it is an error of this file
+    f = pirradf._file_path(file_name=file_name, path_file=path_file)
+    if not os.path.exists(f):
+        raise FileNotFoundError(f"File {f} not found")
+
+    pirradf.open_file(file_name=file_name, path_file=path_file)
+    pirradf._create_dataframe_from_Lroot_calc_irrad()
+    pirradf.check_irradiances()
+    return pirradf.df
+
+
+def _compute_file(df, options):
+    """
+    Calculate kfunctions of a dataframe of irradiances. Runs in a worker
+    process or thread
+
+    Return
+    ------
+        df: pandas dataframe object
+            dataframe with irradiances and kfunctions
+    """
+    config = dict(invalid_policy=options['invalid_policy'],
+                  clamp_value=options['clamp_value'],
+                  kernel=options['kernel'])
+    if options['lambdas'] is not None:
+        df = _resample_lambdas(df, options['lambdas'], config)
+    if options['depths'] is not None:
+        df = _resample_depths(df, options['depths'], config)
+
+    return compute_kfunctions(df, config)
+
+
+def _output_processor(df, file_name, options):
+    """
+    Create a ProcessIrradFile to save results of a file with the options
+    """
+    pirradf = ProcessIrradFile()
+    pirradf.df = df
+    pirradf.file_name = file_name
+    pirradf.file_name_csv = (
+        f"{_file_stem(file_name)}_calculated_kfunctions.csv")
+    pirradf.invalid_policy = options['invalid_policy']
+    pirradf.clamp_value = options['clamp_value']
+    pirradf.output_format = options['output_format']
+    pirradf.compression = options['compression']
+    pirradf.path_files_csv = options['path_files_csv']
+    pirradf.path_images_plotly = options['path_images_plotly']
+    pirradf.path_images_matplotlib = options['path_images_matplotlib']
+    pirradf.include_plotlyjs = options['include_plotlyjs']
+    pirradf.html_precision = options['html_precision']
+    pirradf.downsample = options['downsample']
+    pirradf.downsample_points = options['downsample_points']
+    pirradf.image_formats = options['image_formats']
+    pirradf.dpi = options['dpi']
+    pirradf.run_directories = options['run_directories']
+    pirradf._set_run_name(
+        file_name, invalid_policy=options['invalid_policy'],
+        lambdas=options['lambdas'], depths=options['depths'])
+    return pirradf
+
+
+def _write_file(df, file_name, options):
+    """
+    Save kfunctions of a file
+
+    Return
+    ------
+        output_files: list
+            Paths of the saved files
+    """
+    pirradf = _output_processor(df, file_name, options)
+    fname = f"{_file_stem(file_name)}_calculated_kfunctions"
+    pirradf._save_dataframe(df, fname)
+    return pirradf.output_files
+
+
+def _plot_file(df, file_name, options):
+    """
+    Save the plots of a file
+
+    Return
+    ------
+        output_files: list
+            Paths of the saved plots
+    """
+    pirradf = _output_processor(df, file_name, options)
+    for plot in options['plots']:
+        for library in options['libraries']:
+            getattr(pirradf, f"{plot}_{library}")()
+    return pirradf.output_files
+
+
+async def _read_stage(files, path_file, queue, executor, results):
+    loop = asyncio.get_running_loop()
+    for file_name in files:
+        try:
+            df = await loop.run_in_executor(
+                executor, _read_file, file_name, path_file)
+        except Exception as er:
+            results[file_name] = f"{type(er).__name__}: {er}"
+            continue
+        # wait here while the calculation stage is busy
+        await queue.put((file_name, df))
+
+
+async def _compute_stage(in_queue, out_queue, executor, options, results):
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await in_queue.get()
+        if item is None:
+            break
+        file_name, df = item
+        try:
+            df = await loop.run_in_executor(
+                executor, _compute_file, df, options)
+        except Exception as er:
+            results[file_name] = f"{type(er).__name__}: {er}"
+            continue
+        await out_queue.put((file_name, df))
+
+
+async def _write_stage(queue, io_executor, plot_executor, options, results):
+    loop = asyncio.get_running_loop()
+    pending = set()
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        file_name, df = item
+
+        async def output(file_name=file_name, df=df):
+            try:
+                files = await loop.run_in_executor(
+                    io_executor, _write_file, df, file_name, options)
+                if options['plots']:
+                    files += await loop.run_in_executor(
+                        plot_executor, _plot_file, df, file_name, options)
+                results[file_name] = files
+            except Exception as er:
+                results[file_name] = f"{type(er).__name__}: {er}"
+
+        pending.add(asyncio.ensure_future(output()))
+
+        # bound the number of results that are waiting to be saved
+        if len(pending) >= queue.maxsize:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def process_directory_async(path_files_raw="files/raw",
+                                  pattern="*.csv",
+                                  path_files_csv="files/csv",
+                                  invalid_policy="drop",
+                                  clamp_value=1e-30, kernel="numpy",
+                                  lambdas=None,
+                                  depths=None, output_format="csv",
+                                  compression=None,
+                                  run_directories=False, plots=(),
+                                  plotly=True, matplotlib=False,
+                                  path_images_plotly="images/plotly",
+                                  path_images_matplotlib="images/matplotlib",
+                                  include_plotlyjs=True, html_precision=None,
+                                  downsample=None, downsample_points=500,
+                                  image_formats=('svg',), dpi=100,
+                                  workers=None, pool="process",
+                                  queue_size=4):
+    """
+    Calculate kfunctions of all files of a folder, overlapping reads,
+    calculations, writes and plots
+
+    Parameters
+    ----------
+        path_files_raw: str
+            Path of the files of irradiances (Default="files/raw")
+        pattern: str
+            Pattern of the names of the files (Default="*.csv")
+        path_files_csv: str
+            Path of the results (Default="files/csv")
+        invalid_policy, clamp_value, kernel, lambdas, depths,
+        output_format, run_directories:
+            Options of ProcessIrradFile.calc_kfunctions()
+        compression: str
+            Compression of the results: 'gzip', 'bz2', 'xz', 'zstd' or None
+            (Default=None)
+        plots: tuple
+            Plots to save, as ('plot_calculated_Kd_HL',) (Default=())
+        plotly: Boolean
+            Boolean to plot with Plotly lib (Default=True)
+        matplotlib: Boolean
+            Boolean to plot with Matplotlib lib (Default=False)
+        path_images_plotly: str
+            Path of Plotly images (Default="images/plotly")
+        path_images_matplotlib: str
+            Path of Matplotlib images (Default="images/matplotlib")
+        include_plotlyjs: bool or str
+            plotly.js of html files: True (embedded), 'directory' (one
+            shared plotly.min.js) or 'cdn' (Default=True)
+        html_precision: int
+            Significant digits of the data of html files
+            (Default=None, all digits)
+        downsample: str
+            Method to downsample the curves of the plots: 'lttb' or
+            'minmax' (Default=None, all points)
+        downsample_points: int
+            Maximum number of points of each curve (Default=500)
+        image_formats: tuple
+            Formats of the images of the plots: 'svg' and/or 'png'
+            (Default=('svg',))
+        dpi: int
+            Dots per inch of png images (Default=100)
+        workers: int
+            Number of processes or threads to calculate kfunctions
+            (Default=None, number of CPUs)
+        pool: str
+            'process' or 'thread' workers (Default="process")
+        queue_size: int
+            Maximum number of files waiting between two stages (Default=4)
+
+    Return
+    ------
+        results: dict
+            Name of each file and the paths of its results, or the error
+    """
+    if pool not in POOLS:
+        raise ValueError(f"pool must be one of {POOLS}, not '{pool}'")
+
+    files = sorted(fnmatch.filter(os.listdir(path_files_raw), pattern))
+    options = dict(
+        invalid_policy=invalid_policy, clamp_value=clamp_value,
+        kernel=kernel, lambdas=lambdas,
+        depths=depths,
+        output_format=output_format, compression=compression,
+        run_directories=run_directories,
+        path_files_csv=path_files_csv, plots=tuple(plots),
+        libraries=[name for name, used in (
+            ('plotly', plotly), ('matplotlib', matplotlib)) if used is True],
+        path_images_plotly=path_images_plotly,
+        path_images_matplotlib=path_images_matplotlib,
+        include_plotlyjs=include_plotlyjs, html_precision=html_precision,
+        downsample=downsample, downsample_points=downsample_points,
+        image_formats=tuple(image_formats), dpi=dpi)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    results = {}
+    read_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+
+    if pool == 'thread':
+        cpu_pool = ThreadPoolExecutor
+    else:
+        cpu_pool = ProcessPoolExecutor
+
+    # pyplot figures are not thread-safe: plots run in a single thread
+    with ThreadPoolExecutor(max_workers=2) as io_executor, \
+            ThreadPoolExecutor(max_workers=1) as plot_executor, \
+            cpu_pool(max_workers=workers) as cpu_executor:
+
+        computers = [
+            asyncio.ensure_future(_compute_stage(
+                read_queue, write_queue, cpu_executor, options, results))
+            for worker in range(workers)]
+        writer = asyncio.ensure_future(_write_stage(
+            write_queue, io_executor, plot_executor, options, results))
+
+        await _read_stage(
+            files, path_files_raw, read_queue, io_executor, results)
+        for worker in computers:
+            await read_queue.put(None)
+        await asyncio.gather(*computers)
+        await write_queue.put(None)
+        await writer
+
+    return results
+
+
+def process_directory(**kwargs):
+    """
+    Calculate kfunctions of all files of a folder. See
+    process_directory_async() for the parameters
+
+    Return
+    ------
+        results: dict
+            Name of each file and the paths of its results, or the error
+    """
+    return asyncio.run(process_directory_async(**kwargs))
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the outputs of calculate_kfunctions on synthetic files of
+irradiances.
+
+    python benchmark_kfunctions.py --lambdas 61 --depth-step 0.1 compression
+    python benchmark_kfunctions.py --lambdas 7 templates --runs 20
+    python benchmark_kfunctions.py --lambdas 301 images --dpi 150
+    python benchmark_kfunctions.py pools --workers 4
+
+"""
+import os
+import argparse
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import matplotlib.pyplot as plt
+
+import calculate_kfunctions
+from calculate_kfunctions import (
+    COMPRESSIONS, IMAGE_FORMATS, OUTPUT_FORMATS, PLOTS, POOLS,
+    ProcessIrradFile, compute_kfunctions)
+from compare_kfunctions import (
+    _timed, engine_kfunctions, synthetic_irradiances)
+from shared_kfunctions import calculate_shared
+
+# synthetic files of the pools benchmark: (number of lambdas, depth step)
+POOL_SIZES = {'small': (7, 0.5), 'large': (301, 0.02)}
+
+
+def _size(path):
+    """
+    Size in bytes of a file or of all files of a folder
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def kfunctions_dataframe(n_lambdas=61, depth_step=0.1):
+    """
+    Irradiances and kfunctions of a synthetic file
+    """
+    df = synthetic_irradiances(n_lambdas=n_lambdas, depth_step=depth_step)
+    kfunctions = engine_kfunctions(df)
+    return df.join(kfunctions)
+
+
+def benchmark_compression(df, repeat=3):
+    """
+    Write and read the results with each output format and compression
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with irradiances and kfunctions
+        repeat: int
+            Number of writes and reads, the best time is reported
+            (Default=3)
+
+    Return
+    ------
+        report: list
+            dicts with 'output_format', 'compression', 'bytes',
+            'write_seconds' and 'read_seconds'
+    """
+    report = []
+    with tempfile.TemporaryDirectory() as path:
+        for output_format in OUTPUT_FORMATS:
+            for compression in (None,) + tuple(COMPRESSIONS):
+                pirradf = ProcessIrradFile()
+                pirradf.path_files_csv = path
+                pirradf.output_format = output_format
+                pirradf.compression = compression
+                try:
+                    result, write_seconds = _timed(
+                        pirradf._save_dataframe, df, "benchmark",
+                        repeat=repeat)
+                except ImportError as er:
+                    print(f"{output_format:9} {str(compression):6} {er}")
+                    continue
+                f = pirradf.output_files[-1]
+
+                reader = ProcessIrradFile()
+
+                def read():
+                    reader.open_file(file_name=os.path.basename(f),
+                                     path_file=path)
+                    reader.create_dataframe_from_Lroot_calc_kfunctions()
+
+                result, read_seconds = _timed(read, repeat=repeat)
+                report.append({
+                    'output_format': output_format,
+                    'compression': compression,
+                    'bytes': _size(f),
+                    'write_seconds': write_seconds,
+                    'read_seconds': read_seconds,
+                })
+
+    reference = report[0]['bytes']
+    print(f"{'format':9} {'codec':6} {'MB':>8} {'ratio':>6} "
+          f"{'write s':>8} {'read s':>8}")
+    for row in report:
+        print(f"{row['output_format']:9} {str(row['compression']):6} "
+              f"{row['bytes'] / 2**20:8.2f} "
+              f"{reference / row['bytes']:6.1f} "
+              f"{row['write_seconds']:8.3f} {row['read_seconds']:8.3f}")
+
+    return report
+
+
+def benchmark_templates(df, runs=20):
+    """
+    Time of the plotly methods of each plot building the subplots and
+    layout for each run, and reusing the cached template figure
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with irradiances and kfunctions
+        runs: int
+            Number of figures of each plot (Default=20)
+
+    Return
+    ------
+        report: list
+            dicts with 'plot', 'build_seconds' and 'reuse_seconds' of each
+            figure, without saving it
+    """
+    pirradf = ProcessIrradFile()
+    pirradf.df = df
+    pirradf._save_figure = lambda *args: None
+    templates = calculate_kfunctions._plotly_templates.__dict__
+
+    report = []
+    print(f"{'plot':34} {'build ms':>9} {'reuse ms':>9} {'gain':>6}")
+    for plot in PLOTS:
+        plot_method = getattr(pirradf, f"{plot}_plotly")
+
+        start = time.perf_counter()
+        for run in range(runs):
+            templates.clear()
+            plot_method()
+        build_seconds = (time.perf_counter() - start) / runs
+
+        # first figure builds the template
+        plot_method()
+        start = time.perf_counter()
+        for run in range(runs):
+            plot_method()
+        reuse_seconds = (time.perf_counter() - start) / runs
+
+        report.append({
+            'plot': plot,
+            'build_seconds': build_seconds,
+            'reuse_seconds': reuse_seconds,
+        })
+        print(f"{plot:34} {build_seconds * 1e3:9.1f} "
+              f"{reuse_seconds * 1e3:9.1f} "
+              f"{build_seconds / reuse_seconds:6.2f}")
+
+    return report
+
+
+def benchmark_images(df, plot="plot_calculated_Kd_LR_all_points", dpi=100,
+                     repeat=3):
+    """
+    Export time and size of the figures of a plot in each image format,
+    with Matplotlib and Plotly
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with irradiances and kfunctions
+        plot: str
+            Plot of PLOTS (Default="plot_calculated_Kd_LR_all_points")
+        dpi: int
+            Dots per inch of png images (Default=100)
+        repeat: int
+            Number of exports, the best time is reported (Default=3)
+
+    Return
+    ------
+        report: list
+            dicts with 'library', 'image_format', 'bytes' and
+            'export_seconds'
+    """
+    pirradf = ProcessIrradFile()
+    pirradf.df = df
+    pirradf.dpi = dpi
+    figures = {}
+    save_figure = pirradf._save_figure
+    for library in ('matplotlib', 'plotly'):
+        # build the figure once, only the export is timed
+        pirradf._save_figure = (
+            lambda fig, *args, library=library: figures.update(
+                {library: fig}))
+        getattr(pirradf, f"{plot}_{library}")()
+    pirradf._save_figure = save_figure
+
+    report = []
+    print(f"{'library':10} {'format':6} {'MB':>8} {'export s':>9}")
+    with tempfile.TemporaryDirectory() as path:
+        for library, fig in figures.items():
+            for image_format in IMAGE_FORMATS:
+                try:
+                    result, export_seconds = _timed(
+                        pirradf._save_figure, fig, path, "benchmark",
+                        (image_format,), repeat=repeat)
+                except (ImportError, ValueError) as er:
+                    print(f"{library:10} {image_format:6} "
+                          f"{type(er).__name__}: {er}")
+                    continue
+                report.append({
+                    'library': library,
+                    'image_format': image_format,
+                    'bytes': _size(pirradf.output_files[-1]),
+                    'export_seconds': export_seconds,
+                })
+                print(f"{library:10} {image_format:6} "
+                      f"{report[-1]['bytes'] / 2**20:8.2f} "
+                      f"{export_seconds:9.3f}")
+        plt.close(figures['matplotlib'])
+
+    return report
+
+
+def _batch(dfs, pool, workers, config):
+    """
+    Calculate kfunctions of many dataframes, serial if pool is None
+    """
+    if pool is None:
+        return [compute_kfunctions(df, config) for df in dfs]
+
+    executor = ThreadPoolExecutor if pool == 'thread' else ProcessPoolExecutor
+    with executor(max_workers=workers) as executor:
+        return list(executor.map(
+            compute_kfunctions, dfs, [config] * len(dfs)))
+
+
+def benchmark_pools(workers=4, files=32, kernel="numpy", repeat=3):
+    """
+    Time of serial, thread pool and process pool calculation of kfunctions
+    of a batch of files (one file for each task, as process_directory())
+    and of the lambdas of one file (partitions of lambdas for each task, as
+    calculate_shared()), with small and large synthetic files. Times
+    include the start of the pool, reads and writes of files are not
+    included
+
+    Parameters
+    ----------
+        workers: int
+            Number of processes or threads (Default=4)
+        files: int
+            Number of files of the batch (Default=32)
+        kernel: str
+            Kernel of ProcessIrradFile (Default="numpy")
+        repeat: int
+            Number of runs, the best time is reported (Default=3)
+
+    Return
+    ------
+        report: list
+            dicts with 'mode', 'size', 'rows', 'pool' and 'seconds'
+    """
+    config = dict(kernel=kernel)
+    # first call compiles the numba kernel
+    compute_kfunctions(synthetic_irradiances(), config)
+
+    report = []
+    print(f"{'mode':7} {'size':6} {'rows':>9} {'serial s':>9} "
+          f"{'thread s':>9} {'process s':>10}")
+    for size, (n_lambdas, depth_step) in POOL_SIZES.items():
+        df = synthetic_irradiances(n_lambdas=n_lambdas, depth_step=depth_step)
+        dfs = [df] * (files if size == 'small' else max(1, files // 8))
+
+        modes = {
+            'batch': lambda pool: _batch(dfs, pool, workers, config),
+            'lambdas': lambda pool: (
+                compute_kfunctions(df, config) if pool is None else
+                calculate_shared(df.copy(), workers=workers, kernel=kernel,
+                                 pool=pool)),
+        }
+        for mode, function in modes.items():
+            rows = len(df) * (len(dfs) if mode == 'batch' else 1)
+            seconds = {}
+            for pool in (None,) + POOLS:
+                result, seconds[pool] = _timed(function, pool, repeat=repeat)
+                report.append({'mode': mode, 'size': size, 'rows': rows,
+                               'pool': pool, 'seconds': seconds[pool]})
+            print(f"{mode:7} {size:6} {rows:9} {seconds[None]:9.3f} "
+                  f"{seconds['thread']:9.3f} {seconds['process']:10.3f}")
+
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--lambdas', type=int, default=61,
+                        help="Number of lambdas of the synthetic file")
+    parser.add_argument('--depth-step', type=float, default=0.1,
+                        help="Depth step in meters of the synthetic file")
+    parser.add_argument('--repeat', type=int, default=3)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    subparsers.add_parser(
+        'compression', help="Size, write and read time of each codec")
+    templates = subparsers.add_parser(
+        'templates', help="Time of plotly figures with cached templates")
+    templates.add_argument('--runs', type=int, default=20)
+    images = subparsers.add_parser(
+        'images', help="Export time and size of each image format")
+    images.add_argument('--plot', choices=PLOTS,
+                        default='plot_calculated_Kd_LR_all_points')
+    images.add_argument('--dpi', type=int, default=100)
+    pools = subparsers.add_parser(
+        'pools', help="Time of thread and process pools, small and large "
+        "files (--lambdas and --depth-step are not used)")
+    pools.add_argument('--workers', type=int, default=4)
+    pools.add_argument('--files', type=int, default=32)
+    pools.add_argument('--kernel', default="numpy")
+    args = parser.parse_args()
+
+    if args.benchmark == 'pools':
+        benchmark_pools(workers=args.workers, files=args.files,
+                        kernel=args.kernel, repeat=args.repeat)
+        parser.exit()
+
+    df = kfunctions_dataframe(n_lambdas=args.lambdas,
+                              depth_step=args.depth_step)
+    print(f"{len(df)} rows, {len(df.columns)} columns")
+
+    if args.benchmark == 'compression':
+        benchmark_compression(df, repeat=args.repeat)
+    elif args.benchmark == 'templates':
+        benchmark_templates(df, runs=args.runs)
+    elif args.benchmark == 'images':
+        benchmark_images(df, plot=args.plot, dpi=args.dpi,
+                         repeat=args.repeat)
@@ -9,26 +9,1150 @@ calculate-irradiances-Hydrolight script to obtain kfunctions (Kd, Ku or Kl).
 
 """
 import os
+import bz2
+import contextlib
+import cProfile
+import functools
+import gzip
+import hashlib
+import json
+import lzma
 import pandas as pd
-from scipy import stats
 import numpy as np
+from scipy import sparse
 import io
-import math
+import shutil
 import sys
 import time
 import threading
-import warnings
+import tracemalloc
+import uuid
 import matplotlib.pyplot as plt
 import matplotlib.style as mplstyle
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 
+# numba is optional: it compiles the kernel of the 'numba' engine
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from plotly.offline import get_plotlyjs
+
 # allow configure orca to send requests to remote server
 import plotly.io as pio
 
 pio._orca.ensure_server = lambda: None
 pio._orca.orca_state["port"] = 32909
 
+# irradiance used to calculate each kfunction
+KFUNCTIONS_IRRADIANCES = {
+    'Kd': 'calculated_Ed',
+    'Ku': 'calculated_Eu',
+    'Kl1': 'calculated_El1_no_polar_cap',
+    'Kl2': 'calculated_El2_no_polar_cap',
+    'Kl1_polar_cap': 'calculated_El1_polar_cap',
+    'Kl2_polar_cap': 'calculated_El2_polar_cap',
+    'Khc': 'calculated_Ehc',
+    'Khc_45': 'calculated_Ehc_45',
+}
+
+# columns of the file needed to calculate kfunctions
+REQUIRED_COLUMNS = ('lambda', 'depth') + tuple(KFUNCTIONS_IRRADIANCES.values())
+
+# (prefix, method) of the kfunctions columns, in the order they are saved
+KFUNCTIONS_COLUMNS = (
+    ('calculated', 'LR'),
+    ('r2value', 'LR'),
+    ('calculated', 'LR_all_points'),
+    ('r2value', 'LR_all_points'),
+    ('calculated', 'HL'),
+)
+
+# policies for non-positive or non-numeric irradiances:
+# - 'drop': exclude the point of the regressions
+# - 'nan': propagate NaN to the kfunctions that use the point
+# - 'clamp': replace non-positive irradiances with clamp_value
+INVALID_POLICIES = ('drop', 'nan', 'clamp')
+
+# default bands to integrate irradiances: (min_lambda, max_lambda) in nm
+BANDS = {
+    'PAR': (400, 700),
+}
+
+# conversion from W/m^2 to umol photons/m^2 s, multiplied by lambda in nm
+WATT_TO_UMOL_PHOTONS = 1e-3 / (6.62607015e-34 * 2.99792458e8 * 6.02214076e23)
+
+# formats to save kfunctions. Columnar format is a folder with one .npy file
+# for each column, that can be read lazily column by column
+OUTPUT_FORMATS = ('csv', 'columnar')
+COLUMNAR_SUFFIX = "_columnar"
+
+# compressions of the results and extension of the compressed files. zstd
+# needs the zstandard package
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'bz2': '.bz2',
+    'xz': '.xz',
+    'zstd': '.zst',
+}
+
+# optional profiling hooks of the stages of the process
+PROFILE_HOOKS = ('cprofile', 'tracemalloc')
+
+# plotly.js of html files: embedded in each file (True), one plotly.min.js
+# file in the folder of the html files ('directory') or from the plotly CDN
+# ('cdn')
+INCLUDE_PLOTLYJS = (True, 'directory', 'cdn')
+PLOTLYJS_FILE = "plotly.min.js"
+
+# formats of the images of the plots: 'svg' (vector) or 'png' (raster with
+# self.dpi dots per inch). Plotly figures are also saved in html
+IMAGE_FORMATS = ('svg', 'png')
+
+# plots of plot_kfunctions, with a _matplotlib and a _plotly method
+PLOTS = (
+    'plot_irradiances',
+    'plot_kfunctionsLR',
+    'plot_calculated_Kd_LR_all_points',
+    'plot_calculated_Kd_HL',
+)
+
+# columns of the file of kfunctions used by the methods of each plot, with
+# lambda and depth
+PLOT_COLUMNS = {
+    'plot_irradiances': (
+        'calculated_Ed', 'calculated_Eu', 'calculated_El1', 'calculated_El2',
+        'calculated_El1_no_polar_cap', 'calculated_El2_no_polar_cap',
+        'calculated_El1_polar_cap', 'calculated_El2_polar_cap',
+        'calculated_Ehc', 'calculated_Ehc_45'),
+    'plot_kfunctionsLR': tuple(
+        f'calculated_{kfunction}_LR' for kfunction in KFUNCTIONS_IRRADIANCES),
+    'plot_calculated_Kd_LR_all_points': tuple(
+        f'calculated_{kfunction}_LR_all_points'
+        for kfunction in KFUNCTIONS_IRRADIANCES),
+    'plot_calculated_Kd_HL': (
+        'calculated_Kd_HL', 'calculated_Ku_HL', 'calculated_Kl1_HL',
+        'calculated_Kl2_HL'),
+}
+
+# plotly figures of each plot with the subplots and layout, built once for
+# each thread. Each run removes the traces of the last run and adds its own
+_plotly_templates = threading.local()
+
+# downsampling of the curves of the plots to a number of points:
+# - 'lttb': Largest-Triangle-Three-Buckets, keeps the shape of the curve
+# - 'minmax': minimum and maximum values of each bucket of depths
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+# kernels to calculate kfunctions:
+# - 'numpy': vectorized NumPy operations over all lambdas
+# - 'numba': compiled loop over the rows (needs numba)
+# - 'auto': 'numba' if numba is installed, else 'numpy'
+KERNELS = ('auto', 'numpy', 'numba')
+
+# pools of workers to calculate kfunctions:
+# - 'process': worker processes, dataframes are pickled to each worker
+# - 'thread': worker threads, without copies. NumPy operations on the
+#   columns and the numba kernel release the GIL
+POOLS = ('process', 'thread')
+
+# default configuration of compute_kfunctions():
+# - 'invalid_policy': policy of INVALID_POLICIES
+# - 'clamp_value': irradiance of non-positive values with 'clamp' policy
+# - 'kernel': kernel of KERNELS
+KFUNCTIONS_CONFIG = {
+    'invalid_policy': 'drop',
+    'clamp_value': 1e-30,
+    'kernel': 'numpy',
+}
+
+
+@functools.lru_cache(maxsize=32)
+def _interpolation_weights(source, target):
+    """
+    Sparse matrix of linear interpolation weights from a source grid to a
+    target grid (lambdas or depths). Cached for each (source, target) pair
+    of grids
+
+    Parameters
+    ----------
+        source: tuple
+            Sorted values of the grid of the file
+        target: tuple
+            Values to interpolate
+
+    Return
+    ------
+        weights: scipy sparse matrix
+            Weights with shape (target, source)
+    """
+    source = np.asarray(source, dtype=float)
+    target = np.asarray(target, dtype=float)
+
+    if (target.min() < source[0]) or (target.max() > source[-1]):
+        raise ValueError(
+            f"Target values must be inside {source[0]}-{source[-1]}, "
+            "the values of the file")
+
+    right = np.clip(np.searchsorted(source, target), 1, len(source) - 1)
+    left = right - 1
+    step = source[right] - source[left]
+    fraction = np.where(step > 0, (target - source[left]) / step, 0.0)
+
+    rows = np.tile(np.arange(len(target)), 2)
+    cols = np.concatenate((left, right))
+    values = np.concatenate((1 - fraction, fraction))
+
+    # only nonzero weights are stored: 0 * NaN of a not valid neighbour
+    # would make NaN a target equal to a source value
+    nonzero = values != 0
+    return sparse.csr_matrix(
+        (values[nonzero], (rows[nonzero], cols[nonzero])),
+        shape=(len(target), len(source)))
+
+
+def _compression(path):
+    """
+    Get the compression of a file from its extension, None if it is not
+    compressed
+    """
+    for compression, extension in COMPRESSIONS.items():
+        if path.endswith(extension):
+            return compression
+    return None
+
+
+def _file_stem(file_name):
+    """
+    Name of a file without folders, compression and format extensions, to
+    name its outputs: 'site.a.csv.gz' gives 'site.a'. Columnar folders
+    have no extension
+    """
+    name = os.path.basename(file_name)
+    compression = _compression(name)
+    if compression is not None:
+        name = name[:-len(COMPRESSIONS[compression])]
+    if name.endswith(COLUMNAR_SUFFIX):
+        return name
+    return os.path.splitext(name)[0]
+
+
+def _open_compressed(path, mode='rb', compression=None):
+    """
+    Open a file with a compression
+
+    Parameters
+    ----------
+        path: str
+            Path of the file
+        mode: str
+            Mode to open the file, as 'rt' or 'wb' (Default='rb')
+        compression: str
+            Compression of the file, one of COMPRESSIONS (Default=None, not
+            compressed)
+
+    Return
+    ------
+        file: file object
+    """
+    if compression is None:
+        return open(path, mode)
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'bz2':
+        return bz2.open(path, mode)
+    if compression == 'xz':
+        return lzma.open(path, mode)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("compression 'zstd' needs zstandard installed")
+        return zstandard.open(path, mode)
+    raise ValueError(
+        f"compression must be one of {tuple(COMPRESSIONS)} or None, "
+        f"not '{compression}'")
+
+
+def _round_significant(values, precision):
+    """
+    Round float values to a number of significant digits, so they are
+    written with less digits in json
+    """
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values) & (values != 0)
+    magnitude = np.zeros(values.shape)
+    np.floor(np.log10(np.abs(values), where=finite, out=magnitude),
+             where=finite, out=magnitude)
+    scale = 10.0 ** (precision - 1 - magnitude)
+    return np.where(finite, np.round(values * scale) / scale, values)
+
+
+def write_columnar(df, path, compression=None):
+    """
+    Save dataframe as a columnar folder: one .npy file for each column and
+    columns.json with the names of the columns
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe to save
+        path: str
+            Path of the folder
+        compression: str
+            Compression of the .npy files, one of COMPRESSIONS
+            (Default=None, not compressed)
+    """
+    os.makedirs(path, exist_ok=True)
+
+    extension = COMPRESSIONS.get(compression, "")
+    for n, column in enumerate(df.columns):
+        values = df[column].to_numpy()
+        if values.dtype == object:
+            values = values.astype(str)
+        with _open_compressed(os.path.join(path, f"{n}.npy{extension}"),
+                              'wb', compression) as file:
+            np.save(file, values)
+
+    with open(os.path.join(path, "columns.json"), 'w') as file:
+        json.dump({'columns': list(df.columns), 'rows': len(df),
+                   'compression': compression}, file)
+
+
+def read_columnar_names(path):
+    """
+    Names of the columns of a columnar folder, in the order they are saved
+    """
+    with open(os.path.join(path, "columns.json"), 'r') as file:
+        return json.load(file)['columns']
+
+
+def read_columnar(path, columns=None, lambdas=None):
+    """
+    Read columns of a columnar folder. Columns that are not compressed are
+    memory mapped, so only the values that are used are read from disk
+
+    Parameters
+    ----------
+        path: str
+            Path of the folder
+        columns: list
+            Names of the columns to read (Default=None, all columns)
+        lambdas: list
+            Lambda values of the rows to read (Default=None, all rows)
+
+    Return
+    ------
+        df: pandas dataframe object
+            dataframe with the columns
+    """
+    with open(os.path.join(path, "columns.json"), 'r') as file:
+        description = json.load(file)
+    names = description['columns']
+    compression = description.get('compression')
+
+    if columns is None:
+        columns = names
+
+    missing = [column for column in columns if column not in names]
+    if missing:
+        raise KeyError(f"Columns {missing} not found in {path}")
+
+    # files written by partitions can have more rows than the data
+    rows = description.get('rows')
+
+    def load(column):
+        f = os.path.join(path, f"{names.index(column)}.npy")
+        if compression is None:
+            return np.load(f, mmap_mode='r')[:rows]
+        # compressed streams can not seek back as np.load needs
+        with _open_compressed(
+                f + COMPRESSIONS[compression], 'rb', compression) as file:
+            return np.load(io.BytesIO(file.read()))[:rows]
+
+    if lambdas is None:
+        return pd.DataFrame({column: load(column) for column in columns})
+
+    selected = np.isin(load('lambda'), lambdas)
+    return pd.DataFrame({
+        column: load(column)[selected] for column in columns})
+
+
+def _kfunctions_loop(depth, log_irradiance, used, block_start):
+    """
+    Calculate kfunctions of one irradiance with a loop over the rows. It is
+    compiled with numba when it is installed
+
+    Parameters
+    ----------
+        depth: numpy array
+            Depth of each row
+        log_irradiance: numpy array
+            ln(E) of each row
+        used: numpy array
+            Boolean array, True where the point is used in the regressions
+        block_start: numpy array
+            Index of the first row of the lambda block of each row
+
+    Return
+    ------
+        lr, r2_lr, lr_all, r2_lr_all: numpy arrays
+            kfunctions LR and LR_all_points and their r2 values. NaN where
+            the kfunction can not be calculated
+    """
+    n_rows = len(depth)
+    lr = np.full(n_rows, np.nan)
+    r2_lr = np.full(n_rows, np.nan)
+    lr_all = np.full(n_rows, np.nan)
+    r2_lr_all = np.full(n_rows, np.nan)
+
+    last = -1
+    ref = 0
+    y_ref = 0.0
+    n = sx = sy = sxx = syy = sxy = 0.0
+    poisoned = False
+    for row in range(n_rows):
+        start = block_start[row]
+
+        # new lambda: sums are centered in the first regression point
+        if row == start:
+            last = -1
+            ref = min(start + 2, n_rows - 1)
+            y_ref = log_irradiance[ref]
+            if np.isnan(y_ref):
+                y_ref = 0.0
+            n = sx = sy = sxx = syy = sxy = 0.0
+            poisoned = False
+
+        if not used[row]:
+            continue
+        prev = last
+        last = row
+
+        # We do not calculate in depths of -1.0 and 0.0
+        if row - start < 2:
+            continue
+
+        # regression with last 2 elements z2 and z1
+        if prev >= 0:
+            d_log = log_irradiance[last] - log_irradiance[prev]
+            d_depth = depth[last] - depth[prev]
+            if d_depth != 0:
+                lr[row] = -d_log / d_depth
+            if not np.isnan(d_log):
+                r2_lr[row] = 1.0 if d_log != 0 else 0.0
+
+        # regression with all elements
+        x = depth[row] - depth[ref]
+        y = log_irradiance[row] - y_ref
+        if np.isnan(y):
+            poisoned = True
+            y = 0.0
+        n += 1.0
+        sx += x
+        sy += y
+        sxx += x * x
+        syy += y * y
+        sxy += x * y
+        if poisoned:
+            continue
+
+        ssxm = n * sxx - sx * sx
+        ssym = n * syy - sy * sy
+        ssxym = n * sxy - sx * sy
+        r_den = np.sqrt(ssxm * ssym)
+        r = 0.0 if r_den == 0 else min(max(ssxym / r_den, -1.0), 1.0)
+        if n >= 2 and ssxm != 0:
+            lr_all[row] = -ssxym / ssxm
+        r2_lr_all[row] = r * r
+
+    return lr, r2_lr, lr_all, r2_lr_all
+
+
+if numba is not None:
+    _kfunctions_kernel = numba.njit(nogil=True, error_model='numpy')(
+        _kfunctions_loop)
+else:
+    _kfunctions_kernel = None
+
+
+def _lttb_loop(x, y, points):
+    """
+    Indices of the points of a curve selected by Largest-Triangle-Three-
+    Buckets: first and last points, and in each bucket the point with the
+    largest triangle with the last selected point and the mean of the next
+    bucket. It is compiled with numba if it is installed
+
+    Parameters
+    ----------
+        x, y: numpy array
+            Values of the curve, sorted by x
+        points: int
+            Number of points to select, less than the points of the curve
+
+    Return
+    ------
+        selected: numpy array
+            Indices of the selected points
+    """
+    n = len(x)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[points - 1] = n - 1
+    edges = (1 + np.arange(points - 1) * (n - 2) / (points - 2)).astype(
+        np.int64)
+
+    last = 0
+    for bucket in range(points - 2):
+        start = edges[bucket]
+        end = edges[bucket + 1]
+        if bucket + 2 < points - 1:
+            next_start, next_end = end, edges[bucket + 2]
+        else:
+            next_start, next_end = n - 1, n
+        mean_x = np.mean(x[next_start:next_end])
+        mean_y = np.nanmean(y[next_start:next_end])
+
+        area = np.abs((x[last] - mean_x) * (y[start:end] - y[last]) -
+                      (x[last] - x[start:end]) * (mean_y - y[last]))
+        # NaN values are selected only if all the bucket is NaN
+        area[np.isnan(area)] = -1.0
+        last = start + np.argmax(area)
+        selected[bucket + 1] = last
+
+    return selected
+
+
+if numba is not None:
+    _lttb_kernel = numba.njit(nogil=True)(_lttb_loop)
+else:
+    _lttb_kernel = _lttb_loop
+
+
+def _downsample_indices(x, y, points, method='lttb'):
+    """
+    Indices of the points of a curve to plot it with a number of points
+
+    Parameters
+    ----------
+        x, y: numpy array
+            Values of the curve, sorted by x
+        points: int
+            Maximum number of points (at least 4)
+        method: str
+            'lttb' or 'minmax' (Default='lttb')
+
+    Return
+    ------
+        selected: numpy array
+            Sorted indices of the selected points, all the points if the
+            curve has no more than points
+    """
+    if method not in DOWNSAMPLE_METHODS:
+        raise ValueError(
+            f"downsample must be one of {DOWNSAMPLE_METHODS} or None, "
+            f"not '{method}'")
+    if points < 4:
+        raise ValueError(f"downsample_points must be 4 or more, not {points}")
+
+    n = len(x)
+    if n <= points:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if method == 'lttb':
+        return _lttb_kernel(x, y, points)
+
+    # minimum and maximum of each bucket, with the first and last points
+    buckets = (points - 2) // 2
+    bucket = np.arange(n) * buckets // n
+    starts = np.searchsorted(bucket, np.arange(buckets))
+    # NaN values are sorted at the end of each bucket
+    minimum = np.lexsort((y, bucket))[starts]
+    maximum = np.lexsort((-y, bucket))[starts]
+    selected = np.concatenate(([0, n - 1], minimum, maximum))
+    return np.unique(selected)
+
+
+class LambdaIndex:
+    """
+    Index of the lambda blocks of a dataframe, with the rows of a lambda
+    together and sorted by depth. It is built with one pass over the lambda
+    column, and gives the rows and depths of each lambda without grouping
+    """
+
+    def __init__(self, lmbd, depth=None):
+        """
+        Parameters
+        ----------
+            lmbd: numpy array
+                lambda value of each row
+            depth: numpy array
+                Depth of each row (Default=None)
+        """
+        lmbd = np.asarray(lmbd)
+        self.rows = len(lmbd)
+        if self.rows == 0:
+            self.starts = np.zeros(0, dtype=np.int64)
+        else:
+            changes = np.flatnonzero(lmbd[1:] != lmbd[:-1]) + 1
+            self.starts = np.concatenate(([0], changes))
+        self.ends = np.append(self.starts[1:], self.rows).astype(np.int64)
+
+        # lambda of each block in the order of the rows, and sorted
+        self.block_lambdas = lmbd[self.starts]
+        self.order = np.argsort(self.block_lambdas, kind='stable')
+        self.lambdas = self.block_lambdas[self.order]
+        self.depth = None if depth is None else np.asarray(depth, dtype=float)
+
+        self._blocks = {
+            value: n for n, value in enumerate(self.block_lambdas.tolist())}
+        self._block_start = None
+
+    @classmethod
+    def from_dataframe(cls, df, column='lambda'):
+        """
+        Build the index of the blocks of a column of a dataframe
+        """
+        depth = df['depth'].to_numpy(dtype=float) if 'depth' in df else None
+        return cls(df[column].to_numpy(), depth)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def block_start(self):
+        """
+        Index of the first row of the lambda block of each row
+        """
+        if self._block_start is None:
+            self._block_start = np.repeat(
+                self.starts, self.ends - self.starts)
+        return self._block_start
+
+    @property
+    def position(self):
+        """
+        Position of each row inside its lambda block
+        """
+        return np.arange(self.rows) - self.block_start
+
+    def rows_of(self, lmbda):
+        """
+        Get the slice of the rows of a lambda
+
+        Parameters
+        ----------
+            lmbda: float
+                lambda value
+
+        Return
+        ------
+            rows: slice
+                Rows of the lambda
+        """
+        try:
+            n = self._blocks[lmbda]
+        except KeyError:
+            raise KeyError(f"lambda {lmbda} not found") from None
+        return slice(int(self.starts[n]), int(self.ends[n]))
+
+    def depths(self, lmbda):
+        """
+        Get the depths of a lambda
+        """
+        return self.depth[self.rows_of(lmbda)]
+
+    def blocks(self):
+        """
+        Yield each lambda, sorted, with the first and the end row of its
+        block
+        """
+        for n in self.order:
+            yield self.block_lambdas[n], self.starts[n], self.ends[n]
+
+
+def _resolve_kernel(kernel):
+    """
+    Get the kernel to calculate kfunctions: 'numpy' or 'numba'
+    """
+    if kernel not in KERNELS:
+        raise ValueError(
+            f"kernel must be one of {KERNELS}, not '{kernel}'")
+
+    if kernel == 'auto':
+        return 'numpy' if numba is None else 'numba'
+
+    if kernel == 'numba' and numba is None:
+        raise ImportError("kernel 'numba' needs numba installed")
+
+    return kernel
+
+
+def _numeric(df):
+    """
+    Assign float to lambda and depth and numeric values to all columns
+    of a dataframe
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe of irradiances
+
+    Return
+    ------
+        df: pandas dataframe object
+            New dataframe with numeric values
+    """
+    # a new dataframe, df is not modified
+    df = df.assign(**{
+        'lambda': df['lambda'].astype(float).fillna(0.0),
+        'depth': df['depth'].astype(float).fillna(0.0),
+    })
+
+    return df.apply(pd.to_numeric, args=('coerce',))
+
+
+def _log_irradiance(irradiance, invalid_policy='drop', clamp_value=1e-30):
+    """
+    Calculate the natural logarithm of an irradiance column and the mask
+    of valid values, according to the invalid irradiance policy
+
+    Parameters
+    ----------
+        irradiance: numpy array
+            Irradiance values of one column
+        invalid_policy: str
+            Policy for non-positive or non-numeric irradiances
+            (Default='drop')
+        clamp_value: float
+            Irradiance of non-positive values with 'clamp' policy
+            (Default=1e-30)
+
+    Return
+    ------
+        log_irradiance: numpy array
+            ln(E), NaN where the irradiance is not valid
+        mask: numpy array
+            Boolean array, True where the irradiance is valid
+    """
+    irradiance = np.asarray(irradiance, dtype=float)
+
+    # replace non-positive irradiances with the clamp value. NaN values
+    # (non numeric values in the file) remain not valid
+    if invalid_policy == 'clamp':
+        irradiance = np.maximum(irradiance, clamp_value)
+
+    mask = np.isfinite(irradiance) & (irradiance > 0)
+    log_irradiance = np.full(irradiance.shape, np.nan)
+    np.log(irradiance, out=log_irradiance, where=mask)
+
+    return log_irradiance, mask
+
+
+def _block_cumsum(values, index):
+    """
+    Cumulative sum of values restarted at each lambda block. Each block
+    is summed apart, as a row of a (block, position) matrix: subtracting a
+    cumulative sum of all rows loses precision in the last blocks of large
+    files
+    """
+    values = np.asarray(values, dtype=float)
+    lengths = index.ends - index.starts
+    width = int(lengths.max(initial=0))
+
+    # all blocks with the same length (the same depths for all lambdas)
+    if len(values) == len(index) * width:
+        return np.cumsum(
+            values.reshape(len(index), width), axis=1).reshape(-1)
+
+    # blocks padded with zeros to the longest block
+    if len(index) * width <= 2 * len(values):
+        block = np.repeat(np.arange(len(index)), lengths)
+        position = np.arange(len(values)) - index.block_start
+        matrix = np.zeros((len(index), width))
+        matrix[block, position] = values
+        return np.cumsum(matrix, axis=1)[block, position]
+
+    # blocks of very different lengths: a cumulative sum of all rows in
+    # extended precision, minus the sum before each block
+    total = np.cumsum(values, dtype=np.longdouble)
+    before = np.concatenate(([0.0], total[:-1]))[index.block_start]
+    return (total - before).astype(float)
+
+
+def _kfunctions_from_log(depth, log_irradiance, mask, index, config,
+                         stage=contextlib.nullcontext):
+    """
+    Calculate kfunctions of one irradiance for all lambdas at once
+
+    Parameters
+    ----------
+        depth: numpy array
+            Depth of each row
+        log_irradiance: numpy array
+            ln(E) of each row
+        mask: numpy array
+            Boolean array, True where the irradiance is valid
+        index: LambdaIndex object
+            Lambda blocks of the rows
+        config: dict
+            Configuration of compute_kfunctions()
+        stage: function
+            Context manager to time each method (Default=no timing)
+
+    Return
+    ------
+        kfunctions: dict
+            Arrays 'LR', 'r2value_LR', 'LR_all_points',
+            'r2value_LR_all_points' and 'HL'. NaN where the kfunction
+            can not be calculated
+    """
+    rows = np.arange(len(depth))
+    block_start = index.block_start
+    position = rows - block_start
+
+    # with 'drop' policy not valid points are excluded of the
+    # regressions. With 'nan' or 'clamp' policy they propagate NaN
+    if config['invalid_policy'] == 'drop':
+        used = mask
+    else:
+        used = np.ones(len(depth), dtype=bool)
+
+    if _resolve_kernel(config['kernel']) == 'numba':
+        with stage('numba'):
+            lr, r2_lr, lr_all, r2_lr_all = _kfunctions_kernel(
+                depth, log_irradiance, used, block_start)
+        kfunctions = {
+            'LR': lr,
+            'r2value_LR': r2_lr,
+            'LR_all_points': lr_all,
+            'r2value_LR_all_points': r2_lr_all,
+            'HL': lr.copy(),
+        }
+        for method, values in kfunctions.items():
+            values[~np.isfinite(values)] = np.nan
+        return kfunctions
+
+    # We do not calculate in depths of -1.0 and 0.0 (first two depths of
+    # each lambda)
+    computed = used & (position >= 2)
+
+    # last two used points until each row, inside its lambda block
+    last = np.maximum.accumulate(np.where(used, rows, -1))
+    prev = np.full(len(depth), -1)
+    before = last - 1
+    has_prev = computed & (before >= block_start)
+    prev[has_prev] = last[before[has_prev]]
+    has_prev &= prev >= block_start
+    last = np.where(has_prev, last, 0)
+    prev = np.where(has_prev, prev, 0)
+
+    errstate = dict(divide='ignore', invalid='ignore')
+
+    # Calculate K-functions as a negative of the slope of linear
+    # regression with last 2 elements z2 and z1
+    with np.errstate(**errstate), stage('LR'):
+        d_log = log_irradiance[last] - log_irradiance[prev]
+        slope = d_log / (depth[last] - depth[prev])
+        lr = np.where(has_prev, -slope, np.nan)
+        r2_lr = np.where(
+            has_prev & ~np.isnan(d_log), (d_log != 0) * 1.0, np.nan)
+
+    # Calculate K-functions as it is calculated in HydroLight:
+    # logarithmic derivative between the last 2 depths
+    with stage('HL'):
+        hl = lr.copy()
+
+    # Calculate K-functions as a negative of the slope of linear
+    # regression with all elements, except points in depths at -1.0 and
+    # 0.0. Sums are centered in the first regression point of each lambda
+    # to avoid loss of precision
+    with np.errstate(**errstate), stage('LR_all_points'):
+        ref = np.minimum(block_start + 2, len(depth) - 1)
+        x = depth - depth[ref]
+        y = log_irradiance - np.nan_to_num(log_irradiance[ref])
+        poisoned = _block_cumsum(computed & np.isnan(y), index)
+        y = np.where(computed, np.nan_to_num(y), 0.0)
+        x = np.where(computed, x, 0.0)
+
+        n = _block_cumsum(computed * 1.0, index)
+        sx = _block_cumsum(x, index)
+        sy = _block_cumsum(y, index)
+        ssxm = n * _block_cumsum(x * x, index) - sx * sx
+        ssym = n * _block_cumsum(y * y, index) - sy * sy
+        ssxym = n * _block_cumsum(x * y, index) - sx * sy
+
+        r_den = np.sqrt(ssxm * ssym)
+        r = np.clip(np.where(r_den == 0, 0.0, ssxym / r_den), -1.0, 1.0)
+        valid_all = computed & (poisoned == 0)
+        lr_all = np.where(valid_all & (n >= 2), -ssxym / ssxm, np.nan)
+        r2_lr_all = np.where(valid_all, r * r, np.nan)
+
+    kfunctions = {
+        'LR': lr,
+        'r2value_LR': r2_lr,
+        'LR_all_points': lr_all,
+        'r2value_LR_all_points': r2_lr_all,
+        'HL': hl,
+    }
+    for method, values in kfunctions.items():
+        values[~np.isfinite(values)] = np.nan
+
+    return kfunctions
+
+
+def _kfunctions_arrays(df, index, config, stage=contextlib.nullcontext):
+    """
+    Calculate kfunctions of all irradiances of dataframe
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with depth and irradiances, sorted by depth inside
+            each block
+        index: LambdaIndex object
+            Lambda blocks of the rows of dataframe
+        config: dict
+            Configuration of compute_kfunctions()
+        stage: function
+            Context manager to time each stage (Default=no timing)
+
+    Return
+    ------
+        kfunctions: dict
+            Name of each kfunction column and its values, in the order
+            they are saved. Values that can not be calculated are 0,
+            except with 'nan' policy
+    """
+    invalid_policy = config['invalid_policy']
+    if invalid_policy not in INVALID_POLICIES:
+        raise ValueError(
+            f"invalid_policy must be one of {INVALID_POLICIES}, "
+            f"not '{invalid_policy}'")
+
+    depth = df['depth'].to_numpy(dtype=float)
+
+    results = {}
+    for kfunction, irradiance in KFUNCTIONS_IRRADIANCES.items():
+        with stage(kfunction):
+            log_irradiance, mask = _log_irradiance(
+                df[irradiance].to_numpy(), invalid_policy,
+                config['clamp_value'])
+            results[kfunction] = _kfunctions_from_log(
+                depth, log_irradiance, mask, index, config, stage=stage)
+
+    kfunctions = {}
+    for prefix, method in KFUNCTIONS_COLUMNS:
+        for kfunction in KFUNCTIONS_IRRADIANCES:
+            key = method if prefix == 'calculated' else f'r2value_{method}'
+            values = results[kfunction][key]
+            if invalid_policy != 'nan':
+                values = np.nan_to_num(values)
+            kfunctions[f'{prefix}_{kfunction}_{method}'] = values
+
+    return kfunctions
+
+
+def _kfunctions_config(config=None):
+    """
+    Configuration of compute_kfunctions() with the defaults of
+    KFUNCTIONS_CONFIG
+    """
+    if config is None:
+        config = {}
+
+    unknown = sorted(set(config) - set(KFUNCTIONS_CONFIG))
+    if unknown:
+        raise KeyError(f"Unknown configuration keys {unknown}")
+
+    return {**KFUNCTIONS_CONFIG, **config}
+
+
+def _irradiance_cube(df, columns):
+    """
+    Arrange irradiances of a dataframe as a (lambda, depth) cube
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances columns
+        columns: list
+            Names of the irradiance columns
+
+    Return
+    ------
+        lambdas: numpy array
+            Sorted lambda values
+        depths: numpy array
+            Depth values, the same for all lambdas
+        cube: numpy array
+            Irradiances with shape (columns, lambda, depth)
+    """
+    index = LambdaIndex(df['lambda'].to_numpy(dtype=float))
+    starts = index.starts
+    n_depth = len(df) // len(starts)
+
+    depths = df['depth'].to_numpy(dtype=float)
+    if (len(df) != len(starts) * n_depth) or not np.array_equal(
+            depths.reshape(len(starts), n_depth),
+            np.broadcast_to(depths[:n_depth], (len(starts), n_depth))):
+        raise ValueError(
+            "All lambdas must have the same depths to build the "
+            "(lambda, depth) cube")
+
+    cube = df[columns].to_numpy(dtype=float).T.reshape(
+        len(columns), len(starts), n_depth)[:, index.order]
+
+    return index.lambdas, depths[:n_depth], cube
+
+
+def _resample_lambdas(table, lambdas, config=None):
+    """
+    Interpolate all irradiances of a table in log space onto the target
+    lambdas. The table is not modified
+
+    Parameters
+    ----------
+        table: pandas dataframe object
+            dataframe with lambda, depth and irradiances, all lambdas with
+            the same depths
+        lambdas: list
+            Target lambda values in nm
+        config: dict
+            Configuration of compute_kfunctions(), 'invalid_policy' and
+            'clamp_value' are used (Default=None, KFUNCTIONS_CONFIG)
+
+    Return
+    ------
+        df: pandas dataframe object
+            New dataframe with the irradiances of the target lambdas
+    """
+    config = _kfunctions_config(config)
+    df = _numeric(table)
+
+    columns = [column for column in df.columns
+               if column not in ('lambda', 'depth')]
+    source, depths, cube = _irradiance_cube(df, columns)
+    target = np.unique(np.asarray(lambdas, dtype=float))
+
+    # ln(E) of all columns and depths as a (lambda, column * depth)
+    # matrix. Not valid irradiances are NaN and stay not valid in the
+    # neighbouring target lambdas
+    log_cube, mask = _log_irradiance(
+        cube, config['invalid_policy'], config['clamp_value'])
+    log_matrix = log_cube.transpose(1, 0, 2).reshape(len(source), -1)
+
+    weights = _interpolation_weights(tuple(source), tuple(target))
+    resampled = np.exp(weights @ log_matrix).reshape(
+        len(target), len(columns), len(depths))
+
+    df = pd.DataFrame({
+        'lambda': np.repeat(target, len(depths)),
+        'depth': np.tile(depths, len(target)),
+    })
+    for n, column in enumerate(columns):
+        df[column] = resampled[:, n].ravel()
+
+    return df
+
+
+def _resample_depths(table, depths, config=None):
+    """
+    Interpolate all irradiances of a table in log space onto the target
+    depths, for all lambdas at once. The first two depths (-1.0 and 0.0)
+    are kept. The table is not modified
+
+    Parameters
+    ----------
+        table: pandas dataframe object
+            dataframe with lambda, depth and irradiances, all lambdas with
+            the same depths
+        depths: float or list
+            Depth step in meters of a uniform grid, or target depth values
+            in meters
+        config: dict
+            Configuration of compute_kfunctions(), 'invalid_policy' and
+            'clamp_value' are used (Default=None, KFUNCTIONS_CONFIG)
+
+    Return
+    ------
+        df: pandas dataframe object
+            New dataframe with the irradiances of the target depths
+    """
+    config = _kfunctions_config(config)
+    df = _numeric(table)
+
+    columns = [column for column in df.columns
+               if column not in ('lambda', 'depth')]
+    lambdas, source, cube = _irradiance_cube(df, columns)
+
+    if np.ndim(depths) == 0:
+        target = np.arange(source[2], source[-1] + depths / 2, depths)
+        # the last step can pass the last depth of the file
+        target = target[target <= source[-1]]
+    else:
+        target = np.unique(np.asarray(depths, dtype=float))
+        target = target[target > source[1]]
+        if len(target) == 0 or (target < source[2]).any():
+            raise ValueError(
+                f"Target depths must be {source[2]} or deeper, the "
+                f"first depth below {source[1]} of the file")
+
+    # ln(E) is linear in depth between two depths
+    log_cube, mask = _log_irradiance(
+        cube[:, :, 2:], config['invalid_policy'], config['clamp_value'])
+    weights = _interpolation_weights(tuple(source[2:]), tuple(target))
+    log_matrix = log_cube.reshape(-1, len(source) - 2)
+    resampled = np.exp((weights @ log_matrix.T).T).reshape(
+        len(columns), len(lambdas), len(target))
+    resampled = np.concatenate((cube[:, :, :2], resampled), axis=2)
+
+    target = np.concatenate((source[:2], target))
+    df = pd.DataFrame({
+        'lambda': np.repeat(lambdas, len(target)),
+        'depth': np.tile(target, len(lambdas)),
+    })
+    for n, column in enumerate(columns):
+        df[column] = resampled[n].ravel()
+
+    return df
+
+
+def compute_kfunctions(table, config=None):
+    """
+    Calculate kfunctions of a table of irradiances. The table is not
+    modified and no global setting is changed, so it can be called from
+    many threads at once
+
+    Parameters
+    ----------
+        table: pandas dataframe object
+            dataframe with lambda, depth and irradiances, rows of a lambda
+            together and sorted by depth
+        config: dict
+            'invalid_policy', 'clamp_value' and 'kernel'
+            (Default=None, KFUNCTIONS_CONFIG)
+
+    Return
+    ------
+        result: pandas dataframe object
+            New dataframe with numeric values of the table and the
+            kfunctions columns
+    """
+    config = _kfunctions_config(config)
+
+    result = _numeric(table)
+    kfunctions = _kfunctions_arrays(
+        result, LambdaIndex.from_dataframe(result), config)
+    for column, values in kfunctions.items():
+        result[column] = values
+
+    return result
+
 
 class ProcessIrradFile:
     """
@@ -41,17 +1165,41 @@ class ProcessIrradFile:
 
         # class variables
         self.file_name = "Lroot_calculated_irradiances.csv"
-        self.file_name_csv = f"{self.file_name.split('.')[0]}_data.csv"
+        self.file_name_csv = f"{_file_stem(self.file_name)}_data.csv"
         self.path_files_raw = "files/raw"
         self.path_files_csv = "files/csv"
         self.path_images_plotly = "images/plotly"
+        self.path_images_matplotlib = "images/matplotlib"
+        self.run_directories = False
+        self.run_name = None
+        self.output_files = []
         self.content = None
         self.df = pd.DataFrame()
-        pd.options.mode.chained_assignment = None
-        warnings.filterwarnings("ignore")
+        self.df_bands = pd.DataFrame()
+        self.invalid_policy = "drop"
+        self.clamp_value = 1e-30
+        self.output_format = "csv"
+        self.compression = None
+        self.memory_budget = None
+        self.include_plotlyjs = True
+        self.html_precision = None
+        self.html_report = None
+        self.downsample = None
+        self.downsample_points = 500
+        self.image_formats = ('svg',)
+        self.dpi = 100
+        self.file_path = None
+        self._lambda_index = None
+        self.kernel = "numpy"
+        self.profile = False
+        self.profile_hooks = ()
+        self.stages = []
+        self._stage_names = []
 
     def calc_kfunctions(self, file_name="Lroot_calculated_irradiances.csv",
-                        path_file="files/raw"):
+                        path_file="files/raw", invalid_policy=None,
+                        lambdas=None, depths=None, output_format=None,
+                        kernel=None, memory_budget=None):
         """
         Join methods to calculate kfunctions
 
@@ -61,24 +1209,132 @@ class ProcessIrradFile:
                 Name of the file (Default="Lroot.txt")
             path_file: str
                 Path of the file (Default="files/raw")
+            invalid_policy: str
+                Policy for non-positive or non-numeric irradiances: 'drop',
+                'nan' or 'clamp' (Default=None, uses self.invalid_policy)
+            lambdas: list
+                Lambda values in nm to interpolate irradiances before
+                calculating kfunctions (Default=None, lambdas of the file)
+            depths: float or list
+                Depth step in meters, or depth values in meters, to
+                interpolate irradiances before calculating kfunctions
+                (Default=None, depths of the file)
+            output_format: str
+                Format of the results: 'csv' or 'columnar'
+                (Default=None, uses self.output_format)
+            kernel: str
+                Kernel to calculate kfunctions: 'auto', 'numpy' or 'numba'
+                (Default=None, uses self.kernel)
+            memory_budget: int
+                Memory in bytes to calculate kfunctions out of core, by
+                partitions of lambdas saved in a columnar folder
+                (Default=None, uses self.memory_budget. None reads the
+                whole file)
+        """
+        if file_name is None:
+            file_name = self.file_name
+        else:
+            self.file_name = file_name
+
+        if invalid_policy is not None:
+            self.invalid_policy = invalid_policy
+
+        if output_format is not None:
+            self.output_format = output_format
+
+        if kernel is not None:
+            self.kernel = kernel
+
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+
+        self._set_run_name(
+            file_name, invalid_policy=self.invalid_policy, lambdas=lambdas,
+            depths=depths)
+
+        fname = f"{_file_stem(file_name)}_calc_kfunctions"
+        with self._profile_run(fname):
+            if self.memory_budget is not None:
+                if (lambdas is not None) or (depths is not None):
+                    raise ValueError(
+                        "lambdas and depths can not be interpolated out of "
+                        "core, set memory_budget to None")
+                with self._stage("calculate_kfunctions_out_of_core"):
+                    self._calculate_kfunctions_out_of_core(self._file_path(
+                        file_name=file_name, path_file=path_file))
+                return
+
+            with self._stage("open_file"):
+                self.open_file(file_name=file_name, path_file=path_file)
+            with self._stage("create_dataframe"):
+                self.create_dataframe_from_Lroot_calc_irrad()
+            with self._stage("validate"):
+                self.check_irradiances()
+            if lambdas is not None:
+                with self._stage("resample_lambdas"):
+                    self._resample_lambdas(lambdas)
+            if depths is not None:
+                with self._stage("resample_depths"):
+                    self._resample_depths(depths)
+            with self._stage("calculate_kfunctions"):
+                self.calculate_kfunctions()
+
+    def calc_band_kfunctions(self,
+                             file_name="Lroot_calculated_irradiances.csv",
+                             path_file="files/raw", bands=None,
+                             response_functions=None, quanta=False):
+        """
+        Join methods to calculate kfunctions of irradiances integrated over
+        wavelength bands (PAR or sensor bands)
+
+        Parameters
+        ----------
+            file_name: str
+                Name of the file (Default="Lroot_calculated_irradiances.csv")
+            path_file: str
+                Path of the file (Default="files/raw")
+            bands: dict
+                Name of the band and (min_lambda, max_lambda) in nm
+                (Default=None, PAR band 400-700 nm)
+            response_functions: dict
+                Name of the band and (lambdas, response) of the sensor
+                spectral response function (Default=None)
+            quanta: Boolean
+                Integrate in umol photons instead of W (Default=False)
         """
         if file_name is None:
             file_name = self.file_name
         else:
             self.file_name = file_name
 
-        self.open_file(file_name=file_name, path_file=path_file)
-        self.create_dataframe_from_Lroot_calc_irrad()
-        self.calculate_kfunctions()
+        self._set_run_name(
+            file_name, invalid_policy=self.invalid_policy, bands=bands,
+            response_functions=response_functions, quanta=quanta)
+
+        fname = f"{_file_stem(file_name)}_calc_band_kfunctions"
+        with self._profile_run(fname):
+            with self._stage("open_file"):
+                self.open_file(file_name=file_name, path_file=path_file)
+            with self._stage("create_dataframe"):
+                self.create_dataframe_from_Lroot_calc_irrad()
+            with self._stage("validate"):
+                self.check_irradiances()
+            with self._stage("calculate_band_kfunctions"):
+                self._calculate_band_kfunctions(
+                    bands=bands, response_functions=response_functions,
+                    quanta=quanta)
 
     def plot_kfunctions(self, file_name_csv=None, path_file_csv=None,
                         is_shown=False, min_lambda=400, max_lambda=700,
+                        max_depth=None,
                         plotly=True,
                         matplotlib=False,
                         plot_irradiances=True,
                         plot_kfunctionsLR=False,
                         plot_calculated_Kd_LR_all_points=True,
-                        plot_calculated_Kd_HL=False):
+                        plot_calculated_Kd_HL=False,
+                        downsample=None, downsample_points=None,
+                        image_formats=None, dpi=None):
         """
         Join methods to plot irradiances
 
@@ -94,6 +1350,8 @@ class ProcessIrradFile:
                 Minimum lambda value to plot (Default=400)
             max_lambda: int
                 Maximum lambda value to plot (Default=700)
+            max_depth: float
+                Maximum depth value to plot (Default=None, all depths)
             plotly: Boolean
                 Boolean to plot with Plotly lib (Default=True)
             matplotlib: Boolean
@@ -106,7 +1364,30 @@ class ProcessIrradFile:
                 Boolean to plot plot_calculated_Kd_LR_all_points (Default=True)
             plot_calculated_Kd_HL: Boolean
                 Boolean to plot plot_calculated_Kd_HL (Default=False)
+            downsample: str
+                Method to downsample the curves of each lambda: 'lttb' or
+                'minmax' (Default=None, uses self.downsample)
+            downsample_points: int
+                Maximum number of points of each curve
+                (Default=None, uses self.downsample_points)
+            image_formats: tuple
+                Formats of the images: 'svg' and/or 'png'
+                (Default=None, uses self.image_formats)
+            dpi: int
+                Dots per inch of png images (Default=None, uses self.dpi)
         """
+        if downsample is not None:
+            self.downsample = downsample
+
+        if image_formats is not None:
+            self.image_formats = image_formats
+
+        if dpi is not None:
+            self.dpi = dpi
+
+        if downsample_points is not None:
+            self.downsample_points = downsample_points
+
         if file_name_csv is None:
             file_name_csv = self.file_name_csv
         else:
@@ -117,41 +1398,78 @@ class ProcessIrradFile:
         else:
             self.path_files_csv = path_file_csv
 
-        self.open_file(file_name=file_name_csv, path_file=path_file_csv)
-        self.create_dataframe_from_Lroot_calc_kfunctions()
-
-        if plotly is True:
-
-            if plot_irradiances is True:
-                self.plot_irradiances_plotly(is_shown=is_shown)
-
-            if plot_kfunctionsLR is True:
-                self.plot_kfunctionsLR_plotly(is_shown=is_shown)
-
-            if plot_calculated_Kd_LR_all_points is True:
-                self.plot_calculated_Kd_LR_all_points_plotly(is_shown=is_shown)
-
-            if plot_calculated_Kd_HL is True:
-                self.plot_calculated_Kd_HL_plotly(is_shown=is_shown)
-
-        if matplotlib is True:
-
-            if plot_irradiances is True:
-                self.plot_irradiances_matplotlib(is_shown=is_shown)
-
-            if plot_kfunctionsLR is True:
-                self.plot_kfunctionsLR_matplotlib(is_shown=is_shown)
-
-            if plot_calculated_Kd_LR_all_points is True:
-                self.plot_calculated_Kd_LR_all_points_matplotlib(
-                    is_shown=is_shown)
-
-            if plot_calculated_Kd_HL is True:
-                self.plot_calculated_Kd_HL_matplotlib(is_shown=is_shown)
-
-    def open_file(self, file_name=None, path_file=None):
+        self._set_run_name(
+            file_name_csv, min_lambda=min_lambda, max_lambda=max_lambda,
+            max_depth=max_depth, downsample=self.downsample,
+            downsample_points=(self.downsample_points
+                               if self.downsample is not None else None))
+
+        # read only the columns of the enabled plots
+        plots = [plot for plot, enabled in (
+            ('plot_irradiances', plot_irradiances),
+            ('plot_kfunctionsLR', plot_kfunctionsLR),
+            ('plot_calculated_Kd_LR_all_points',
+             plot_calculated_Kd_LR_all_points),
+            ('plot_calculated_Kd_HL', plot_calculated_Kd_HL)) if enabled]
+        columns = ['lambda', 'depth'] + [
+            column for plot in plots for column in PLOT_COLUMNS[plot]]
+
+        fname = f"{_file_stem(file_name_csv)}_plot_kfunctions"
+        with self._profile_run(fname):
+            with self._stage("open_file"):
+                self.open_file(
+                    file_name=file_name_csv, path_file=path_file_csv,
+                    lazy=True)
+            with self._stage("create_dataframe"):
+                self.create_dataframe_from_Lroot_calc_kfunctions(
+                    columns=columns)
+
+            if plotly is True:
+
+                if plot_irradiances is True:
+                    with self._stage("plot_irradiances_plotly"):
+                        self.plot_irradiances_plotly(is_shown=is_shown)
+
+                if plot_kfunctionsLR is True:
+                    with self._stage("plot_kfunctionsLR_plotly"):
+                        self.plot_kfunctionsLR_plotly(is_shown=is_shown)
+
+                if plot_calculated_Kd_LR_all_points is True:
+                    with self._stage(
+                            "plot_calculated_Kd_LR_all_points_plotly"):
+                        self.plot_calculated_Kd_LR_all_points_plotly(
+                            min_lambda=min_lambda, max_lambda=max_lambda,
+                            is_shown=is_shown, max_depth=max_depth)
+
+                if plot_calculated_Kd_HL is True:
+                    with self._stage("plot_calculated_Kd_HL_plotly"):
+                        self.plot_calculated_Kd_HL_plotly(is_shown=is_shown)
+
+            if matplotlib is True:
+
+                if plot_irradiances is True:
+                    with self._stage("plot_irradiances_matplotlib"):
+                        self.plot_irradiances_matplotlib(is_shown=is_shown)
+
+                if plot_kfunctionsLR is True:
+                    with self._stage("plot_kfunctionsLR_matplotlib"):
+                        self.plot_kfunctionsLR_matplotlib(is_shown=is_shown)
+
+                if plot_calculated_Kd_LR_all_points is True:
+                    with self._stage(
+                            "plot_calculated_Kd_LR_all_points_matplotlib"):
+                        self.plot_calculated_Kd_LR_all_points_matplotlib(
+                            is_shown=is_shown)
+
+                if plot_calculated_Kd_HL is True:
+                    with self._stage("plot_calculated_Kd_HL_matplotlib"):
+                        self.plot_calculated_Kd_HL_matplotlib(
+                            is_shown=is_shown)
+
+    def _file_path(self, file_name=None, path_file=None):
         """
-        Open file and get content of file
+        Get the path of a file, with self.file_name and self.path_files_raw
+        by default
 
         Parameters
         ----------
@@ -159,6 +1477,11 @@ class ProcessIrradFile:
                 Name of the file (Default=None)
             path_file: str
                 Path of the file (Default=None)
+
+        Return
+        ------
+            f: str
+                Path of the file
         """
         if (file_name is None) and (path_file is None):
             f = os.path.join(self.path_files_raw, self.file_name)
@@ -168,9 +1491,35 @@ class ProcessIrradFile:
             f = os.path.join(self.path_files_raw, file_name)
         else:
             f = os.path.join(path_file, file_name)
+        return f
+
+    def open_file(self, file_name=None, path_file=None, lazy=False):
+        """
+        Open file and get content of file
+
+        Parameters
+        ----------
+            file_name: str
+                Name of the file (Default=None)
+            path_file: str
+                Path of the file (Default=None)
+            lazy: Boolean
+                Only check the file. It is read by
+                create_dataframe_from_Lroot_calc_kfunctions() (Default=False)
+        """
+        f = self._file_path(file_name=file_name, path_file=path_file)
+        self.file_path = f
         try:
-            with open(f, 'r') as file:
-                self.content = file.read()
+            # columnar folders are read in create_dataframe methods
+            if os.path.isdir(f):
+                self.content = None
+            elif lazy is True:
+                if not os.path.exists(f):
+                    raise FileNotFoundError(f)
+                self.content = None
+            else:
+                with _open_compressed(f, 'rt', _compression(f)) as file:
+                    self.content = file.read()
 
         except FileNotFoundError:
             print(f"File {self.file_name} not found")
@@ -184,505 +1533,740 @@ class ProcessIrradFile:
         self.df = pd.read_csv(io.StringIO(self.content), header=0,
                               skipinitialspace=True, index_col=0)
 
+    def validate_irradiances(self, df=None, max_rows=10, first_row=0):
+        """
+        Check the dataframe of irradiances before calculating kfunctions:
+        columns, numeric values, depths sorted inside each lambda, duplicate
+        (lambda, depth) pairs and non-positive irradiances
+
+        Parameters
+        ----------
+            df: pandas dataframe object
+                dataframe of irradiances, as read from the file
+                (Default=None, uses self.df)
+            max_rows: int
+                Maximum number of rows listed for each problem (Default=10)
+            first_row: int
+                Position in the file of the first row of dataframe, when it
+                is a partition of the file (Default=0)
+
+        Return
+        ------
+            result: dict
+                'valid': False if there are errors, 'rows': number of rows,
+                'lambdas': number of lambdas and 'problems': list of dicts
+                with 'check', 'severity' ('error' or 'warning'),
+                'message', 'columns', 'count' (number of rows or columns
+                with the problem) and the first 'rows' (positions in the
+                file) with the problem
+        """
+        if df is None:
+            df = self.df
+
+        problems = []
+
+        def add_problem(check, severity, message, columns=(), rows=None,
+                        count=None):
+            rows = (np.flatnonzero(rows) + first_row if rows is not None
+                    else np.array([]))
+            problems.append({
+                'check': check,
+                'severity': severity,
+                'message': message,
+                'columns': list(columns),
+                'count': int(len(rows) if count is None else count),
+                'rows': rows[:max_rows].tolist(),
+            })
+
+        missing = [column for column in REQUIRED_COLUMNS
+                   if column not in df.columns]
+        if missing:
+            add_problem('missing_columns', 'error',
+                        f"Missing columns {missing}", columns=missing,
+                        count=len(missing))
+
+        present = [column for column in REQUIRED_COLUMNS
+                   if column in df.columns]
+        values = df[present].apply(pd.to_numeric, args=('coerce',))
+
+        # lambda and depth must be numeric. Not numeric irradiances are
+        # not valid points of the regressions (see invalid_policy)
+        for columns, severity in (
+                ([c for c in present if c in ('lambda', 'depth')], 'error'),
+                ([c for c in present if c not in ('lambda', 'depth')],
+                 'warning')):
+            not_numeric = values[columns].isna()
+            if not_numeric.to_numpy().any():
+                add_problem(
+                    'non_numeric', severity,
+                    f"Not numeric or empty values in "
+                    f"{not_numeric.columns[not_numeric.any()].tolist()}",
+                    columns=not_numeric.columns[not_numeric.any()],
+                    rows=not_numeric.any(axis=1).to_numpy())
+
+        irradiances = values[[c for c in present
+                              if c not in ('lambda', 'depth')]]
+        non_positive = irradiances <= 0
+        if non_positive.to_numpy().any():
+            add_problem(
+                'non_positive', 'warning',
+                f"Non-positive irradiances in "
+                f"{non_positive.columns[non_positive.any()].tolist()}",
+                columns=non_positive.columns[non_positive.any()],
+                rows=non_positive.any(axis=1).to_numpy())
+
+        n_lambdas = 0
+        if ('lambda' in present) and ('depth' in present):
+            # rows with not numeric lambda or depth are already errors, the
+            # structure is checked in the other rows
+            numeric = np.flatnonzero(
+                values[['lambda', 'depth']].notna().all(axis=1).to_numpy())
+            lmbd = values['lambda'].to_numpy(dtype=float)[numeric]
+            depth = values['depth'].to_numpy(dtype=float)[numeric]
+
+            def file_rows(mask):
+                rows = np.zeros(len(df), dtype=bool)
+                rows[numeric[mask]] = True
+                return rows
+
+            if len(numeric) > 0:
+                index = LambdaIndex(lmbd)
+                starts = index.starts
+                n_lambdas = len(np.unique(lmbd))
+
+                # rows of a lambda must be together
+                repeated = np.zeros(len(lmbd), dtype=bool)
+                repeated[starts] = pd.Series(
+                    lmbd[starts]).duplicated().to_numpy()
+                if repeated.any():
+                    add_problem(
+                        'lambda_blocks', 'error',
+                        "Rows of a lambda are not together",
+                        columns=['lambda'], rows=file_rows(repeated))
+
+                unsorted = np.zeros(len(lmbd), dtype=bool)
+                unsorted[1:] = (index.position[1:] != 0) & (
+                    depth[1:] < depth[:-1])
+                if unsorted.any():
+                    add_problem(
+                        'unsorted_depths', 'error',
+                        "Depths are not sorted inside a lambda",
+                        columns=['depth'], rows=file_rows(unsorted))
+
+                duplicated = pd.DataFrame(
+                    {'lambda': lmbd, 'depth': depth}).duplicated().to_numpy()
+                if duplicated.any():
+                    add_problem(
+                        'duplicates', 'error',
+                        "Duplicate (lambda, depth) pairs",
+                        columns=['lambda', 'depth'],
+                        rows=file_rows(duplicated))
+
+        return {
+            'valid': not any(
+                problem['severity'] == 'error' for problem in problems),
+            'rows': len(df),
+            'lambdas': n_lambdas,
+            'problems': problems,
+        }
+
+    def check_irradiances(self, df=None, first_row=0):
+        """
+        Validate the dataframe of irradiances and raise an error if it is
+        not valid
+
+        Parameters
+        ----------
+            df: pandas dataframe object
+                dataframe of irradiances (Default=None, uses self.df)
+            first_row: int
+                Position in the file of the first row of dataframe
+                (Default=0)
+
+        Raise
+        -----
+            ValueError
+                If there are errors in the dataframe
+        """
+        result = self.validate_irradiances(df, first_row=first_row)
+        if not result['valid']:
+            errors = [
+                f"{problem['message']} (rows {problem['rows']})"
+                if problem['rows'] else problem['message']
+                for problem in result['problems']
+                if problem['severity'] == 'error']
+            raise ValueError(
+                "Irradiances are not valid: " + "; ".join(errors))
+
     def create_dataframe_from_Lroot_calc_irrad(self):
         """
         Create new thread to process create dataframe
         """
-        the_process = threading.Thread(
-            target=self._create_dataframe_from_Lroot_calc_irrad)
-        the_process.start()
-        while the_process.is_alive():
-            self.animated_loading(process_name="Create Dataframe")
+        self._run_loading(self._create_dataframe_from_Lroot_calc_irrad,
+                          process_name="Create Dataframe")
 
-    def _calculate_kfunctions(self):
+    def _log_irradiance(self, irradiance):
         """
-        Calculate kfunctions Kd, Ku and Kl
+        Calculate ln(E) and the mask of valid values with the invalid
+        irradiance policy of the attributes. See _log_irradiance()
+        """
+        return _log_irradiance(
+            irradiance, self.invalid_policy, self.clamp_value)
+
+    def lambda_index(self, df=None):
+        """
+        Get the LambdaIndex of a dataframe. The index of self.df is built
+        once and reused until self.df is replaced
+
+        Parameters
+        ----------
+            df: pandas dataframe object
+                dataframe with lambda and depth columns
+                (Default=None, uses self.df)
 
         Return
         ------
-            df_final: pandas dataframe object
-                dataframe with Kd values
+            index: LambdaIndex object
         """
-        # add columns to dataframe
-        # Calculate K-functions as a negative of the slope of liner regression
-        # with last 2 elements z2 and z1
-        self.df['calculated_Kd_LR'] = 0
-        self.df['calculated_Ku_LR'] = 0
-        self.df['calculated_Kl1_LR'] = 0
-        self.df['calculated_Kl2_LR'] = 0
-        self.df['calculated_Kl1_polar_cap_LR'] = 0
-        self.df['calculated_Kl2_polar_cap_LR'] = 0
-        self.df['calculated_Khc_LR'] = 0
-        self.df['calculated_Khc_45_LR'] = 0
-
-        self.df['r2value_Kd_LR'] = 0
-        self.df['r2value_Ku_LR'] = 0
-        self.df['r2value_Kl1_LR'] = 0
-        self.df['r2value_Kl2_LR'] = 0
-        self.df['r2value_Kl1_polar_cap_LR'] = 0
-        self.df['r2value_Kl2_polar_cap_LR'] = 0
-        self.df['r2value_Khc_LR'] = 0
-        self.df['r2value_Khc_45_LR'] = 0
-
-        # Calculate K-functions as a negative of the slope of liner regression
-        # with all elements, except points in depths at -1.0 and 0.0
-        self.df['calculated_Kd_LR_all_points'] = 0
-        self.df['calculated_Ku_LR_all_points'] = 0
-        self.df['calculated_Kl1_LR_all_points'] = 0
-        self.df['calculated_Kl2_LR_all_points'] = 0
-        self.df['calculated_Kl1_polar_cap_LR_all_points'] = 0
-        self.df['calculated_Kl2_polar_cap_LR_all_points'] = 0
-        self.df['calculated_Khc_LR_all_points'] = 0
-        self.df['calculated_Khc_45_LR_all_points'] = 0
-
-        self.df['r2value_Kd_LR_all_points'] = 0
-        self.df['r2value_Ku_LR_all_points'] = 0
-        self.df['r2value_Kl1_LR_all_points'] = 0
-        self.df['r2value_Kl2_LR_all_points'] = 0
-        self.df['r2value_Kl1_polar_cap_LR_all_points'] = 0
-        self.df['r2value_Kl2_polar_cap_LR_all_points'] = 0
-        self.df['r2value_Khc_LR_all_points'] = 0
-        self.df['r2value_Khc_45_LR_all_points'] = 0
-
-        # Calculate K-functions as it is calculated in HydroLight
-        self.df['calculated_Kd_HL'] = 0
-        self.df['calculated_Ku_HL'] = 0
-        self.df['calculated_Kl1_HL'] = 0
-        self.df['calculated_Kl2_HL'] = 0
-        self.df['calculated_Kl1_polar_cap_HL'] = 0
-        self.df['calculated_Kl2_polar_cap_HL'] = 0
-        self.df['calculated_Khc_HL'] = 0
-        self.df['calculated_Khc_45_HL'] = 0
-
-        # assign float to lambda and depth in dataframe
-        self.df['lambda'] = self.df['lambda'].astype(float).fillna(0.0)
-        self.df['depth'] = self.df['depth'].astype(float).fillna(0.0)
-
-        self.df = self.df.apply(pd.to_numeric, args=('coerce',))
-
-        # init variables
-        lmbd = self.df['lambda'].iloc[0]
-
-        x = []
-
-        log_y_kd = []
-        log_y_ku = []
-        log_y_kl1 = []
-        log_y_kl2 = []
-        log_y_kl1_polar_cap = []
-        log_y_kl2_polar_cap = []
-        log_y_khc = []
-        log_y_khc_45 = []
-
-        y_kd = []
-        y_ku = []
-        y_kl1 = []
-        y_kl2 = []
-        y_kl1_polar_cap = []
-        y_kl2_polar_cap = []
-        y_khc = []
-        y_khc_45 = []
-
-        # Calculate df linear regression
-        print(f" - Start in lambda = {lmbd}")
-
-        for i in range(0, len(self.df)):
-
-            depth = self.df['depth'].iloc[i]
-
-            # clear variables in each new lambda
-            if lmbd != self.df['lambda'].iloc[i]:
-                lmbd = self.df['lambda'].iloc[i]
-                x = []
-
-                log_y_kd = []
-                log_y_ku = []
-                log_y_kl1 = []
-                log_y_kl2 = []
-                log_y_kl1_polar_cap = []
-                log_y_kl2_polar_cap = []
-                log_y_khc = []
-                log_y_khc_45 = []
-
-                y_kd = []
-                y_ku = []
-                y_kl1 = []
-                y_kl2 = []
-                y_kl1_polar_cap = []
-                y_kl2_polar_cap = []
-                y_khc = []
-                y_khc_45 = []
-                print(f" - Calculate in lambda = {lmbd}")
-
-            # Calculate k-functions. When we calculate all points of linear
-            # regression we do not calculate in depths of -1.0 and 0.0
-            if not math.isnan(depth):
-                x.append(self.df['depth'].iloc[i])
-
-                try:
-                    log_y_kd.append(math.log(
-                        self.df['calculated_Ed'].iloc[i]))
-                except ValueError as er:
-                    log_y_kd.append(0)
-                try:
-                    log_y_ku.append(math.log(
-                        self.df['calculated_Eu'].iloc[i]))
-                except ValueError as er:
-                    log_y_ku.append(0)
-                try:
-                    log_y_kl1.append(math.log(
-                        self.df['calculated_El1_no_polar_cap'].iloc[i]))
-                except ValueError as er:
-                    log_y_kl1.append(0)
-                try:
-                    log_y_kl2.append(math.log(
-                        self.df['calculated_El2_no_polar_cap'].iloc[i]))
-                except ValueError as er:
-                    log_y_kl2.append(0)
-                try:
-                    log_y_kl1_polar_cap.append(math.log(
-                        self.df['calculated_El1_polar_cap'].iloc[i]))
-                except ValueError as er:
-                    log_y_kl1_polar_cap.append(0)
-                try:
-                    log_y_kl2_polar_cap.append(math.log(
-                        self.df['calculated_El2_polar_cap'].iloc[i]))
-                except ValueError as er:
-                    log_y_kl1_polar_cap.append(0)
-                try:
-                    log_y_khc.append(math.log(
-                        self.df['calculated_Ehc'].iloc[i]))
-                except ValueError as er:
-                    log_y_kl1_polar_cap.append(0)
-                try:
-                    log_y_khc_45.append(math.log(
-                        self.df['calculated_Ehc_45'].iloc[i]))
-                except ValueError as er:
-                    log_y_kl1_polar_cap.append(0)
-
-                y_kd.append(self.df['calculated_Ed'].iloc[i])
-                y_ku.append(self.df['calculated_Eu'].iloc[i])
-                y_kl1.append(self.df['calculated_El1_no_polar_cap'].iloc[i])
-                y_kl2.append(self.df['calculated_El2_no_polar_cap'].iloc[i])
-                y_kl1_polar_cap.append(
-                    self.df['calculated_El1_polar_cap'].iloc[i])
-                y_kl2_polar_cap.append(
-                    self.df['calculated_El2_polar_cap'].iloc[i])
-                y_khc.append(self.df['calculated_Ehc'].iloc[i])
-                y_khc_45.append(self.df['calculated_Ehc_45'].iloc[i])
-
-            # Calculate Kd
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_kd[-2:])
-                self.df['calculated_Kd_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Kd_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_kd[2:])
-                if math.isnan(slope):
-                    self.df['calculated_Kd_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df['calculated_Kd_LR_all_points'].iloc[i] = slope*(-1)
-                self.df['r2value_Kd_LR_all_points'].iloc[i] = r_value * r_value
-
-                self.df['calculated_Kd_HL'].iloc[i] = (
-                    math.log(y_kd[-1] / y_kd[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Kd_LR'].iloc[i] = 0
-                self.df['r2value_Kd_LR'].iloc[i] = 0
-                self.df['calculated_Kd_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kd_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kd_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Kd_LR'].iloc[i] = 0
-                self.df['r2value_Kd_LR'].iloc[i] = 0
-                self.df['calculated_Kd_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kd_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kd_HL'].iloc[i] = 0
-
-            # Calculate Ku
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_ku[-2:])
-                self.df['calculated_Ku_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Ku_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_ku[2:])
-                if math.isnan(slope):
-                    self.df['calculated_Ku_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df['calculated_Ku_LR_all_points'].iloc[i] = slope*(-1)
-                self.df['r2value_Ku_LR_all_points'].iloc[i] = r_value*r_value
-
-                self.df['calculated_Ku_HL'].iloc[i] = (
-                    math.log(y_ku[-1] / y_ku[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Ku_LR'].iloc[i] = 0
-                self.df['r2value_Ku_LR'].iloc[i] = 0
-                self.df['calculated_Ku_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Ku_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Ku_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Ku_LR'].iloc[i] = 0
-                self.df['r2value_Ku_LR'].iloc[i] = 0
-                self.df['calculated_Ku_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Ku_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Ku_HL'].iloc[i] = 0
-
-            # Calculate Kl1
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_kl1[-2:])
-                self.df['calculated_Kl1_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Kl1_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_kl1[2:])
-                if math.isnan(slope):
-                    self.df['calculated_Kl1_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df[
-                        'calculated_Kl1_LR_all_points'].iloc[i] = slope*(-1)
-                self.df['r2value_Kl1_LR_all_points'].iloc[i] = r_value*r_value
-
-                self.df['calculated_Kl1_HL'].iloc[i] = (
-                    math.log(y_kl1[-1] / y_kl1[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Kl1_LR'].iloc[i] = 0
-                self.df['r2value_Kl1_LR'].iloc[i] = 0
-                self.df['calculated_Kl1_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl1_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl1_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Kl1_LR'].iloc[i] = 0
-                self.df['r2value_Kl1_LR'].iloc[i] = 0
-                self.df['calculated_Kl1_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl1_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl1_HL'].iloc[i] = 0
-
-            # Calculate Kl2
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_kl2[-2:])
-                self.df['calculated_Kl2_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Kl2_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_kl2[2:])
-                if math.isnan(slope):
-                    self.df['calculated_Kl2_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df[
-                        'calculated_Kl2_LR_all_points'].iloc[i] = slope*(-1)
-                self.df['r2value_Kl2_LR_all_points'].iloc[i] = r_value*r_value
-
-                self.df['calculated_Kl2_HL'].iloc[i] = (
-                    math.log(y_kl2[-1] / y_kl2[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Kl2_LR'].iloc[i] = 0
-                self.df['r2value_Kl2_LR'].iloc[i] = 0
-                self.df['calculated_Kl2_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl2_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl2_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Kl2_LR'].iloc[i] = 0
-                self.df['r2value_Kl2_LR'].iloc[i] = 0
-                self.df['calculated_Kl2_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl2_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl2_HL'].iloc[i] = 0
-
-            # Calculate Kl1_polar_cap
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_kl1_polar_cap[-2:])
-                self.df['calculated_Kl1_polar_cap_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Kl1_polar_cap_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_kl1_polar_cap[2:])
-                if math.isnan(slope):
-                    self.df[
-                        'calculated_Kl1_polar_cap_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df[
-                        'calculated_Kl1_polar_cap_LR_all_points'
-                        ].iloc[i] = slope*(-1)
-                self.df[
-                    'r2value_Kl1_polar_cap_LR_all_points'
-                    ].iloc[i] = r_value*r_value
-
-                self.df['calculated_Kl1_polar_cap_HL'].iloc[i] = (
-                    math.log(y_kl1_polar_cap[-1] / y_kl1_polar_cap[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Kl1_polar_cap_LR'].iloc[i] = 0
-                self.df['r2value_Kl1_polar_cap_LR'].iloc[i] = 0
-                self.df['calculated_Kl1_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl1_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl1_polar_cap_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Kl1_polar_cap_LR'].iloc[i] = 0
-                self.df['r2value_Kl1_polar_cap_LR'].iloc[i] = 0
-                self.df['calculated_Kl1_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl1_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl1_polar_cap_HL'].iloc[i] = 0
-
-            # Calculate Kl2_polar_cap
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_kl2_polar_cap[-2:])
-                self.df['calculated_Kl2_polar_cap_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Kl2_polar_cap_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_kl2_polar_cap[2:])
-                if math.isnan(slope):
-                    self.df[
-                        'calculated_Kl2_polar_cap_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df[
-                        'calculated_Kl2_polar_cap_LR_all_points'
-                        ].iloc[i] = slope*(-1)
-                self.df[
-                    'r2value_Kl2_polar_cap_LR_all_points'
-                    ].iloc[i] = r_value*r_value
-
-                self.df['calculated_Kl2_polar_cap_HL'].iloc[i] = (
-                    math.log(y_kl2_polar_cap[-1] / y_kl2_polar_cap[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Kl2_polar_cap_LR'].iloc[i] = 0
-                self.df['r2value_Kl2_polar_cap_LR'].iloc[i] = 0
-                self.df['calculated_Kl2_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl2_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl2_polar_cap_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Kl2_polar_cap_LR'].iloc[i] = 0
-                self.df['r2value_Kl2_polar_cap_LR'].iloc[i] = 0
-                self.df['calculated_Kl2_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Kl2_polar_cap_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Kl2_polar_cap_HL'].iloc[i] = 0
-
-            # Calculate Khc
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_khc[-2:])
-                self.df['calculated_Khc_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Khc_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_khc[2:])
-                if math.isnan(slope):
-                    self.df['calculated_Khc_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df[
-                        'calculated_Khc_LR_all_points'].iloc[i] = slope*(-1)
-                self.df['r2value_Khc_LR_all_points'].iloc[i] = r_value*r_value
-
-                self.df['calculated_Khc_HL'].iloc[i] = (
-                    math.log(y_khc[-1] / y_khc[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Khc_LR'].iloc[i] = 0
-                self.df['r2value_Khc_LR'].iloc[i] = 0
-                self.df['calculated_Khc_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Khc_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Khc_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Khc_LR'].iloc[i] = 0
-                self.df['r2value_Khc_LR'].iloc[i] = 0
-                self.df['calculated_Khc_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Khc_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Khc_HL'].iloc[i] = 0
-
-            # Calculate Khc_45
-            try:
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[-2:], log_y_khc_45[-2:])
-                self.df['calculated_Khc_45_LR'].iloc[i] = slope * (-1)
-                self.df['r2value_Khc_45_LR'].iloc[i] = r_value * r_value
-
-                slope, intercept, r_value, p_value, std_err = stats.linregress(
-                    x[2:], log_y_khc_45[2:])
-                if math.isnan(slope):
-                    self.df['calculated_Khc_45_LR_all_points'].iloc[i] = 0
-                else:
-                    self.df[
-                        'calculated_Khc_45_LR_all_points'].iloc[i] = slope*(-1)
-                self.df[
-                    'r2value_Khc_45_LR_all_points'].iloc[i] = r_value*r_value
-
-                self.df['calculated_Khc_45_HL'].iloc[i] = (
-                    math.log(y_khc_45[-1] / y_khc_45[-2]) / (
-                        x[-1] - x[-2])) * -1
-
-            except IndexError:
-                self.df['calculated_Khc_45_LR'].iloc[i] = 0
-                self.df['r2value_Khc_45_LR'].iloc[i] = 0
-                self.df['calculated_Khc_45_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Khc_45_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Khc_45_HL'].iloc[i] = 0
-
-            except ValueError:
-                self.df['calculated_Khc_45_LR'].iloc[i] = 0
-                self.df['r2value_Khc_45_LR'].iloc[i] = 0
-                self.df['calculated_Khc_45_LR_all_points'].iloc[i] = 0
-                self.df['r2value_Khc_45_LR_all_points'].iloc[i] = 0
-                self.df['calculated_Khc_45_HL'].iloc[i] = 0
+        if (df is not None) and (df is not self.df):
+            return LambdaIndex.from_dataframe(df)
 
-        # save as csv
-        fname = f"{self.file_name.split('.')[0]}_calculated_kfunctions.csv"
-        f = os.path.join(self.path_files_csv, fname)
-        self.df.to_csv(f)
+        if (self._lambda_index is None) or (
+                self._lambda_index[0] is not self.df) or (
+                self._lambda_index[1].rows != len(self.df)):
+            self._lambda_index = (
+                self.df, LambdaIndex.from_dataframe(self.df))
+        return self._lambda_index[1]
 
-    def calculate_kfunctions(self):
-        the_process = threading.Thread(
-            target=self._calculate_kfunctions)
-        start = time.time()
-        the_process.start()
-        while the_process.is_alive():
-            self.animated_loading(process_name="Calculate kfunctions")
-        end = time.time()
-        print("\nComplete. ")
-        print(f"Time calculating kfunctions: {(end - start)/60} minutes")
+    def select_lambda(self, lmbda, df=None):
+        """
+        Get the rows of a lambda of a dataframe
+
+        Parameters
+        ----------
+            lmbda: float
+                lambda value
+            df: pandas dataframe object
+                dataframe with lambda and depth columns
+                (Default=None, uses self.df)
+
+        Return
+        ------
+            df: pandas dataframe object
+                Rows of the lambda
+        """
+        if df is None:
+            df = self.df
+        return df.iloc[self.lambda_index(df).rows_of(lmbda)]
 
-    def create_dataframe_from_Lroot_calc_kfunctions(self):
+    def _iter_lambdas(self, df=None):
         """
-        Create dataframe from content file
+        Yield each lambda, sorted, and its rows of a dataframe
         """
-        # Create dataframe from content of .csv file
-        self.df = pd.read_csv(io.StringIO(self.content), header=0,
-                              skipinitialspace=True, index_col=0)
+        if df is None:
+            df = self.df
+        for lmbda, start, end in self.lambda_index(df).blocks():
+            yield lmbda, df.iloc[start:end]
 
-    def wavelength_to_rgb(self, wavelength, gamma=0.8):
-        ''' taken from http://www.noah.org/wiki/Wavelength_to_RGB_in_Python
-        This converts a given wavelength of light to an
-        approximate RGB color value. The wavelength must be given
-        in nanometers in the range from 380 nm through 750 nm
-        (789 THz through 400 THz).
+    def _config(self):
+        """
+        Get the configuration of compute_kfunctions() from the attributes
+        """
+        return _kfunctions_config(dict(
+            invalid_policy=self.invalid_policy,
+            clamp_value=self.clamp_value,
+            kernel=self.kernel))
 
-        Based on code by Dan Bruton
-        http://www.physics.sfasu.edu/astro/color/spectra.html
+    def _numeric(self, df):
+        """
+        Get a dataframe with float lambda and depth and numeric values in
+        all columns. See _numeric()
+        """
+        return _numeric(df)
+
+    def _coerce_dataframe(self):
+        """
+        Assign float to lambda and depth and numeric values to all columns
+        of dataframe
+        """
+        self.df = self._numeric(self.df)
+
+    def _kfunctions_arrays(self, df, index):
+        """
+        Calculate kfunctions of all irradiances of dataframe with the
+        configuration of the attributes. See _kfunctions_arrays()
+
+        Return
+        ------
+            kfunctions: dict
+                Name of each kfunction column and its values
+        """
+        return _kfunctions_arrays(df, index, self._config(),
+                                  stage=self._stage)
+
+    def _add_kfunctions(self, df, index):
+        """
+        Calculate kfunctions of all irradiances and add them as columns of
+        dataframe
+
+        Parameters
+        ----------
+            df: pandas dataframe object
+                dataframe with depth and irradiances, sorted by depth inside
+                each block
+            index: LambdaIndex object
+                Lambda blocks of the rows of dataframe
+
+        Return
+        ------
+            df: pandas dataframe object
+                dataframe with kfunctions columns
+        """
+        for column, values in self._kfunctions_arrays(df, index).items():
+            df[column] = values
+
+        return df
+
+    def iter_kfunctions(self, file_name=None, path_file=None,
+                        chunksize=100000):
+        """
+        Read the file by chunks and yield the kfunctions of each lambda as
+        soon as all its rows are read. Memory is proportional to one lambda
+        (and one chunk)
+
+        Parameters
+        ----------
+            file_name: str
+                Name of the file (Default=None, uses self.file_name)
+            path_file: str
+                Path of the file (Default=None, uses self.path_files_raw)
+            chunksize: int
+                Number of rows read at once (Default=100000)
+
+        Yield
+        -----
+            lmbd: float
+                lambda value
+            depth: numpy array
+                Depth values of the lambda
+            kfunctions: dict
+                Name of each kfunction column, as 'calculated_Kd_HL', and its
+                values
+        """
+        f = self._file_path(file_name=file_name, path_file=path_file)
+        for partition in self._iter_partitions(f, chunksize):
+            for block in self._iter_blocks(self._numeric(partition)):
+                yield block
+
+    def _iter_partitions(self, f, chunksize):
+        """
+        Read a file of irradiances by chunks and yield dataframes with all
+        the rows of complete lambdas
+
+        Parameters
+        ----------
+            f: str
+                Path of the file
+            chunksize: int
+                Number of rows read at once
+
+        Yield
+        -----
+            partition: pandas dataframe object
+                dataframe with the values of one or more lambdas, as read
+                from the file
+        """
+        pending = None
+        with _open_compressed(f, 'rt', _compression(f)) as file:
+            reader = pd.read_csv(file, header=0, skipinitialspace=True,
+                                 index_col=0, chunksize=chunksize)
+
+            for chunk in reader:
+                if pending is not None:
+                    chunk = pd.concat([pending, chunk])
+
+                # rows of the last lambda can continue in the next chunk.
+                # Values are not numeric yet: they are compared, not sorted
+                lmbd = chunk['lambda'].to_numpy()
+                changes = np.flatnonzero(lmbd[1:] != lmbd[:-1])
+                last = changes[-1] + 1 if len(changes) else 0
+                if last > 0:
+                    yield chunk.iloc[:last]
+                pending = chunk.iloc[last:]
+
+        if (pending is not None) and (len(pending) > 0):
+            yield pending
+
+    def _count_rows(self, f):
+        """
+        Count the rows of a csv file, without the header, without parsing it
+        """
+        rows = 0
+        last = b'\n'
+        with _open_compressed(f, 'rb', _compression(f)) as file:
+            for block in iter(functools.partial(file.read, 2**20), b''):
+                rows += block.count(b'\n')
+                last = block[-1:]
+        if last != b'\n':
+            rows += 1
+        return rows - 1
+
+    def _calculate_kfunctions_out_of_core(self, f):
+        """
+        Calculate kfunctions of a file by partitions of lambdas that fit in
+        self.memory_budget. Irradiances and kfunctions of each partition
+        are written to a columnar folder on disk, so the whole file is never
+        in memory. A lambda is never split, even if it does not fit in the
+        budget
+
+        Parameters
+        ----------
+            f: str
+                Path of the file
+        """
+        if self.compression is not None:
+            raise ValueError(
+                "kfunctions out of core are saved in a columnar folder "
+                "without compression, set compression to None")
+
+        # memory of a row: input columns as text and numbers, kfunctions
+        # columns and the temporary arrays of the kernel
+        with _open_compressed(f, 'rt', _compression(f)) as file:
+            n_columns = len(file.readline().split(','))
+        n_kfunctions = len(KFUNCTIONS_COLUMNS) * len(KFUNCTIONS_IRRADIANCES)
+        row_bytes = 8 * (5 * n_columns + 2 * n_kfunctions + 32)
+        chunksize = max(1, int(self.memory_budget // row_bytes))
+
+        n_rows = self._count_rows(f)
+        print(f" - Calculate in partitions of {chunksize} rows")
+
+        fname = f"{_file_stem(self.file_name)}_calculated_kfunctions"
+        out = self._output_file(
+            self.path_files_csv, f"{fname}{COLUMNAR_SUFFIX}")
+        with self._atomic_write(out) as tmp:
+            os.makedirs(tmp)
+
+            columns = None
+            arrays = []
+            row = 0
+            lambdas = set()
+            for partition in self._iter_partitions(f, chunksize):
+                # values as read from the file: not numeric lambda or depth
+                # are errors
+                with self._stage("validate"):
+                    self.check_irradiances(partition, first_row=row)
+                partition = self._numeric(partition)
+
+                # a lambda of a previous partition is split in the file
+                split = lambdas.intersection(partition['lambda'].unique())
+                if split:
+                    raise ValueError(
+                        f"Irradiances are not valid: Rows of a lambda are "
+                        f"not together (lambdas {sorted(split)[:10]} in "
+                        f"rows before {row} and after it)")
+                lambdas.update(partition['lambda'].unique())
+
+                kfunctions = self._kfunctions_arrays(
+                    partition, self.lambda_index(partition))
+
+                if columns is None:
+                    columns = list(partition.columns) + list(kfunctions)
+                    arrays = [
+                        np.lib.format.open_memmap(
+                            os.path.join(tmp, f"{n}.npy"), mode='w+',
+                            dtype=float, shape=(n_rows,))
+                        for n in range(len(columns))]
+
+                end = row + len(partition)
+                if end > n_rows:
+                    raise ValueError(f"File {f} has more rows than lines")
+                with self._stage("write"):
+                    values = [partition[column].to_numpy()
+                              for column in partition.columns]
+                    values += list(kfunctions.values())
+                    for array, value in zip(arrays, values):
+                        array[row:end] = value
+                        array.flush()
+                row = end
+
+            del arrays
+            with open(os.path.join(tmp, "columns.json"), 'w') as file:
+                json.dump({'columns': columns, 'rows': row,
+                           'compression': None}, file)
+
+    def _iter_blocks(self, df):
+        """
+        Yield the kfunctions of each lambda of a dataframe
+        """
+        if len(df) == 0:
+            return
+
+        # stages are not recorded: a stream is not a profiled run, and its
+        # stages would be kept for every lambda
+        config = self._config()
+        index = self.lambda_index(df)
+        for start, end in zip(index.starts, index.ends):
+            block = df.iloc[start:end]
+            kfunctions = _kfunctions_arrays(
+                block, LambdaIndex(np.zeros(end - start)), config)
+            yield (block['lambda'].iloc[0],
+                   block['depth'].to_numpy(dtype=float), kfunctions)
+
+    def _resample_lambdas(self, lambdas):
+        """
+        Interpolate all irradiances of dataframe in log space onto the
+        target lambdas with the configuration of the attributes. See
+        _resample_lambdas()
+        """
+        self.df = _resample_lambdas(self.df, lambdas, self._config())
+
+    def _resample_depths(self, depths):
+        """
+        Interpolate all irradiances of dataframe in log space onto the
+        target depths with the configuration of the attributes. See
+        _resample_depths()
+        """
+        self.df = _resample_depths(self.df, depths, self._config())
+
+    def _compute_kfunctions(self):
+        """
+        Calculate kfunctions Kd, Ku and Kl and add them to dataframe,
+        without saving results
+        """
+        self._coerce_dataframe()
+
+        self.df = self._add_kfunctions(self.df, self.lambda_index())
+
+    def _calculate_kfunctions(self):
+        """
+        Calculate kfunctions Kd, Ku and Kl
+
+        Return
+        ------
+            df_final: pandas dataframe object
+                dataframe with Kd values
+        """
+        print(f" - Calculate in {self.df['lambda'].nunique()} lambdas")
+
+        self._compute_kfunctions()
+
+        # save as csv
+        fname = f"{_file_stem(self.file_name)}_calculated_kfunctions"
+        self._save_dataframe(self.df, fname)
+
+    def _save_dataframe(self, df, fname):
+        """
+        Save dataframe in path_files_csv with the output format and the
+        compression
+
+        Parameters
+        ----------
+            df: pandas dataframe object
+                dataframe to save
+            fname: str
+                Name of the file without extension
+        """
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError(
+                f"output_format must be one of {OUTPUT_FORMATS}, "
+                f"not '{self.output_format}'")
+
+        if (self.compression is not None) and (
+                self.compression not in COMPRESSIONS):
+            raise ValueError(
+                f"compression must be one of {tuple(COMPRESSIONS)} or None, "
+                f"not '{self.compression}'")
+
+        with self._stage("write"):
+            if self.output_format == 'columnar':
+                f = self._output_file(
+                    self.path_files_csv, f"{fname}{COLUMNAR_SUFFIX}")
+                with self._atomic_write(f) as tmp:
+                    write_columnar(df, tmp, compression=self.compression)
+            else:
+                extension = COMPRESSIONS.get(self.compression, "")
+                f = self._output_file(
+                    self.path_files_csv, f"{fname}.csv{extension}")
+                with self._atomic_write(f) as tmp:
+                    with _open_compressed(
+                            tmp, 'wt', self.compression) as file:
+                        df.to_csv(file)
+
+    def calculate_kfunctions(self):
+        start = time.time()
+        self._run_loading(self._calculate_kfunctions,
+                          process_name="Calculate kfunctions")
+        end = time.time()
+        print("\nComplete. ")
+        print(f"Time calculating kfunctions: {(end - start)/60} minutes")
+
+    def _irradiance_cube(self, df, columns):
+        """
+        Arrange irradiances of dataframe as a (lambda, depth) cube. See
+        _irradiance_cube()
+        """
+        return _irradiance_cube(df, columns)
+
+    def _band_weights(self, lambdas, bands, response_functions=None,
+                      quanta=False):
+        """
+        Calculate the weights to integrate irradiances over each band with
+        the trapezoidal rule
+
+        Parameters
+        ----------
+            lambdas: numpy array
+                Sorted lambda values
+            bands: dict
+                Name of the band and (min_lambda, max_lambda)
+            response_functions: dict
+                Name of the band and (lambdas, response) of the sensor
+                spectral response function (Default=None)
+            quanta: Boolean
+                Integrate in umol photons instead of W (Default=False)
+
+        Return
+        ------
+            names: list
+                Name of each band
+            limits: list
+                (min_lambda, max_lambda) of each band
+            weights: numpy array
+                Weights with shape (band, lambda)
+        """
+        if response_functions is None:
+            response_functions = {}
+
+        limits = []
+        weights = np.zeros((len(bands) + len(response_functions),
+                            len(lambdas)))
+        names = list(bands) + list(response_functions)
+        for n, name in enumerate(names):
+            if name in bands:
+                min_lambda, max_lambda = bands[name]
+                response = np.ones(len(lambdas))
+            else:
+                srf_lambdas, srf = (np.asarray(values, dtype=float)
+                                    for values in response_functions[name])
+                min_lambda, max_lambda = srf_lambdas.min(), srf_lambdas.max()
+                response = np.interp(lambdas, srf_lambdas, srf)
+
+            inside, = np.where((lambdas >= min_lambda) &
+                               (lambdas <= max_lambda))
+            if len(inside) == 0:
+                raise ValueError(
+                    f"Band {name} ({min_lambda}-{max_lambda} nm) has no "
+                    "lambdas in the file")
+
+            # with a single lambda the band irradiance is the irradiance
+            # in that lambda
+            if len(inside) == 1:
+                weights[n, inside] = 1.0
+            else:
+                step = np.diff(lambdas[inside])
+                weights[n, inside[:-1]] += step / 2
+                weights[n, inside[1:]] += step / 2
+            weights[n] *= response
+            limits.append((min_lambda, max_lambda))
+
+        if quanta is True:
+            weights *= lambdas * WATT_TO_UMOL_PHOTONS
+
+        return names, limits, weights
+
+    def _calculate_band_kfunctions(self, bands=None, response_functions=None,
+                                   quanta=False):
+        """
+        Integrate irradiances over each band and calculate kfunctions of the
+        integrated irradiances
+
+        Parameters
+        ----------
+            bands: dict
+                Name of the band and (min_lambda, max_lambda)
+                (Default=None, PAR band)
+            response_functions: dict
+                Name of the band and (lambdas, response) of the sensor
+                spectral response function (Default=None)
+            quanta: Boolean
+                Integrate in umol photons instead of W (Default=False)
+        """
+        if bands is None:
+            bands = BANDS
+
+        self._coerce_dataframe()
+
+        columns = list(KFUNCTIONS_IRRADIANCES.values())
+        lambdas, depths, cube = self._irradiance_cube(self.df, columns)
+        names, limits, weights = self._band_weights(
+            lambdas, bands, response_functions, quanta)
+
+        # integrate all irradiances of all bands in a single pass
+        band_cube = np.einsum('bl,cld->cbd', weights, cube)
+
+        n_band = len(names)
+        self.df_bands = pd.DataFrame({
+            'band': np.repeat(names, len(depths)),
+            'min_lambda': np.repeat([lim[0] for lim in limits], len(depths)),
+            'max_lambda': np.repeat([lim[1] for lim in limits], len(depths)),
+            'depth': np.tile(depths, n_band),
+        })
+        for n, column in enumerate(columns):
+            self.df_bands[column] = band_cube[n].ravel()
+
+        index = LambdaIndex(np.repeat(np.arange(n_band), len(depths)))
+        self.df_bands = self._add_kfunctions(self.df_bands, index)
+
+        # save as csv
+        fname = f"{_file_stem(self.file_name)}_band_kfunctions"
+        self._save_dataframe(self.df_bands, fname)
+
+    def create_dataframe_from_Lroot_calc_kfunctions(self, columns=None):
+        """
+        Create dataframe from content file, or from the file or columnar
+        folder of open_file(lazy=True)
+
+        Parameters
+        ----------
+            columns: list
+                Columns to read, the columns that are not in the file are
+                skipped (Default=None, all columns)
+        """
+        def usecols(column):
+            # first column is the index, without name
+            return (column in columns) or column.startswith('Unnamed: ')
+
+        if self.content is None and self.file_path is not None:
+            if os.path.isdir(self.file_path):
+                if columns is not None:
+                    names = read_columnar_names(self.file_path)
+                    columns = [column for column in names
+                               if column in columns]
+                self.df = read_columnar(self.file_path, columns)
+                return
+
+            # stream the file, only the columns are parsed and kept
+            with _open_compressed(self.file_path, 'rt',
+                                  _compression(self.file_path)) as file:
+                self.df = pd.read_csv(
+                    file, header=0, skipinitialspace=True, index_col=0,
+                    usecols=None if columns is None else usecols)
+            return
+
+        # Create dataframe from content of .csv file
+        self.df = pd.read_csv(io.StringIO(self.content), header=0,
+                              skipinitialspace=True, index_col=0,
+                              usecols=None if columns is None else usecols)
+
+    def wavelength_to_rgb(self, wavelength, gamma=0.8):
+        ''' taken from http://www.noah.org/wiki/Wavelength_to_RGB_in_Python
+        This converts a given wavelength of light to an
+        approximate RGB color value. The wavelength must be given
+        in nanometers in the range from 380 nm through 750 nm
+        (789 THz through 400 THz).
+
+        Based on code by Dan Bruton
+        http://www.physics.sfasu.edu/astro/color/spectra.html
         Additionally alpha value set to 0.5 outside range
         '''
         wavelength = float(wavelength)
@@ -726,6 +2310,41 @@ class ProcessIrradFile:
             B = 0.0
         return (R, G, B, A)
 
+    def _profile(self, df, column, points=0):
+        """
+        Values of a column and depths of one lambda to plot, at the surface
+        and below, from the depth where the column is calculated. Curves
+        are downsampled to self.downsample_points with the method
+        self.downsample, if it is not None
+
+        Parameters
+        ----------
+            df: pandas dataframe object
+                dataframe of one lambda
+            column: str
+                Name of the column
+            points: int
+                Number of depths below the surface (depth > 0) needed to
+                calculate the column: 1 for LR and HL, 2 for LR all points
+                (Default=0, irradiances)
+
+        Return
+        ------
+            values, depth: pandas series objects
+                Values of the column and depths to plot
+        """
+        depth = df['depth']
+        selected = (depth >= 0) & ((depth > 0).cumsum() >= points)
+        values = df[column][selected]
+        depth = depth[selected]
+        if self.downsample is None:
+            return values, depth
+
+        selected = _downsample_indices(
+            depth.to_numpy(dtype=float), values.to_numpy(dtype=float),
+            self.downsample_points, self.downsample)
+        return values.iloc[selected], depth.iloc[selected]
+
     def plot_irradiances_matplotlib(self, is_shown=False):
         """
         Plot calculated Irradiances from .csv file in Matplotlib
@@ -743,7 +2362,7 @@ class ProcessIrradFile:
         fig.subplots_adjust(right=0.8)
         fig.suptitle("Calculated Irradiances", fontsize=12)
 
-        for i, df in self.df.groupby(['lambda']):
+        for i, df in self._iter_lambdas():
 
             lmbda = f'lambda: {i}'
             color = self.wavelength_to_rgb(wavelength=i)
@@ -753,7 +2372,7 @@ class ProcessIrradFile:
             ax1.set_ylabel('depth (m)', fontsize=8)
             ax1.grid(True, alpha=0.3)
             ax1.plot(
-                df['calculated_Ed'].iloc[1:], df['depth'].iloc[1:],
+                *self._profile(df, 'calculated_Ed'),
                 label=lmbda, color=color)[0]
             ax1.set_title('calculated_Ed', size=10)
 
@@ -762,7 +2381,7 @@ class ProcessIrradFile:
             ax2.set_ylabel('depth (m)', fontsize=8)
             ax2.grid(True, alpha=0.3)
             ax2.plot(
-                df['calculated_Eu'].iloc[1:], df['depth'].iloc[1:],
+                *self._profile(df, 'calculated_Eu'),
                 label=lmbda, color=color)[0]
             ax2.set_title('calculated_Eu', size=10)
 
@@ -771,7 +2390,7 @@ class ProcessIrradFile:
             ax3.set_ylabel('depth (m)', fontsize=8)
             ax3.grid(True, alpha=0.3)
             ax3.plot(
-                df['calculated_El1'].iloc[1:], df['depth'].iloc[1:],
+                *self._profile(df, 'calculated_El1'),
                 label=lmbda, color=color)[0]
             ax3.set_title('calculated_El1', size=10)
 
@@ -780,7 +2399,7 @@ class ProcessIrradFile:
             ax4.set_ylabel('depth (m)', fontsize=8)
             ax4.grid(True, alpha=0.3)
             ax4.plot(
-                df['calculated_El2'].iloc[1:], df['depth'].iloc[1:],
+                *self._profile(df, 'calculated_El2'),
                 label=lmbda, color=color)[0]
             ax4.set_title('calculated_El2', size=10)
 
@@ -796,21 +2415,484 @@ class ProcessIrradFile:
             fontsize=8
             )
 
-        fig.tight_layout(rect=[0, 0.03, 0.80, 0.95])
-
-        if not os.path.exists("images/matplotlib"):
-            os.mkdir("images/matplotlib")
+        fig.tight_layout(rect=[0, 0.03, 0.80, 0.95])
+
+        fname = f"{_file_stem(self.file_name_csv)}_calculated_irradiances"
+        self._save_figure(
+            fig, self.path_images_matplotlib, fname, self.image_formats)
+
+        if is_shown is True:
+            plt.show()
+        plt.close(fig)
+
+    def _plot_irradiances_plotly_template(self):
+        """
+        Empty figure with the subplots and layout of plot_irradiances_plotly
+        """
+        fig = make_subplots(
+            rows=4, cols=2,
+            column_widths=[0.5, 0.5],
+            row_heights=[0.25, 0.25, 0.25, 0.25],
+            subplot_titles=("calculated_Ed",
+                            "calculated_Eu",
+                            "calculated_El1_no_polar_cap",
+                            "calculated_El2_no_polar_cap",
+                            "calculated_El1_polar_cap",
+                            "calculated_El2_polar_cap",
+                            "calculated_Ehc",
+                            "calculated_Ehc_45",
+                            ))
+
+        # Update xaxis properties
+        fig.update_xaxes(
+            title_text="Irradiance Ed (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=1, col=1)
+        fig.update_xaxes(
+            title_text="Irradiance Eu (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=1, col=2)
+        fig.update_xaxes(
+            title_text="Irradiance El1 polar cap (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=2, col=1)
+        fig.update_xaxes(
+            title_text="Irradiance El2 polar cap (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=2, col=2)
+        fig.update_xaxes(
+            title_text="Irradiance El1 no polar cap (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=3, col=1)
+        fig.update_xaxes(
+            title_text="Irradiance El2 no polar cap (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=3, col=2)
+        fig.update_xaxes(
+            title_text="Irradiance Ehc (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=4, col=1)
+        fig.update_xaxes(
+            title_text="Irradiance Ehc 45 (W/m^2 nm)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=4, col=2)
+
+        # Update yaxis properties
+        fig.update_yaxes(
+            title_text='depth (m)',
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            autorange='reversed')
+
+        # Update title and height
+        fig.update_layout(
+            title_text="<b>Calculated Irradiances</b>",
+            title_font=dict(size=16),
+            title=dict(
+                y=0.97,
+                x=0.5,
+                xanchor='center',
+                yanchor="top"),
+            legend_title='<b> wavelength </b>',
+            legend=dict(
+                traceorder="normal",
+                y=1,
+                x=1.1,
+                yanchor="top",
+                font=dict(
+                    family="sans-serif",
+                    size=9,
+                    color="black"
+                ),
+            )
+        )
+
+        fig.update_layout(height=1920, width=1600)
+
+        for i in fig['layout']['annotations']:
+            i['font'] = dict(size=12, color='#000000')
+
+        """ fig.update_layout(
+            updatemenus=[
+                dict(
+                    type="buttons",
+                    direction="right",
+                    active=0,
+                    x=0.57,
+                    y=1.2,
+                    buttons=list([
+                        dict(label="1m depth",
+                        method="update",
+                        args=[{"visible": [True, False, True, False]},
+                                {"title": "Yahoo",
+                                    "annotations": []}]),
+                        dict(label="2m depth",
+                            method="update",
+                            args=[{"visible": [True, True, False, False]},
+                                {"title": "Yahoo High",
+                                    "annotations": 10}]),
+                        dict(label="5m depth",
+                            method="update",
+                            args=[{"visible": [False, False, True, True]},
+                                {"title": "Yahoo Low",
+                                    "annotations": 20}]),
+                        dict(label="all depth",
+                            method="update",
+                            args=[{"visible": [True, True, True, True]},
+                                {"title": "Yahoo",
+                                    "annotations": 30}]),
+                    ]),
+                )
+            ]) """
+
+        return fig
+
+    def plot_irradiances_plotly(self, is_shown=False):
+        """
+        calculated Irradiances from .csv file in Plotly
+
+        Parameters
+        ----------
+            is_shown: Boolean
+                Flag to show the plot. By default, False.
+
+        """
+        # plot of calculated_Ed for each lambda in function of depth in plotly
+        # copy of the empty figure with the subplots and layout
+        fig = self._plotly_figure('plot_irradiances')
+
+        for i, df in self._iter_lambdas():
+            lmbda = f'lambda: {i}'
+            color = "rgba" + str(self.wavelength_to_rgb(wavelength=i))
+
+            # Add scatter plot of irradiances
+            values, depth = self._profile(df, 'calculated_Ed')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    marker=dict(color=color),
+                    text=values),
+                row=1, col=1
+                )
+
+            values, depth = self._profile(df, 'calculated_Eu')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=1, col=2
+                )
+
+            values, depth = self._profile(df, 'calculated_El1_no_polar_cap')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=2, col=1
+                )
+
+            values, depth = self._profile(df, 'calculated_El2_no_polar_cap')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=2, col=2
+                )
+
+            values, depth = self._profile(df, 'calculated_El1_polar_cap')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=3, col=1
+                )
+
+            values, depth = self._profile(df, 'calculated_El2_polar_cap')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=3, col=2
+                )
+
+            values, depth = self._profile(df, 'calculated_Ehc')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=4, col=1
+                )
+
+            values, depth = self._profile(df, 'calculated_Ehc_45')
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=4, col=2
+                )
+
+        if is_shown is True:
+            fig.show(config={'showLink': True})
+
+        fname = f"{_file_stem(self.file_name_csv)}_calculated_irradiances"
+        self._save_figure(fig, self.path_images_plotly, fname,
+                          tuple(self.image_formats) + ('html',))
+
+    def plot_kfunctionsLR_matplotlib(self, is_shown=False):
+        """
+        Plot kfunctions calculated as Linear Regression
+        from .csv file in Matplotlib
+
+        Parameters
+        ----------
+            is_shown: Boolean
+                Flag to show the plot. By default, False.
+
+        """
+        mplstyle.use(['ggplot'])
+
+        # plot of calculated_Ed for each lambda in function of depth
+        # in matplotlib
+        fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(nrows=2, ncols=2)
+        fig.subplots_adjust(right=0.8)
+        fig.suptitle("Calculated kfunctions LR", fontsize=12)
+
+        for i, df in self._iter_lambdas():
+
+            lmbda = f'lambda: {i}'
+            color = self.wavelength_to_rgb(wavelength=i)
+
+            ax1.invert_yaxis()
+            ax1.set_xlabel('calculated kfunction Kd (1/meter)', fontsize=8)
+            ax1.set_ylabel('depth (m)', fontsize=8)
+            ax1.grid(True, alpha=0.3)
+            ax1.plot(
+                *self._profile(df, 'calculated_Kd_LR', 1),
+                label=lmbda, color=color)[0]
+            ax1.set_title('calculated_Kd_LR', size=10)
+
+            ax2.invert_yaxis()
+            ax2.set_xlabel('calculated kfunction Ku (1/meter)', fontsize=8)
+            ax2.set_ylabel('depth (m)', fontsize=8)
+            ax2.grid(True, alpha=0.3)
+            ax2.plot(
+                *self._profile(df, 'calculated_Ku_LR', 1),
+                label=lmbda, color=color)[0]
+            ax2.set_title('calculated_Ku_LR', size=10)
+
+            ax3.invert_yaxis()
+            ax3.set_xlabel('calculated kfunction Kl1 (1/meter)', fontsize=8)
+            ax3.set_ylabel('depth (m)', fontsize=8)
+            ax3.grid(True, alpha=0.3)
+            ax3.plot(
+                *self._profile(df, 'calculated_Kl1_LR', 1),
+                label=lmbda, color=color)[0]
+            ax3.set_title('calculated_Kl1_LR', size=10)
+
+            ax4.invert_yaxis()
+            ax4.set_xlabel('calculated kfunction Kl2 (1/meter)', fontsize=8)
+            ax4.set_ylabel('depth (m)', fontsize=8)
+            ax4.grid(True, alpha=0.3)
+            ax4.plot(
+                *self._profile(df, 'calculated_Kl2_LR', 1),
+                label=lmbda, color=color)[0]
+            ax4.set_title('calculated_Kl2_LR', size=10)
+
+        handles, labels = ax2.get_legend_handles_labels()
+
+        # Create the legend
+        fig.legend(
+            handles, labels,
+            bbox_to_anchor=(1.0, 0.5),
+            loc='center right',
+            title="wavelength",
+            borderaxespad=0.5,
+            fontsize=8
+            )
+
+        fig.tight_layout(rect=[0, 0.03, 0.80, 0.95])
+
+        fname = f"{_file_stem(self.file_name_csv)}_calculated_kfunctions_LR"
+        self._save_figure(
+            fig, self.path_images_matplotlib, fname, self.image_formats)
+
+        if is_shown is True:
+            plt.show()
+        plt.close(fig)
+
+    def _plot_kfunctionsLR_plotly_template(self):
+        """
+        Empty figure with the subplots and layout of plot_kfunctionsLR_plotly
+        """
+        fig = make_subplots(
+            rows=4, cols=2,
+            column_widths=[0.5, 0.5],
+            row_heights=[0.25, 0.25, 0.25, 0.25],
+            subplot_titles=(
+                "calculated_Kd_LR",
+                "calculated_Ku_LR",
+                "calculated_Kl1_no_polar_cap_LR",
+                "calculated_Kl2_no_polar_cap_LR",
+                "calculated_Kl1_polar_cap_LR",
+                "calculated_Kl2_polar_cap_LR",
+                "calculated_Khc_LR",
+                "calculated_Khc_45_LR"))
+
+        # Update xaxis properties
+        fig.update_xaxes(
+            title_text="calculated kfunction Kd (1/meter)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=1, col=1)
+        fig.update_xaxes(
+            title_text="calculated kfunction Ku (1/meter)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=1, col=2)
+        fig.update_xaxes(
+            title_text="calculated kfunction Kl1 (1/meter)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=2, col=1)
+        fig.update_xaxes(
+            title_text="calculated kfunction Kl2 (1/meter)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=2, col=2)
+        fig.update_xaxes(
+            title_text="calculated kfunction Kl1 polar cap (1/meter))",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=3, col=1)
+        fig.update_xaxes(
+            title_text="calculated kfunction Kl2 polar cap (1/meter)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=3, col=2)
+        fig.update_xaxes(
+            title_text="calculated kfunction Khc (1/meter)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=4, col=1)
+        fig.update_xaxes(
+            title_text="calculated kfunction Khc 45 (1/meter)",
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            row=4, col=2)
+
+        # Update yaxis properties
+        fig.update_yaxes(
+            title_text='depth (m)',
+            title_font=dict(size=12),
+            ticklen=5,
+            zeroline=False,
+            autorange='reversed')
+
+        # Update title and height
+        fig.update_layout(
+            title_text="<b>Calculated kfunctions LR</b>",
+            title_font=dict(size=16),
+            title=dict(
+                y=0.97,
+                x=0.5,
+                xanchor='center',
+                yanchor="top"),
+            legend_title='<b> Wavelength </b>',
+            legend=dict(
+                traceorder="normal",
+                y=1,
+                x=1.1,
+                yanchor="top",
+                font=dict(
+                    family="sans-serif",
+                    size=9,
+                    color="black"
+                ),
+            )
+        )
+
+        fig.update_layout(height=1920, width=1600)
 
-        plt.savefig(
-            fname="images/matplotlib/calculated_irradiances.svg",
-            )
+        for i in fig['layout']['annotations']:
+            i['font'] = dict(size=12, color='#000000')
 
-        if is_shown is True:
-            plt.show()
+        return fig
 
-    def plot_irradiances_plotly(self, is_shown=False):
+    def plot_kfunctionsLR_plotly(self, is_shown=False):
         """
-        calculated Irradiances from .csv file in Plotly
+        Plot kfunctions calculated as Linear Regression
+        from .csv file in Plotly
 
         Parameters
         ----------
@@ -818,263 +2900,138 @@ class ProcessIrradFile:
                 Flag to show the plot. By default, False.
 
         """
-        # plot of calculated_Ed for each lambda in function of depth in plotly
+        # plot of calculated_Kfunctions for each lambda in function of depth
+        # in plotly
         # Initialize figure with subplots
-        fig = make_subplots(
-            rows=4, cols=2,
-            column_widths=[0.5, 0.5],
-            row_heights=[0.25, 0.25, 0.25, 0.25],
-            subplot_titles=("calculated_Ed",
-                            "calculated_Eu",
-                            "calculated_El1_no_polar_cap",
-                            "calculated_El2_no_polar_cap",
-                            "calculated_El1_polar_cap",
-                            "calculated_El2_polar_cap",
-                            "calculated_Ehc",
-                            "calculated_Ehc_45",
-                            ))
 
-        for i, df in self.df.groupby(['lambda']):
+        # copy of the empty figure with the subplots and layout
+        fig = self._plotly_figure('plot_kfunctionsLR')
+
+        for i, df in self._iter_lambdas():
             lmbda = f'lambda: {i}'
             color = "rgba" + str(self.wavelength_to_rgb(wavelength=i))
 
             # Add scatter plot of irradiances
+            values, depth = self._profile(df, 'calculated_Kd_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Ed'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     marker=dict(color=color),
-                    text=df['calculated_Ed'].iloc[1:]),
+                    text=values),
                 row=1, col=1
                 )
 
+            values, depth = self._profile(df, 'calculated_Ku_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Eu'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_Eu'].iloc[1:]),
+                    text=values),
                 row=1, col=2
                 )
 
+            values, depth = self._profile(df, 'calculated_Kl1_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_El1_no_polar_cap'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_El1_no_polar_cap'].iloc[1:]),
+                    text=values),
                 row=2, col=1
                 )
 
+            values, depth = self._profile(df, 'calculated_Kl2_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_El2_no_polar_cap'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_El2_no_polar_cap'].iloc[1:]),
+                    text=values),
                 row=2, col=2
                 )
 
+            values, depth = self._profile(df, 'calculated_Kl1_polar_cap_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_El1_polar_cap'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_El1_polar_cap'].iloc[1:]),
+                    text=values),
                 row=3, col=1
                 )
 
+            values, depth = self._profile(df, 'calculated_Kl2_polar_cap_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_El2_polar_cap'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_El2_polar_cap'].iloc[1:]),
+                    text=values),
                 row=3, col=2
                 )
 
+            values, depth = self._profile(df, 'calculated_Khc_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Ehc'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_Ehc'].iloc[1:]),
+                    text=values),
                 row=4, col=1
                 )
 
+            values, depth = self._profile(df, 'calculated_Khc_45_LR', 1)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Ehc_45'].iloc[1:],
-                    y=df['depth'].iloc[1:],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_Ehc_45'].iloc[1:]),
+                    text=values),
                 row=4, col=2
                 )
 
-        # Update xaxis properties
-        fig.update_xaxes(
-            title_text="Irradiance Ed (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=1, col=1)
-        fig.update_xaxes(
-            title_text="Irradiance Eu (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=1, col=2)
-        fig.update_xaxes(
-            title_text="Irradiance El1 polar cap (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=2, col=1)
-        fig.update_xaxes(
-            title_text="Irradiance El2 polar cap (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=2, col=2)
-        fig.update_xaxes(
-            title_text="Irradiance El1 no polar cap (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=3, col=1)
-        fig.update_xaxes(
-            title_text="Irradiance El2 no polar cap (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=3, col=2)
-        fig.update_xaxes(
-            title_text="Irradiance Ehc (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=4, col=1)
-        fig.update_xaxes(
-            title_text="Irradiance Ehc 45 (W/m^2 nm)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            row=4, col=2)
-
-        # Update yaxis properties
-        fig.update_yaxes(
-            title_text='depth (m)',
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            autorange='reversed')
-
-        # Update title and height
-        fig.update_layout(
-            title_text="<b>Calculated Irradiances</b>",
-            title_font=dict(size=16),
-            title=dict(
-                y=0.97,
-                x=0.5,
-                xanchor='center',
-                yanchor="top"),
-            legend_title='<b> wavelength </b>',
-            legend=dict(
-                traceorder="normal",
-                y=1,
-                x=1.1,
-                yanchor="top",
-                font=dict(
-                    family="sans-serif",
-                    size=9,
-                    color="black"
-                ),
-            )
-        )
-
-        fig.update_layout(height=1920, width=1600)
-
-        for i in fig['layout']['annotations']:
-            i['font'] = dict(size=12, color='#000000')
-
-        """ fig.update_layout(
-            updatemenus=[
-                dict(
-                    type="buttons",
-                    direction="right",
-                    active=0,
-                    x=0.57,
-                    y=1.2,
-                    buttons=list([
-                        dict(label="1m depth",
-                        method="update",
-                        args=[{"visible": [True, False, True, False]},
-                                {"title": "Yahoo",
-                                    "annotations": []}]),
-                        dict(label="2m depth",
-                            method="update",
-                            args=[{"visible": [True, True, False, False]},
-                                {"title": "Yahoo High",
-                                    "annotations": 10}]),
-                        dict(label="5m depth",
-                            method="update",
-                            args=[{"visible": [False, False, True, True]},
-                                {"title": "Yahoo Low",
-                                    "annotations": 20}]),
-                        dict(label="all depth",
-                            method="update",
-                            args=[{"visible": [True, True, True, True]},
-                                {"title": "Yahoo",
-                                    "annotations": 30}]),
-                    ]),
-                )
-            ]) """
-
         if is_shown is True:
             fig.show(config={'showLink': True})
 
-        if not os.path.exists("images/plotly"):
-            os.mkdir("images/plotly")
-
-        fname = f"{self.file_name_csv.split('.')[0]}_calculated_irradiances"
-        f = os.path.join(self.path_images_plotly, fname)
-        fig.write_image(f"{f}.svg")
-        fig.write_html(f"{f}.html")
+        fname = f"{_file_stem(self.file_name_csv)}_calculated_kfunctions_LR"
+        self._save_figure(fig, self.path_images_plotly, fname, ('html',))
 
-    def plot_kfunctionsLR_matplotlib(self, is_shown=False):
+    def plot_calculated_Kd_LR_all_points_matplotlib(self, is_shown=False):
         """
-        Plot kfunctions calculated as Linear Regression
+        Plot kfunctions calculated as Linear Regression with all points
         from .csv file in Matplotlib
 
         Parameters
@@ -1089,9 +3046,9 @@ class ProcessIrradFile:
         # in matplotlib
         fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(nrows=2, ncols=2)
         fig.subplots_adjust(right=0.8)
-        fig.suptitle("Calculated kfunctions LR", fontsize=12)
+        fig.suptitle("Calculated kfunctions LR all points", fontsize=12)
 
-        for i, df in self.df.groupby(['lambda']):
+        for i, df in self._iter_lambdas():
 
             lmbda = f'lambda: {i}'
             color = self.wavelength_to_rgb(wavelength=i)
@@ -1101,36 +3058,36 @@ class ProcessIrradFile:
             ax1.set_ylabel('depth (m)', fontsize=8)
             ax1.grid(True, alpha=0.3)
             ax1.plot(
-                df['calculated_Kd_LR'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Kd_LR_all_points', 2),
                 label=lmbda, color=color)[0]
-            ax1.set_title('calculated_Kd_LR', size=10)
+            ax1.set_title('calculated_Kd_LR_all_points', size=10)
 
             ax2.invert_yaxis()
             ax2.set_xlabel('calculated kfunction Ku (1/meter)', fontsize=8)
             ax2.set_ylabel('depth (m)', fontsize=8)
             ax2.grid(True, alpha=0.3)
             ax2.plot(
-                df['calculated_Ku_LR'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Ku_LR_all_points', 2),
                 label=lmbda, color=color)[0]
-            ax2.set_title('calculated_Ku_LR', size=10)
+            ax2.set_title('calculated_Ku_LR_all_points', size=10)
 
             ax3.invert_yaxis()
             ax3.set_xlabel('calculated kfunction Kl1 (1/meter)', fontsize=8)
             ax3.set_ylabel('depth (m)', fontsize=8)
             ax3.grid(True, alpha=0.3)
             ax3.plot(
-                df['calculated_Kl1_LR'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Kl1_LR_all_points', 2),
                 label=lmbda, color=color)[0]
-            ax3.set_title('calculated_Kl1_LR', size=10)
+            ax3.set_title('calculated_Kl1_LR_all_points', size=10)
 
             ax4.invert_yaxis()
             ax4.set_xlabel('calculated kfunction Kl2 (1/meter)', fontsize=8)
             ax4.set_ylabel('depth (m)', fontsize=8)
             ax4.grid(True, alpha=0.3)
             ax4.plot(
-                df['calculated_Kl2_LR'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Kl2_LR_all_points', 2),
                 label=lmbda, color=color)[0]
-            ax4.set_title('calculated_Kl2_LR', size=10)
+            ax4.set_title('calculated_Kl2_LR_all_points', size=10)
 
         handles, labels = ax2.get_legend_handles_labels()
 
@@ -1141,206 +3098,97 @@ class ProcessIrradFile:
             loc='center right',
             title="wavelength",
             borderaxespad=0.5,
-            fontsize=8
-            )
-
-        fig.tight_layout(rect=[0, 0.03, 0.80, 0.95])
-
-        if not os.path.exists("images/matplotlib"):
-            os.mkdir("images/matplotlib")
-
-        plt.savefig(
-            fname="images/matplotlib/calculated_kfunctions_LR.svg",
-            )
-
-        if is_shown is True:
-            plt.show()
-
-    def plot_kfunctionsLR_plotly(self, is_shown=False):
-        """
-        Plot kfunctions calculated as Linear Regression
-        from .csv file in Plotly
-
-        Parameters
-        ----------
-            is_shown: Boolean
-                Flag to show the plot. By default, False.
-
-        """
-        # plot of calculated_Kfunctions for each lambda in function of depth
-        # in plotly
-        # Initialize figure with subplots
-
-        fig = make_subplots(
-            rows=4, cols=2,
-            column_widths=[0.5, 0.5],
-            row_heights=[0.25, 0.25, 0.25, 0.25],
-            subplot_titles=(
-                "calculated_Kd_LR",
-                "calculated_Ku_LR",
-                "calculated_Kl1_no_polar_cap_LR",
-                "calculated_Kl2_no_polar_cap_LR",
-                "calculated_Kl1_polar_cap_LR",
-                "calculated_Kl2_polar_cap_LR",
-                "calculated_Khc_LR",
-                "calculated_Khc_45_LR"))
-
-        for i, df in self.df.groupby(['lambda']):
-            lmbda = f'lambda: {i}'
-            color = "rgba" + str(self.wavelength_to_rgb(wavelength=i))
-
-            # Add scatter plot of irradiances
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kd_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    marker=dict(color=color),
-                    text=df['calculated_Kd_LR'].iloc[2:]),
-                row=1, col=1
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Ku_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Ku_LR'].iloc[2:]),
-                row=1, col=2
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kl1_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Kl1_LR'].iloc[2:]),
-                row=2, col=1
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kl2_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Kl2_LR'].iloc[2:]),
-                row=2, col=2
-                )
+            fontsize=8
+            )
 
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kl1_polar_cap_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Kl1_polar_cap_LR'].iloc[2:]),
-                row=3, col=1
-                )
+        fig.tight_layout(rect=[0, 0.03, 0.80, 0.95])
 
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kl2_polar_cap_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Kl2_polar_cap_LR'].iloc[2:]),
-                row=3, col=2
-                )
+        fcsv = self.file_name_csv
+        fname = f"{_file_stem(fcsv)}_calculated_kfunctions_LR_all_points"
+        self._save_figure(
+            fig, self.path_images_matplotlib, fname, self.image_formats)
 
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Khc_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Khc_LR'].iloc[2:]),
-                row=4, col=1
-                )
+        if is_shown is True:
+            plt.show()
+        plt.close(fig)
 
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Khc_45_LR'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Khc_45_LR'].iloc[2:]),
-                row=4, col=2
-                )
+    def _plot_calculated_Kd_LR_all_points_plotly_template(self):
+        """
+        Empty figure with the subplots and layout of
+        plot_calculated_Kd_LR_all_points_plotly
+        """
+        fig = make_subplots(
+            rows=4, cols=2,
+            column_widths=[0.5, 0.5],
+            row_heights=[0.25, 0.25, 0.25, 0.25],
+            subplot_titles=(
+                "calculated_Kd_LR_all_points",
+                "calculated_Ku_LR_all_points",
+                "calculated_Kl1_LR_all_points",
+                "calculated_Kl2_LR_all_points",
+                "calculated_Kl1_polar_cap_LR_all_points",
+                "calculated_Kl2_polar_cap_LR_all_points",
+                "calculated_Khc_LR_all_points",
+                "calculated_Khc_45_LR_all_points"
+               ))
 
         # Update xaxis properties
+        range_xaxis = [0, 0.5]
         fig.update_xaxes(
             title_text="calculated kfunction Kd (1/meter)",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=1, col=1)
         fig.update_xaxes(
             title_text="calculated kfunction Ku (1/meter)",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=1, col=2)
         fig.update_xaxes(
             title_text="calculated kfunction Kl1 (1/meter)",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=2, col=1)
         fig.update_xaxes(
             title_text="calculated kfunction Kl2 (1/meter)",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=2, col=2)
         fig.update_xaxes(
             title_text="calculated kfunction Kl1 polar cap (1/meter))",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=3, col=1)
         fig.update_xaxes(
             title_text="calculated kfunction Kl2 polar cap (1/meter)",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=3, col=2)
         fig.update_xaxes(
             title_text="calculated kfunction Khc (1/meter)",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=4, col=1)
         fig.update_xaxes(
             title_text="calculated kfunction Khc 45 (1/meter)",
             title_font=dict(size=12),
             ticklen=5,
             zeroline=False,
+            range=range_xaxis,
             row=4, col=2)
 
         # Update yaxis properties
@@ -1353,7 +3201,7 @@ class ProcessIrradFile:
 
         # Update title and height
         fig.update_layout(
-            title_text="<b>Calculated kfunctions LR</b>",
+            title_text="<b>Calculated kfunctions LR all points</b>",
             title_font=dict(size=16),
             title=dict(
                 y=0.97,
@@ -1376,108 +3224,12 @@ class ProcessIrradFile:
 
         fig.update_layout(height=1920, width=1600)
 
-        for i in fig['layout']['annotations']:
-            i['font'] = dict(size=12, color='#000000')
-
-        if is_shown is True:
-            fig.show(config={'showLink': True})
-
-        if not os.path.exists("images/plotly"):
-            os.mkdir("images/plotly")
-        # fig.write_image("images/plotly/calculated_kfunctions_LR.svg")
-        fig.write_html("images/plotly/calculated_kfunctions_LR.html")
-
-    def plot_calculated_Kd_LR_all_points_matplotlib(self, is_shown=False):
-        """
-        Plot kfunctions calculated as Linear Regression with all points
-        from .csv file in Matplotlib
-
-        Parameters
-        ----------
-            is_shown: Boolean
-                Flag to show the plot. By default, False.
-
-        """
-        mplstyle.use(['ggplot'])
-
-        # plot of calculated_Ed for each lambda in function of depth
-        # in matplotlib
-        fig, ((ax1, ax2), (ax3, ax4)) = plt.subplots(nrows=2, ncols=2)
-        fig.subplots_adjust(right=0.8)
-        fig.suptitle("Calculated kfunctions LR all points", fontsize=12)
-
-        for i, df in self.df.groupby(['lambda']):
-
-            lmbda = f'lambda: {i}'
-            color = self.wavelength_to_rgb(wavelength=i)
-
-            ax1.invert_yaxis()
-            ax1.set_xlabel('calculated kfunction Kd (1/meter)', fontsize=8)
-            ax1.set_ylabel('depth (m)', fontsize=8)
-            ax1.grid(True, alpha=0.3)
-            ax1.plot(
-                df['calculated_Kd_LR_all_points'].iloc[3:],
-                df['depth'].iloc[3:],
-                label=lmbda, color=color)[0]
-            ax1.set_title('calculated_Kd_LR_all_points', size=10)
-
-            ax2.invert_yaxis()
-            ax2.set_xlabel('calculated kfunction Ku (1/meter)', fontsize=8)
-            ax2.set_ylabel('depth (m)', fontsize=8)
-            ax2.grid(True, alpha=0.3)
-            ax2.plot(
-                df['calculated_Ku_LR_all_points'].iloc[3:],
-                df['depth'].iloc[3:],
-                label=lmbda, color=color)[0]
-            ax2.set_title('calculated_Ku_LR_all_points', size=10)
-
-            ax3.invert_yaxis()
-            ax3.set_xlabel('calculated kfunction Kl1 (1/meter)', fontsize=8)
-            ax3.set_ylabel('depth (m)', fontsize=8)
-            ax3.grid(True, alpha=0.3)
-            ax3.plot(
-                df['calculated_Kl1_LR_all_points'].iloc[3:],
-                df['depth'].iloc[3:],
-                label=lmbda, color=color)[0]
-            ax3.set_title('calculated_Kl1_LR_all_points', size=10)
-
-            ax4.invert_yaxis()
-            ax4.set_xlabel('calculated kfunction Kl2 (1/meter)', fontsize=8)
-            ax4.set_ylabel('depth (m)', fontsize=8)
-            ax4.grid(True, alpha=0.3)
-            ax4.plot(
-                df['calculated_Kl2_LR_all_points'].iloc[3:],
-                df['depth'].iloc[3:],
-                label=lmbda, color=color)[0]
-            ax4.set_title('calculated_Kl2_LR_all_points', size=10)
-
-        handles, labels = ax2.get_legend_handles_labels()
-
-        # Create the legend
-        fig.legend(
-            handles, labels,
-            bbox_to_anchor=(1.0, 0.5),
-            loc='center right',
-            title="wavelength",
-            borderaxespad=0.5,
-            fontsize=8
-            )
-
-        fig.tight_layout(rect=[0, 0.03, 0.80, 0.95])
-
-        if not os.path.exists("images/matplotlib"):
-            os.mkdir("images/matplotlib")
-
-        plt.savefig(
-            fname="images/matplotlib/calculated_kfunctions_LR_all_points.svg",
-            )
-
-        if is_shown is True:
-            plt.show()
+        return fig
 
     def plot_calculated_Kd_LR_all_points_plotly(self, min_lambda=400,
                                                 max_lambda=700,
-                                                is_shown=False):
+                                                is_shown=False,
+                                                max_depth=None):
         """
         Plot kfunctions calculated as Linear Regression with all points
         from .csv file in Plotly
@@ -1490,253 +3242,155 @@ class ProcessIrradFile:
                 Minimum lambda value to plot (Default=400)
             max_lambda: int
                 Maximum lambda value to plot (Default=700)
+            max_depth: float
+                Maximum depth value to plot (Default=None, all depths)
 
         """
-        self.new_df = self.df.copy()
-
         # filter dataframe lambda. By default:
         # wavelength > 400 and wavelength < 700
-        self.new_df = self.df[(self.df['lambda'] > min_lambda) & (
-            self.df['lambda'] < max_lambda)]
+        selected = (self.df['lambda'] > min_lambda) & (
+            self.df['lambda'] < max_lambda)
+        if max_depth is not None:
+            selected &= self.df['depth'] <= max_depth
+        self.new_df = self.df[selected]
 
         # plot of calculated_kfunctions for each lambda in function of depth
         # in plotly
-        # Initialize figure with subplots
-        fig = make_subplots(
-            rows=4, cols=2,
-            column_widths=[0.5, 0.5],
-            row_heights=[0.25, 0.25, 0.25, 0.25],
-            subplot_titles=(
-                "calculated_Kd_LR_all_points",
-                "calculated_Ku_LR_all_points",
-                "calculated_Kl1_LR_all_points",
-                "calculated_Kl2_LR_all_points",
-                "calculated_Kl1_polar_cap_LR_all_points",
-                "calculated_Kl2_polar_cap_LR_all_points",
-                "calculated_Khc_LR_all_points",
-                "calculated_Khc_45_LR_all_points"
-               ))
-        # to do
-        depth_list = self.new_df['depth'].unique()
-        depth_max, = np.where(depth_list == 2)
-        depth = int(depth_max)
+        # copy of the empty figure with the subplots and layout
+        fig = self._plotly_figure('plot_calculated_Kd_LR_all_points')
 
-        for i, df in self.df.groupby(['lambda']):
+        for i, df in self._iter_lambdas(self.new_df):
 
             lmbda = f'lambda: {i}'
             color = "rgba" + str(self.wavelength_to_rgb(wavelength=i))
 
             # Add scatter plot of irradiances
+            values, depth = self._profile(
+                df, 'calculated_Kd_LR_all_points', 2)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Kd_LR_all_points'].iloc[3:depth],
-                    y=df['depth'].iloc[3:depth],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     marker=dict(color=color),
-                    text=df['calculated_Kd_LR_all_points'].iloc[3:depth]),
+                    text=values),
                 row=1, col=1
                 )
 
+            values, depth = self._profile(
+                df, 'calculated_Ku_LR_all_points', 2)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Ku_LR_all_points'].iloc[3:depth],
-                    y=df['depth'].iloc[3:depth],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_Ku_LR_all_points'].iloc[3:depth]),
+                    text=values),
                 row=1, col=2
                 )
 
+            values, depth = self._profile(
+                df, 'calculated_Kl1_LR_all_points', 2)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Kl1_LR_all_points'].iloc[3:depth],
-                    y=df['depth'].iloc[3:depth],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_Kl1_LR_all_points'].iloc[3:depth]),
+                    text=values),
                 row=2, col=1
                 )
 
+            values, depth = self._profile(
+                df, 'calculated_Kl2_LR_all_points', 2)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Kl2_LR_all_points'].iloc[3:depth],
-                    y=df['depth'].iloc[3:depth],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_Kl2_LR_all_points'].iloc[3:depth]),
+                    text=values),
                 row=2, col=2
                 )
 
+            values, depth = self._profile(
+                df, 'calculated_Kl1_polar_cap_LR_all_points', 2)
             fig.add_trace(
                 go.Scatter(
-                    x=df['calculated_Kl1_polar_cap_LR_all_points'].iloc[
-                        3:depth],
-                    y=df['depth'].iloc[3:depth],
+                    x=values,
+                    y=depth,
                     mode="lines",
                     legendgroup="group " + str(lmbda),
                     name=lmbda,
                     showlegend=False,
                     marker=dict(color=color),
-                    text=df['calculated_Kl1_polar_cap_LR_all_points'].iloc[
-                        3:depth]),
+                    text=values),
                 row=3, col=1
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kl2_polar_cap_LR_all_points'].iloc[
-                        3:depth],
-                    y=df['depth'].iloc[3:depth],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Kl2_polar_cap_LR_all_points'].iloc[
-                        3:depth]),
-                row=3, col=2
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Khc_LR_all_points'].iloc[3:depth],
-                    y=df['depth'].iloc[3:depth],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Khc_LR_all_points'].iloc[3:depth]),
-                row=4, col=1
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Khc_45_LR_all_points'].iloc[3:depth],
-                    y=df['depth'].iloc[3:depth],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Khc_45_LR_all_points'].iloc[3:depth]),
-                row=4, col=2
-                )
-
-        # Update xaxis properties
-        range_xaxis = [0, 0.5]
-        fig.update_xaxes(
-            title_text="calculated kfunction Kd (1/meter)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=1, col=1)
-        fig.update_xaxes(
-            title_text="calculated kfunction Ku (1/meter)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=1, col=2)
-        fig.update_xaxes(
-            title_text="calculated kfunction Kl1 (1/meter)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=2, col=1)
-        fig.update_xaxes(
-            title_text="calculated kfunction Kl2 (1/meter)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=2, col=2)
-        fig.update_xaxes(
-            title_text="calculated kfunction Kl1 polar cap (1/meter))",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=3, col=1)
-        fig.update_xaxes(
-            title_text="calculated kfunction Kl2 polar cap (1/meter)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=3, col=2)
-        fig.update_xaxes(
-            title_text="calculated kfunction Khc (1/meter)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=4, col=1)
-        fig.update_xaxes(
-            title_text="calculated kfunction Khc 45 (1/meter)",
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            range=range_xaxis,
-            row=4, col=2)
+                )
 
-        # Update yaxis properties
-        fig.update_yaxes(
-            title_text='depth (m)',
-            title_font=dict(size=12),
-            ticklen=5,
-            zeroline=False,
-            autorange='reversed')
+            values, depth = self._profile(
+                df, 'calculated_Kl2_polar_cap_LR_all_points', 2)
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=3, col=2
+                )
 
-        # Update title and height
-        fig.update_layout(
-            title_text="<b>Calculated kfunctions LR all points</b>",
-            title_font=dict(size=16),
-            title=dict(
-                y=0.97,
-                x=0.5,
-                xanchor='center',
-                yanchor="top"),
-            legend_title='<b> Wavelength </b>',
-            legend=dict(
-                traceorder="normal",
-                y=1,
-                x=1.1,
-                yanchor="top",
-                font=dict(
-                    family="sans-serif",
-                    size=9,
-                    color="black"
-                ),
-            )
-        )
+            values, depth = self._profile(
+                df, 'calculated_Khc_LR_all_points', 2)
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=4, col=1
+                )
 
-        fig.update_layout(height=1920, width=1600)
+            values, depth = self._profile(
+                df, 'calculated_Khc_45_LR_all_points', 2)
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=4, col=2
+                )
 
         if is_shown is True:
             fig.show(config={'showLink': True})
 
-        if not os.path.exists("images/plotly"):
-            os.mkdir("images/plotly")
-
         fcsv = self.file_name_csv
-        fname = f"{fcsv.split('.')[0]}_calculated_kfunctions_LR_all_points"
-        f = os.path.join(self.path_images_plotly, fname)
-        fig.write_image(f"{f}.svg")
-        fig.write_html(f"{f}.html")
+        fname = f"{_file_stem(fcsv)}_calculated_kfunctions_LR_all_points"
+        self._save_figure(fig, self.path_images_plotly, fname,
+                          tuple(self.image_formats) + ('html',))
 
     def plot_calculated_Kd_HL_matplotlib(self, is_shown=False):
         """
@@ -1757,7 +3411,7 @@ class ProcessIrradFile:
         fig.subplots_adjust(right=0.8)
         fig.suptitle("Calculated kfunctions HL", fontsize=12)
 
-        for i, df in self.df.groupby(['lambda']):
+        for i, df in self._iter_lambdas():
 
             lmbda = f'lambda: {i}'
             color = self.wavelength_to_rgb(wavelength=i)
@@ -1767,7 +3421,7 @@ class ProcessIrradFile:
             ax1.set_ylabel('depth (m)', fontsize=8)
             ax1.grid(True, alpha=0.3)
             ax1.plot(
-                df['calculated_Kd_HL'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Kd_HL', 1),
                 label=lmbda, color=color)[0]
             ax1.set_title('calculated_Kd_HL', size=10)
 
@@ -1776,7 +3430,7 @@ class ProcessIrradFile:
             ax2.set_ylabel('depth (m)', fontsize=8)
             ax2.grid(True, alpha=0.3)
             ax2.plot(
-                df['calculated_Ku_HL'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Ku_HL', 1),
                 label=lmbda, color=color)[0]
             ax2.set_title('calculated_Ku_HL', size=10)
 
@@ -1785,7 +3439,7 @@ class ProcessIrradFile:
             ax3.set_ylabel('depth (m)', fontsize=8)
             ax3.grid(True, alpha=0.3)
             ax3.plot(
-                df['calculated_Kl1_HL'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Kl1_HL', 1),
                 label=lmbda, color=color)[0]
             ax3.set_title('calculated_Kl1_HL', size=10)
 
@@ -1794,7 +3448,7 @@ class ProcessIrradFile:
             ax4.set_ylabel('depth (m)', fontsize=8)
             ax4.grid(True, alpha=0.3)
             ax4.plot(
-                df['calculated_Kl2_HL'].iloc[2:], df['depth'].iloc[2:],
+                *self._profile(df, 'calculated_Kl2_HL', 1),
                 label=lmbda, color=color)[0]
             ax4.set_title('calculated_Kl2_HL', size=10)
 
@@ -1812,29 +3466,19 @@ class ProcessIrradFile:
 
         fig.tight_layout(rect=[0, 0.03, 0.80, 0.95])
 
-        if not os.path.exists("images/matplotlib"):
-            os.mkdir("images/matplotlib")
-
-        plt.savefig(
-            fname="images/matplotlib/calculated_kfunctions_HL.svg",
-            )
+        fname = f"{_file_stem(self.file_name_csv)}_calculated_kfunctions_HL"
+        self._save_figure(
+            fig, self.path_images_matplotlib, fname, self.image_formats)
 
         if is_shown is True:
             plt.show()
+        plt.close(fig)
 
-    def plot_calculated_Kd_HL_plotly(self, is_shown=False):
+    def _plot_calculated_Kd_HL_plotly_template(self):
         """
-        Plot kfunctions calculated as Linear Regression with all points
-        from .csv file in Plotly
-
-        Parameters
-        ----------
-            is_shown: Boolean
-                Flag to show the plot. By default, False.
-
+        Empty figure with the subplots and layout of
+        plot_calculated_Kd_HL_plotly
         """
-        # plot of calculated_Ed for each lambda in function of depth in plotly
-        # Initialize figure with subplots
         fig = make_subplots(
             rows=2, cols=2,
             column_widths=[0.5, 0.5],
@@ -1844,62 +3488,6 @@ class ProcessIrradFile:
                             "calculated_Kl1_HL",
                             "calculated_Kl2_HL"))
 
-        for i, df in self.df.groupby(['lambda']):
-            lmbda = f'lambda: {i}'
-            color = "rgba" + str(self.wavelength_to_rgb(wavelength=i))
-
-            # Add scatter plot of irradiances
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kd_HL'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    marker=dict(color=color),
-                    text=df['calculated_Kd_HL'].iloc[2:]),
-                row=1, col=1
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Ku_HL'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Ku_HL'].iloc[2:]),
-                row=1, col=2
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kl1_HL'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Kl1_HL'].iloc[2:]),
-                row=2, col=1
-                )
-
-            fig.add_trace(
-                go.Scatter(
-                    x=df['calculated_Kl2_HL'].iloc[2:],
-                    y=df['depth'].iloc[2:],
-                    mode="lines",
-                    legendgroup="group " + str(lmbda),
-                    name=lmbda,
-                    showlegend=False,
-                    marker=dict(color=color),
-                    text=df['calculated_Kl2_HL'].iloc[2:]),
-                row=2, col=2
-                )
-
         # Update xaxis properties
         fig.update_xaxes(
             title_text="calculated kfunction Kd (1/meter)",
@@ -1957,17 +3545,456 @@ class ProcessIrradFile:
             )
         )
 
+        return fig
+
+    def plot_calculated_Kd_HL_plotly(self, is_shown=False):
+        """
+        Plot kfunctions calculated as Linear Regression with all points
+        from .csv file in Plotly
+
+        Parameters
+        ----------
+            is_shown: Boolean
+                Flag to show the plot. By default, False.
+
+        """
+        # plot of calculated_Ed for each lambda in function of depth in plotly
+        # copy of the empty figure with the subplots and layout
+        fig = self._plotly_figure('plot_calculated_Kd_HL')
+
+        for i, df in self._iter_lambdas():
+            lmbda = f'lambda: {i}'
+            color = "rgba" + str(self.wavelength_to_rgb(wavelength=i))
+
+            # Add scatter plot of irradiances
+            values, depth = self._profile(df, 'calculated_Kd_HL', 1)
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    marker=dict(color=color),
+                    text=values),
+                row=1, col=1
+                )
+
+            values, depth = self._profile(df, 'calculated_Ku_HL', 1)
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=1, col=2
+                )
+
+            values, depth = self._profile(df, 'calculated_Kl1_HL', 1)
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=2, col=1
+                )
+
+            values, depth = self._profile(df, 'calculated_Kl2_HL', 1)
+            fig.add_trace(
+                go.Scatter(
+                    x=values,
+                    y=depth,
+                    mode="lines",
+                    legendgroup="group " + str(lmbda),
+                    name=lmbda,
+                    showlegend=False,
+                    marker=dict(color=color),
+                    text=values),
+                row=2, col=2
+                )
+
         if is_shown is True:
             fig.show(config={'showLink': True})
 
-        if not os.path.exists("images/plotly"):
-            os.mkdir("images/plotly")
-        fig.write_image("images/plotly/calculated_kfunctions_LH.svg")
-        fig.write_html("images/plotly/calculated_kfunctions_LH.html")
+        fname = f"{_file_stem(self.file_name_csv)}_calculated_kfunctions_LH"
+        self._save_figure(fig, self.path_images_plotly, fname,
+                          tuple(self.image_formats) + ('html',))
+
+    def _set_run_name(self, file_name, **parameters):
+        """
+        Set the name of the run folder from the name of the input file and
+        a hash of the parameters, if self.run_directories is True. Without
+        run folders, results of runs of a file with other parameters have
+        the same names and overwrite the previous ones
+
+        Parameters
+        ----------
+            file_name: str
+                Name of the input file
+            parameters: dict
+                Parameters of the run
+        """
+        if self.run_directories is not True:
+            self.run_name = None
+            return
+
+        parameters = {name: value for name, value in parameters.items()
+                      if value is not None}
+        text = json.dumps(parameters, sort_keys=True,
+                          default=lambda value: np.asarray(value).tolist())
+        digest = hashlib.sha1(text.encode()).hexdigest()[:8]
+        self.run_name = f"{_file_stem(file_name)}_{digest}"
+
+    def _output_file(self, path, fname):
+        """
+        Get the path of an output file, inside the run folder if there is a
+        run name. Folders are created if they do not exist
+
+        Parameters
+        ----------
+            path: str
+                Path of the output folder
+            fname: str
+                Name of the file
+
+        Return
+        ------
+            f: str
+                Path of the file
+        """
+        if self.run_name is not None:
+            path = os.path.join(path, self.run_name)
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, fname)
+
+    @contextlib.contextmanager
+    def _atomic_write(self, f):
+        """
+        Yield a temporary path in the folder of f, that is renamed to f when
+        it is completely written. Readers and other processes never see a
+        partial file
+
+        Parameters
+        ----------
+            f: str
+                Path of the file or folder to write
+        """
+        folder, name = os.path.split(f)
+        stem, extension = os.path.splitext(name)
+        tmp = os.path.join(
+            folder,
+            f".{stem}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp{extension}")
+        try:
+            yield tmp
+
+            # a folder can not replace a folder that is not empty. Move the
+            # old folder away and remove it after the rename
+            if os.path.isdir(tmp) and os.path.isdir(f):
+                old = f"{tmp}.old"
+                os.replace(f, old)
+                os.replace(tmp, f)
+                shutil.rmtree(old, ignore_errors=True)
+            else:
+                os.replace(tmp, f)
+            self.output_files.append(f)
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+            elif os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _plotly_figure(self, plot):
+        """
+        Get the figure of a plot without traces. Subplots and layout are
+        built once in each thread by the _<plot>_plotly_template method,
+        and the figure is reused with the traces of each run. A copy
+        (copy.deepcopy) validates the whole layout again and is only twice
+        as fast as building it
+
+        Parameters
+        ----------
+            plot: str
+                Name of the plot, as 'plot_irradiances'
+
+        Return
+        ------
+            fig: plotly figure object
+                Figure without traces
+        """
+        templates = _plotly_templates.__dict__
+        if plot not in templates:
+            templates[plot] = getattr(self, f"_{plot}_plotly_template")()
+
+        fig = templates[plot]
+        fig.data = ()
+        return fig
+
+    def _save_figure(self, fig, path, fname, extensions):
+        """
+        Save a Matplotlib or Plotly figure with atomic writes
+
+        Parameters
+        ----------
+            fig: Matplotlib or Plotly figure
+                Figure to save
+            path: str
+                Path of the images folder
+            fname: str
+                Name of the file without extension
+            extensions: tuple
+                Formats to save: 'svg', 'png' or 'html'
+        """
+        for extension in extensions:
+            if extension != 'html' and extension not in IMAGE_FORMATS:
+                raise ValueError(
+                    f"image formats must be in {IMAGE_FORMATS}, "
+                    f"not '{extension}'")
+
+            # figures of a report are saved by write_html_report()
+            if extension == 'html' and self.html_report is not None:
+                self.html_report.append((fname, pio.to_html(
+                    self._html_figure(fig), include_plotlyjs=False,
+                    full_html=False, validate=False)))
+                continue
+
+            f = self._output_file(path, f"{fname}.{extension}")
+            with self._atomic_write(f) as tmp:
+                if not isinstance(fig, go.Figure):
+                    # png is rendered by Agg at self.dpi
+                    if extension == 'png':
+                        fig.savefig(tmp, dpi=self.dpi)
+                    else:
+                        fig.savefig(tmp)
+                elif extension == 'html':
+                    pio.write_html(
+                        self._html_figure(fig), tmp, validate=False,
+                        include_plotlyjs=self._plotlyjs(os.path.dirname(f)))
+                elif extension == 'png':
+                    # plotly sizes are in css pixels of 96 dpi
+                    fig.write_image(tmp, scale=self.dpi / 96)
+                else:
+                    fig.write_image(tmp)
+
+    def _html_figure(self, fig):
+        """
+        Get the dict of a plotly figure to write in html, with float values
+        rounded to self.html_precision significant digits
+
+        Parameters
+        ----------
+            fig: plotly figure object
+                Figure to write
+
+        Return
+        ------
+            fig: dict
+                Data and layout of the figure
+        """
+        fig = fig.to_dict()
+        if self.html_precision is None:
+            return fig
+
+        for trace in fig['data']:
+            for key, values in trace.items():
+                if isinstance(values, np.ndarray) and values.dtype.kind == 'f':
+                    trace[key] = _round_significant(
+                        values, self.html_precision)
+        return fig
+
+    def _plotlyjs(self, folder):
+        """
+        Get the include_plotlyjs argument of plotly html files, and write
+        plotly.min.js in the folder if it is shared by the html files
+
+        Parameters
+        ----------
+            folder: str
+                Folder of the html files
+
+        Return
+        ------
+            include_plotlyjs: bool or str
+                True, 'cdn' or the path of plotly.min.js for html files
+        """
+        if self.include_plotlyjs not in INCLUDE_PLOTLYJS:
+            raise ValueError(
+                f"include_plotlyjs must be one of {INCLUDE_PLOTLYJS}, "
+                f"not '{self.include_plotlyjs}'")
+
+        if self.include_plotlyjs != 'directory':
+            return self.include_plotlyjs
+
+        f = os.path.join(folder, PLOTLYJS_FILE)
+        if not os.path.exists(f):
+            with self._atomic_write(f) as tmp:
+                with open(tmp, 'w', encoding='utf-8') as file:
+                    file.write(get_plotlyjs())
+        return PLOTLYJS_FILE
+
+    def write_html_report(self, fname="plotly_report", path=None):
+        """
+        Write the plotly figures collected in self.html_report in one html
+        file, with plotly.js included once. Collect figures setting
+        self.html_report to an empty list before plotting
+
+        Parameters
+        ----------
+            fname: str
+                Name of the file without extension (Default="plotly_report")
+            path: str
+                Path of the file (Default=None, uses self.path_images_plotly)
+        """
+        if not self.html_report:
+            raise ValueError(
+                "No figures in html_report. Set html_report = [] before "
+                "plotting")
+
+        if path is None:
+            path = self.path_images_plotly
+
+        f = self._output_file(path, f"{fname}.html")
+        include_plotlyjs = self._plotlyjs(os.path.dirname(f))
+        if include_plotlyjs is True:
+            script = (f'<script type="text/javascript">{get_plotlyjs()}'
+                      '</script>')
+        elif include_plotlyjs == 'cdn':
+            script = ('<script src="https://cdn.plot.ly/plotly-latest.min.js">'
+                      '</script>')
+        else:
+            script = f'<script src="{include_plotlyjs}"></script>'
+
+        with self._atomic_write(f) as tmp:
+            with open(tmp, 'w', encoding='utf-8') as file:
+                file.write(
+                    f"<html>\n<head><meta charset=\"utf-8\" />"
+                    f"<title>{fname}</title>{script}</head>\n<body>\n")
+                for name, div in self.html_report:
+                    file.write(f"<h2>{name}</h2>\n{div}\n")
+                file.write("</body>\n</html>\n")
+
+        self.html_report = []
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        """
+        Measure the time of a stage of the process, and the memory if the
+        tracemalloc hook is active. Nested stages are saved as
+        "stage/substage" in self.stages
+
+        Parameters
+        ----------
+            name: str
+                Name of the stage
+        """
+        self._stage_names.append(name)
+        stage = {'stage': "/".join(self._stage_names)}
+        if tracemalloc.is_tracing():
+            memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage['seconds'] = time.perf_counter() - start
+            if tracemalloc.is_tracing():
+                current, peak = tracemalloc.get_traced_memory()
+                stage['memory_increase'] = current - memory
+                stage['memory_peak'] = peak
+            self.stages.append(stage)
+            self._stage_names.pop()
+
+    @contextlib.contextmanager
+    def _profile_run(self, fname):
+        """
+        Clear stages, start the profiling hooks and, if self.profile is True,
+        save the JSON report of the stages in path_files_csv at the end
+
+        Parameters
+        ----------
+            fname: str
+                Name of the report without extension
+        """
+        unknown = set(self.profile_hooks) - set(PROFILE_HOOKS)
+        if unknown:
+            raise ValueError(
+                f"profile_hooks must be in {PROFILE_HOOKS}, not {unknown}")
+
+        self.stages = []
+        profiler = None
+        if 'cprofile' in self.profile_hooks:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started_tracemalloc = False
+        if 'tracemalloc' in self.profile_hooks and (
+                not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            started_tracemalloc = True
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            report = {'run': fname, 'seconds': time.perf_counter() - start,
+                      'stages': self.stages}
+            if started_tracemalloc:
+                report['memory_peak'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+            if profiler is not None:
+                profiler.disable()
+
+            if self.profile is True:
+                f = self._output_file(
+                    self.path_files_csv, f"{fname}_profile")
+                if profiler is not None:
+                    with self._atomic_write(f"{f}.prof") as tmp:
+                        profiler.dump_stats(tmp)
+                    report['cprofile'] = f"{f}.prof"
+
+                with self._atomic_write(f"{f}.json") as tmp:
+                    with open(tmp, 'w') as file:
+                        json.dump(report, file, indent=2)
+
+    def _run_loading(self, target, process_name=""):
+        """
+        Run target in a new thread while the loading animation is shown,
+        and return as soon as it ends. With the cprofile hook, target runs
+        in this thread: cProfile only profiles the thread that enables it
+
+        Parameters
+        ----------
+            target: function
+                Function to run, without arguments
+            process_name: str
+                Name shown in the animation (Default="")
+        """
+        if 'cprofile' in self.profile_hooks:
+            target()
+            return
+
+        the_process = threading.Thread(target=target)
+        the_process.start()
+        while the_process.is_alive():
+            self.animated_loading(
+                process_name=process_name, thread=the_process)
 
-    def animated_loading(self, process_name=""):
+    def animated_loading(self, process_name="", thread=None):
         chars = r"/—\|"
         for char in chars:
             sys.stdout.write('\r'+f'{process_name} - Loading...'+char)
-            time.sleep(.1)
+            if thread is None:
+                time.sleep(.1)
+            else:
+                # stop the animation when the thread ends
+                thread.join(.1)
             sys.stdout.flush()
+            if thread is not None and not thread.is_alive():
+                return
@@ -0,0 +1,595 @@
+# -*- coding: utf-8 -*-
+"""
+Differential test of the engines that calculate kfunctions. Runs a frozen
+port of the legacy row loop and the current kernels on synthetic and
+recorded files of irradiances, compares every kfunctions column within
+tolerances and reports the speedup of each kernel.
+
+    python compare_kfunctions.py
+    python compare_kfunctions.py --files files/raw/Lroot.csv files/raw/run.csv
+    python compare_kfunctions.py --kernels numpy numba --rtol 1e-9
+
+Synthetic files with zeros, negative and non-numeric irradiances are
+compared with a row loop reference of each invalid irradiance policy,
+since the legacy loop used ln(E) = 0 for them. They are also resampled
+onto their own lambdas and depths, which must not change them.
+
+Exit status is 1 if any column does not match.
+
+"""
+import os
+import argparse
+import fnmatch
+import math
+import sys
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import calculate_kfunctions
+from calculate_kfunctions import (
+    KFUNCTIONS_COLUMNS, KFUNCTIONS_IRRADIANCES, ProcessIrradFile)
+
+# synthetic cases: (number of lambdas, depth step in meters)
+SYNTHETIC_CASES = ((7, 0.5), (31, 0.2))
+
+# synthetic cases with zeros, negative and non-numeric irradiances,
+# compared for each invalid irradiance policy
+INVALID_CASES = ((7, 0.5),)
+
+
+def kfunctions_columns():
+    """
+    Names of the kfunctions columns, in the order they are saved
+    """
+    return [f'{prefix}_{kfunction}_{method}'
+            for prefix, method in KFUNCTIONS_COLUMNS
+            for kfunction in KFUNCTIONS_IRRADIANCES]
+
+
+def synthetic_irradiances(n_lambdas=7, depth_step=0.5, max_depth=20.0,
+                          seed=0):
+    """
+    Create a dataframe of irradiances with the columns of
+    Lroot_calculated_irradiances.csv: exponential decay with depth, a
+    lambda dependent attenuation and 1% of noise. Irradiances in air
+    (depth -1.0) differ from the surface (depth 0.0)
+
+    Parameters
+    ----------
+        n_lambdas: int
+            Number of lambdas between 400 and 700 nm (Default=7)
+        depth_step: float
+            Depth step in meters (Default=0.5)
+        max_depth: float
+            Maximum depth in meters (Default=20.0)
+        seed: int
+            Seed of the noise (Default=0)
+
+    Return
+    ------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances
+    """
+    rng = np.random.default_rng(seed)
+    lambdas = np.linspace(400, 700, n_lambdas)
+    depths = np.concatenate((
+        [-1.0, 0.0],
+        np.arange(depth_step, max_depth + depth_step / 2, depth_step)))
+
+    lmbd = np.repeat(lambdas, len(depths))
+    depth = np.tile(depths, len(lambdas))
+    z = np.maximum(depth, 0.0)
+    k = 0.02 + 0.5 * ((lmbd - 400) / 300) ** 2
+    decay = np.exp(-k * z - 0.01 * z ** 1.5)
+
+    df = pd.DataFrame({'lambda': lmbd, 'depth': depth})
+    # scale of each irradiance and its factor in air: downwelling is
+    # transmitted by the surface, upwelling is reflected
+    scales = {
+        'calculated_Ed': (1.0, 1.04),
+        'calculated_Eu': (0.02, 0.55),
+        'calculated_El1_no_polar_cap': (0.1, 0.9),
+        'calculated_El2_no_polar_cap': (0.1, 0.9),
+        'calculated_El1_polar_cap': (0.12, 0.85),
+        'calculated_El2_polar_cap': (0.12, 0.85),
+        'calculated_Ehc': (0.3, 0.95),
+        'calculated_Ehc_45': (0.25, 0.95),
+    }
+    for column, (scale, air) in scales.items():
+        df[column] = scale * np.where(depth < 0, air, 1.0) * decay * (
+            1 + 0.01 * rng.standard_normal(len(df)))
+
+    return df
+
+
+def invalid_irradiances(df, fraction=0.03, seed=1):
+    """
+    Replace some irradiances of a dataframe by zeros, negative values and
+    NaN (non-numeric values), in all depths including -1.0 and 0.0
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances
+        fraction: float
+            Fraction of the irradiances replaced by each kind of value
+            (Default=0.03)
+        seed: int
+            Seed of the replaced irradiances (Default=1)
+
+    Return
+    ------
+        df: pandas dataframe object
+            New dataframe with invalid irradiances
+    """
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    for column in KFUNCTIONS_IRRADIANCES.values():
+        values = df[column].to_numpy(dtype=float)
+        kind = rng.random(len(df))
+        values[kind < fraction] = 0.0
+        values[(kind >= fraction) & (kind < 2 * fraction)] *= -1
+        values[(kind >= 2 * fraction) & (kind < 3 * fraction)] = np.nan
+        df[column] = values
+    return df
+
+
+def legacy_kfunctions(df):
+    """
+    Frozen port of the legacy row loop of _calculate_kfunctions: for each
+    row and irradiance, scipy.stats.linregress of the last 2 points and of
+    all points except depths -1.0 and 0.0 of the lambda. The loop is the
+    same, but results are stored in arrays instead of setting dataframe
+    cells. Non-positive irradiances have ln(E) = 0, as in the legacy code,
+    but this 0 is added to the points of the same irradiance (the legacy
+    code added it to the points of El1_polar_cap for some irradiances)
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances
+
+    Return
+    ------
+        kfunctions: pandas dataframe object
+            dataframe with the kfunctions columns
+    """
+    df = df.copy()
+    df['lambda'] = df['lambda'].astype(float).fillna(0.0)
+    df['depth'] = df['depth'].astype(float).fillna(0.0)
+    df = df.apply(pd.to_numeric, args=('coerce',))
+
+    results = {column: np.zeros(len(df)) for column in kfunctions_columns()}
+    lambdas = df['lambda'].to_numpy()
+    depths = df['depth'].to_numpy()
+    irradiances = {kfunction: df[irradiance].to_numpy()
+                   for kfunction, irradiance in KFUNCTIONS_IRRADIANCES.items()}
+
+    lmbd = lambdas[0]
+    x = []
+    log_y = {kfunction: [] for kfunction in KFUNCTIONS_IRRADIANCES}
+    y = {kfunction: [] for kfunction in KFUNCTIONS_IRRADIANCES}
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for i in range(len(df)):
+
+            depth = depths[i]
+
+            # clear variables in each new lambda
+            if lmbd != lambdas[i]:
+                lmbd = lambdas[i]
+                x = []
+                log_y = {kfunction: [] for kfunction in KFUNCTIONS_IRRADIANCES}
+                y = {kfunction: [] for kfunction in KFUNCTIONS_IRRADIANCES}
+
+            if not math.isnan(depth):
+                x.append(depth)
+                for kfunction, values in irradiances.items():
+                    try:
+                        log_y[kfunction].append(math.log(values[i]))
+                    except ValueError:
+                        log_y[kfunction].append(0)
+                    y[kfunction].append(values[i])
+
+            for kfunction in KFUNCTIONS_IRRADIANCES:
+                try:
+                    regression = stats.linregress(
+                        x[-2:], log_y[kfunction][-2:])
+                    lr = regression.slope * (-1)
+                    r2_lr = regression.rvalue * regression.rvalue
+
+                    regression = stats.linregress(
+                        x[2:], log_y[kfunction][2:])
+                    if math.isnan(regression.slope):
+                        lr_all = 0
+                    else:
+                        lr_all = regression.slope * (-1)
+                    r2_lr_all = regression.rvalue * regression.rvalue
+
+                    hl = (math.log(y[kfunction][-1] / y[kfunction][-2]) / (
+                        x[-1] - x[-2])) * -1
+
+                except (IndexError, ValueError, ZeroDivisionError):
+                    lr = r2_lr = lr_all = r2_lr_all = hl = 0
+
+                results[f'calculated_{kfunction}_LR'][i] = lr
+                results[f'r2value_{kfunction}_LR'][i] = r2_lr
+                results[f'calculated_{kfunction}_LR_all_points'][i] = lr_all
+                results[f'r2value_{kfunction}_LR_all_points'][i] = r2_lr_all
+                results[f'calculated_{kfunction}_HL'][i] = hl
+
+    return pd.DataFrame(results, index=df.index)
+
+
+def reference_kfunctions(df, invalid_policy="drop", clamp_value=1e-30):
+    """
+    Row loop reference of the kfunctions with an invalid irradiance
+    policy, for files with non-positive or non-numeric irradiances. For
+    each row and irradiance, scipy.stats.linregress of the last 2 points
+    of the lambda and of all points except depths -1.0 and 0.0:
+    - 'drop': not valid points are excluded of the regressions, and rows
+      with a not valid point are not calculated
+    - 'nan': kfunctions that use a not valid point are NaN
+    - 'clamp': non-positive irradiances are clamp_value and non-numeric
+      irradiances are not valid, as with 'nan'
+    Kfunctions that can not be calculated are NaN with 'nan' policy and 0
+    with the others
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances
+        invalid_policy: str
+            Policy for non-positive or non-numeric irradiances
+            (Default="drop")
+        clamp_value: float
+            Irradiance of non-positive values with 'clamp' policy
+            (Default=1e-30)
+
+    Return
+    ------
+        kfunctions: pandas dataframe object
+            dataframe with the kfunctions columns
+    """
+    df = df.apply(pd.to_numeric, args=('coerce',))
+    results = {column: np.full(len(df), np.nan)
+               for column in kfunctions_columns()}
+    lambdas = df['lambda'].to_numpy(dtype=float)
+    depths = df['depth'].to_numpy(dtype=float)
+    starts = np.flatnonzero(np.r_[True, lambdas[1:] != lambdas[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for kfunction, irradiance in KFUNCTIONS_IRRADIANCES.items():
+            values = df[irradiance].to_numpy(dtype=float)
+            if invalid_policy == 'clamp':
+                values = np.where(values <= 0, clamp_value, values)
+
+            for start, end in zip(starts, ends):
+                # position, depth and ln(E) of the points of the lambda
+                points = []
+                for i in range(start, end):
+                    if math.isfinite(values[i]) and values[i] > 0:
+                        log_e = math.log(values[i])
+                    elif invalid_policy == 'drop':
+                        continue
+                    else:
+                        log_e = math.nan
+                    points.append((i - start, depths[i], log_e))
+                    if i - start < 2:
+                        continue
+
+                    x = [point[1] for point in points]
+                    log_y = [point[2] for point in points]
+                    if len(points) >= 2:
+                        regression = stats.linregress(x[-2:], log_y[-2:])
+                        lr = regression.slope * (-1)
+                        results[f'calculated_{kfunction}_LR'][i] = lr
+                        results[f'r2value_{kfunction}_LR'][i] = (
+                            regression.rvalue * regression.rvalue)
+                        results[f'calculated_{kfunction}_HL'][i] = lr
+
+                    x = [point[1] for point in points if point[0] >= 2]
+                    log_y = [point[2] for point in points if point[0] >= 2]
+                    if math.isnan(sum(log_y)):
+                        r2_lr_all = math.nan
+                    elif len(x) < 2:
+                        r2_lr_all = 0.0
+                    else:
+                        regression = stats.linregress(x, log_y)
+                        results[
+                            f'calculated_{kfunction}_LR_all_points'][i] = (
+                            regression.slope * (-1))
+                        r2_lr_all = regression.rvalue * regression.rvalue
+                    results[f'r2value_{kfunction}_LR_all_points'][i] = (
+                        r2_lr_all)
+
+    kfunctions = pd.DataFrame(results, index=df.index)
+    if invalid_policy != 'nan':
+        kfunctions = kfunctions.fillna(0.0)
+    return kfunctions
+
+
+def engine_kfunctions(df, kernel="numpy", invalid_policy="drop"):
+    """
+    Calculate kfunctions with the current engine
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances
+        kernel: str
+            Kernel of ProcessIrradFile (Default="numpy")
+        invalid_policy: str
+            Policy for non-positive or non-numeric irradiances
+            (Default="drop")
+
+    Return
+    ------
+        kfunctions: pandas dataframe object
+            dataframe with the kfunctions columns
+    """
+    pirradf = ProcessIrradFile()
+    pirradf.kernel = kernel
+    pirradf.invalid_policy = invalid_policy
+    pirradf.df = df.copy()
+    pirradf._compute_kfunctions()
+    return pirradf.df[kfunctions_columns()]
+
+
+def compare(expected, result, rtol=1e-6, atol=1e-9):
+    """
+    Compare every kfunctions column of two dataframes
+
+    Parameters
+    ----------
+        expected: pandas dataframe object
+            Reference kfunctions
+        result: pandas dataframe object
+            kfunctions to check
+        rtol: float
+            Relative tolerance (Default=1e-6)
+        atol: float
+            Absolute tolerance (Default=1e-9)
+
+    Return
+    ------
+        mismatches: list
+            dicts with 'column', 'rows' (number of rows out of the
+            tolerances) and 'max_error' of the columns that do not match
+    """
+    mismatches = []
+    for column in kfunctions_columns():
+        a = expected[column].to_numpy(dtype=float)
+        b = result[column].to_numpy(dtype=float)
+        close = np.isclose(b, a, rtol=rtol, atol=atol, equal_nan=True)
+        if not close.all():
+            # NaN if all the rows out of the tolerances are NaN in one of
+            # the dataframes
+            errors = np.abs(a - b)[~close]
+            mismatches.append({
+                'column': column,
+                'rows': int((~close).sum()),
+                'max_error': (float(np.nanmax(errors))
+                              if not np.isnan(errors).all() else math.nan),
+            })
+    return mismatches
+
+
+def _timed(function, *args, repeat=1, **kwargs):
+    """
+    Run a function and return its result and its best time in seconds
+    """
+    best = math.inf
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def read_irradiances(f):
+    """
+    Read a file of irradiances as ProcessIrradFile
+    """
+    pirradf = ProcessIrradFile()
+    pirradf.open_file(file_name=os.path.basename(f),
+                      path_file=os.path.dirname(f))
+    pirradf._create_dataframe_from_Lroot_calc_irrad()
+    return pirradf.df
+
+
+def check_resampling(df, invalid_policy="drop", clamp_value=1e-30,
+                     rtol=1e-12):
+    """
+    Resample the irradiances of a dataframe onto its own lambdas and onto
+    its own depths. Valid irradiances must not change, whatever their
+    neighbours, and not valid irradiances stay not valid (clamp_value with
+    'clamp' policy). Depths -1.0 and 0.0 are not resampled and are kept
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances, sorted by lambda
+            and depth
+        invalid_policy: str
+            Policy for non-positive or non-numeric irradiances
+            (Default="drop")
+        clamp_value: float
+            Irradiance of non-positive values with 'clamp' policy
+            (Default=1e-30)
+        rtol: float
+            Relative tolerance of the valid irradiances (Default=1e-12)
+
+    Return
+    ------
+        mismatches: list
+            dicts with 'column' ('lambdas: <irradiance>' or
+            'depths: <irradiance>'), 'rows' and 'max_error' of the
+            irradiances that changed
+    """
+    config = dict(invalid_policy=invalid_policy, clamp_value=clamp_value)
+    depths = np.sort(df['depth'].unique())
+    resampled = {
+        'lambdas': calculate_kfunctions._resample_lambdas(
+            df, df['lambda'].unique(), config),
+        'depths': calculate_kfunctions._resample_depths(
+            df, depths[2:], config),
+    }
+
+    mismatches = []
+    for name, result in resampled.items():
+        for column in KFUNCTIONS_IRRADIANCES.values():
+            a = df[column].to_numpy(dtype=float)
+            expected = np.where((a > 0) & np.isfinite(a), a, np.nan)
+            if invalid_policy == 'clamp':
+                expected = np.where(a <= 0, clamp_value, expected)
+            if name == 'depths':
+                kept = df['depth'].to_numpy() <= depths[1]
+                expected = np.where(kept, a, expected)
+
+            b = result[column].to_numpy(dtype=float)
+            close = np.isclose(b, expected, rtol=rtol, atol=0,
+                               equal_nan=True)
+            if not close.all():
+                errors = np.abs(b - expected)[~close]
+                mismatches.append({
+                    'column': f"{name}: {column}",
+                    'rows': int((~close).sum()),
+                    'max_error': (float(np.nanmax(errors))
+                                  if not np.isnan(errors).all()
+                                  else math.nan),
+                })
+    return mismatches
+
+
+def run(cases, kernels=("numpy",), rtol=1e-6, atol=1e-9, repeat=3,
+        invalid_policy=None):
+    """
+    Compare the kernels with the legacy loop, or with the reference of an
+    invalid irradiance policy, in all cases and print a report
+
+    Parameters
+    ----------
+        cases: dict
+            Name of each case and its dataframe of irradiances
+        kernels: tuple
+            Kernels to check (Default=("numpy",))
+        rtol, atol: float
+            Tolerances of compare()
+        repeat: int
+            Number of runs of each kernel, the best time is reported
+            (Default=3)
+        invalid_policy: str
+            Policy of the kernels, compared with reference_kfunctions()
+            (Default=None, 'drop' compared with legacy_kfunctions())
+
+    Return
+    ------
+        report: list
+            dicts with 'case', 'kernel', 'rows', 'legacy_seconds',
+            'seconds', 'speedup' and 'mismatches'
+    """
+    report = []
+    for case, df in cases.items():
+        if invalid_policy is None:
+            expected, legacy_seconds = _timed(legacy_kfunctions, df)
+            policy = "drop"
+            loop = "legacy"
+        else:
+            expected, legacy_seconds = _timed(
+                reference_kfunctions, df, invalid_policy=invalid_policy)
+            policy = invalid_policy
+            loop = "ref"
+            case = f"{case}, {invalid_policy}"
+
+        for kernel in kernels:
+            # first call compiles the numba kernel
+            engine_kfunctions(df, kernel=kernel, invalid_policy=policy)
+            result, seconds = _timed(
+                engine_kfunctions, df, kernel=kernel, repeat=repeat,
+                invalid_policy=policy)
+            mismatches = compare(expected, result, rtol=rtol, atol=atol)
+            report.append({
+                'case': case,
+                'kernel': kernel,
+                'rows': len(df),
+                'legacy_seconds': legacy_seconds,
+                'seconds': seconds,
+                'speedup': legacy_seconds / seconds,
+                'mismatches': mismatches,
+            })
+
+            status = "OK" if not mismatches else "FAIL"
+            print(f"{status:4} {case:40} {kernel:6} {len(df):8} rows  "
+                  f"{loop:6} {legacy_seconds:9.3f} s  "
+                  f"{kernel} {seconds:9.4f} s  "
+                  f"speedup {legacy_seconds / seconds:9.1f}x")
+            for mismatch in mismatches:
+                print(f"     {mismatch['column']}: {mismatch['rows']} rows, "
+                      f"max error {mismatch['max_error']:.3g}")
+
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--files', nargs='*', default=None,
+        help="Recorded files of irradiances (Default: .csv in files/raw)")
+    parser.add_argument(
+        '--kernels', nargs='+', default=None,
+        help="Kernels to check (Default: numpy, and numba if installed)")
+    parser.add_argument('--rtol', type=float, default=1e-6)
+    parser.add_argument('--atol', type=float, default=1e-9)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.kernels is None:
+        args.kernels = ['numpy']
+        if calculate_kfunctions.numba is not None:
+            args.kernels.append('numba')
+
+    if args.files is None:
+        path = os.path.join("files", "raw")
+        args.files = [os.path.join(path, f)
+                      for f in sorted(fnmatch.filter(os.listdir(path),
+                                                     "*.csv"))]
+
+    cases = {}
+    for n_lambdas, depth_step in SYNTHETIC_CASES:
+        cases[f"synthetic {n_lambdas} lambdas, {depth_step} m"] = (
+            synthetic_irradiances(n_lambdas=n_lambdas, depth_step=depth_step))
+    for f in args.files:
+        cases[f] = read_irradiances(f)
+
+    report = run(cases, kernels=args.kernels, rtol=args.rtol,
+                 atol=args.atol, repeat=args.repeat)
+
+    cases = {}
+    for n_lambdas, depth_step in INVALID_CASES:
+        cases[f"invalid {n_lambdas} lambdas, {depth_step} m"] = (
+            invalid_irradiances(synthetic_irradiances(
+                n_lambdas=n_lambdas, depth_step=depth_step)))
+    for invalid_policy in calculate_kfunctions.INVALID_POLICIES:
+        report += run(cases, kernels=args.kernels, rtol=args.rtol,
+                      atol=args.atol, repeat=args.repeat,
+                      invalid_policy=invalid_policy)
+
+        for case, df in cases.items():
+            mismatches = check_resampling(df, invalid_policy=invalid_policy)
+            report.append({'case': case, 'mismatches': mismatches})
+            status = "OK" if not mismatches else "FAIL"
+            print(f"{status:4} {case}, {invalid_policy}: resampled onto "
+                  f"its lambdas and depths")
+            for mismatch in mismatches:
+                print(f"     {mismatch['column']}: {mismatch['rows']} rows, "
+                      f"max error {mismatch['max_error']:.3g}")
+
+    sys.exit(1 if any(row['mismatches'] for row in report) else 0)
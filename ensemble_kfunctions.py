@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Module to compare kfunctions of many Hydrolight runs (different IOPs, sun
+angles...). Outputs "_calculated_kfunctions" of each run are stacked in a
+(run, lambda, depth) array to calculate ensemble statistics, or plotted in
+one figure to compare the runs.
+
+"""
+import os
+import numpy as np
+import pandas as pd
+import plotly
+import plotly.graph_objs as go
+from plotly.subplots import make_subplots
+
+from calculate_kfunctions import ProcessIrradFile, read_columnar
+
+
+class EnsembleKfunctions:
+    """
+    Register outputs of calculate_kfunctions of many runs
+    Stack one column of all runs in a (run, lambda, depth) array
+    Calculate ensemble statistics and deltas from a baseline run
+    Plot one kfunction of all runs in one figure
+    """
+
+    def __init__(self):
+
+        # class variables
+        self.path_files_csv = "files/csv"
+        self.path_images_plotly = "images/plotly"
+        self.include_plotlyjs = True
+        self.html_precision = None
+        self.output_files = []
+        self.runs = pd.DataFrame()
+        self.lambdas = None
+        self.depths = None
+
+    def add_run(self, file_name, path_file=None, name=None, **metadata):
+        """
+        Register the output of a run. Nothing is read until a column is
+        loaded
+
+        Parameters
+        ----------
+            file_name: str
+                Name of the .csv file or columnar folder of the run
+            path_file: str
+                Path of the file (Default=None, uses self.path_files_csv)
+            name: str
+                Name of the run (Default=None, file_name)
+            metadata: dict
+                Parameters of the run, as sun_zenith=30 or chl=0.5
+        """
+        if path_file is None:
+            path_file = self.path_files_csv
+
+        if name is None:
+            name = file_name
+
+        run = pd.DataFrame([dict(
+            name=name, path=os.path.join(path_file, file_name), **metadata)])
+        self.runs = pd.concat([self.runs, run], ignore_index=True)
+
+    def _read_columns(self, path, columns):
+        """
+        Read only some columns of the output of a run
+
+        Parameters
+        ----------
+            path: str
+                Path of the .csv file or columnar folder
+            columns: list
+                Names of the columns
+
+        Return
+        ------
+            df: pandas dataframe object
+                dataframe with the columns
+        """
+        if os.path.isdir(path):
+            return read_columnar(path, columns)
+        return pd.read_csv(path, usecols=columns, skipinitialspace=True)
+
+    def load(self, column):
+        """
+        Stack one column of all runs
+
+        Parameters
+        ----------
+            column: str
+                Name of the column, as 'calculated_Kd_HL'
+
+        Return
+        ------
+            stack: numpy array
+                Values with shape (run, lambda, depth)
+        """
+        if len(self.runs) == 0:
+            raise ValueError("No runs added to the ensemble")
+
+        stack = None
+        for n, path in enumerate(self.runs['path']):
+            df = self._read_columns(path, ['lambda', 'depth', column])
+            lmbd = np.asarray(df['lambda'], dtype=float)
+            depth = np.asarray(df['depth'], dtype=float)
+            order = np.lexsort((depth, lmbd))
+            lambdas = np.unique(lmbd)
+            depths = np.unique(depth)
+
+            if stack is None:
+                self.lambdas = lambdas
+                self.depths = depths
+                stack = np.full(
+                    (len(self.runs), len(lambdas), len(depths)), np.nan)
+
+            if (len(df) != len(self.lambdas) * len(self.depths)) or not (
+                    np.array_equal(lambdas, self.lambdas) and
+                    np.array_equal(depths, self.depths)):
+                raise ValueError(
+                    f"Run {self.runs['name'].iloc[n]} has not the same "
+                    "lambdas and depths than the first run. Calculate "
+                    "kfunctions with the same lambdas and depths arguments")
+
+            stack[n] = np.asarray(df[column], dtype=float)[order].reshape(
+                len(lambdas), len(depths))
+
+        return stack
+
+    def statistics(self, column, percentiles=(5, 50, 95), baseline=None):
+        """
+        Calculate ensemble statistics of one column for each lambda and
+        depth
+
+        Parameters
+        ----------
+            column: str
+                Name of the column, as 'calculated_Kd_HL'
+            percentiles: tuple
+                Percentiles to calculate (Default=(5, 50, 95))
+            baseline: str
+                Name of the run to calculate deltas of each run
+                (Default=None, no deltas)
+
+        Return
+        ------
+            statistics: dict
+                Arrays with shape (lambda, depth): 'mean', 'std' and
+                'p<percentile>'. 'delta' with shape (run, lambda, depth)
+                if there is a baseline
+        """
+        stack = self.load(column)
+
+        statistics = {
+            'mean': np.nanmean(stack, axis=0),
+            'std': np.nanstd(stack, axis=0),
+        }
+        for percentile, values in zip(
+                percentiles, np.nanpercentile(stack, percentiles, axis=0)):
+            statistics[f'p{percentile}'] = values
+
+        if baseline is not None:
+            runs, = np.where(self.runs['name'] == baseline)
+            if len(runs) == 0:
+                raise KeyError(f"Run {baseline} not found in the ensemble")
+            statistics['delta'] = stack - stack[runs[0]]
+
+        return statistics
+
+    def _read_lambdas(self, path, columns, lambdas):
+        """
+        Read some columns of the rows of the lambdas of a run nearest to
+        the requested lambdas. Only these rows are read from columnar
+        folders
+
+        Parameters
+        ----------
+            path: str
+                Path of the .csv file or columnar folder
+            columns: list
+                Names of the columns, with 'lambda'
+            lambdas: list
+                Requested lambda values
+
+        Return
+        ------
+            df: pandas dataframe object
+                dataframe with the columns of the selected rows
+        """
+        if os.path.isdir(path):
+            available = np.unique(read_columnar(path, ['lambda'])['lambda'])
+            selected = available[self._nearest(available, lambdas)]
+            return read_columnar(path, columns, lambdas=selected)
+
+        df = pd.read_csv(path, usecols=columns, skipinitialspace=True)
+        available = np.unique(df['lambda'])
+        selected = available[self._nearest(available, lambdas)]
+        return df[df['lambda'].isin(selected)]
+
+    def _nearest(self, available, values):
+        """
+        Index of the nearest available value of each value
+        """
+        available = np.asarray(available, dtype=float)
+        values = np.atleast_1d(np.asarray(values, dtype=float))
+        return np.abs(available[:, np.newaxis] - values).argmin(axis=0)
+
+    def _save_figure(self, fig, fname, is_shown=False):
+        """
+        Save a plotly figure in html in path_images_plotly
+        """
+        if is_shown is True:
+            fig.show(config={'showLink': True})
+
+        pirradf = ProcessIrradFile()
+        pirradf.include_plotlyjs = self.include_plotlyjs
+        pirradf.html_precision = self.html_precision
+        pirradf._save_figure(fig, self.path_images_plotly, fname, ('html',))
+        self.output_files += pirradf.output_files
+
+    def plot_profiles(self, column="calculated_Kd_HL", lmbda=490,
+                      max_depth=None, is_shown=False, fname=None):
+        """
+        Plot one kfunction of all runs in function of depth, at the lambda
+        of each run nearest to lmbda. Only the rows of this lambda are read
+
+        Parameters
+        ----------
+            column: str
+                Name of the column (Default="calculated_Kd_HL")
+            lmbda: float
+                Lambda value in nm (Default=490)
+            max_depth: float
+                Maximum depth value to plot (Default=None, all depths)
+            is_shown: Boolean
+                Flag to show the plot (Default=False)
+            fname: str
+                Name of the html file without extension
+                (Default=None, "ensemble_<column>_<lmbda>nm")
+
+        Return
+        ------
+            fig: plotly figure object
+        """
+        if len(self.runs) == 0:
+            raise ValueError("No runs added to the ensemble")
+
+        fig = go.Figure()
+        for name, path in zip(self.runs['name'], self.runs['path']):
+            df = self._read_lambdas(path, ['lambda', 'depth', column], [lmbda])
+
+            # kfunctions are not calculated in depths -1.0 and 0.0
+            selected = df['depth'] > 0
+            if max_depth is not None:
+                selected &= df['depth'] <= max_depth
+            df = df[selected]
+
+            # WebGL traces keep the figure responsive with many runs
+            fig.add_trace(go.Scattergl(
+                x=df[column], y=df['depth'], mode="lines", name=str(name),
+                hovertext=f"lambda: {df['lambda'].iloc[0]}"
+                if len(df) else None))
+
+        fig.update_xaxes(title_text=column, title_font=dict(size=12),
+                         ticklen=5, zeroline=False)
+        fig.update_yaxes(title_text='depth (m)', title_font=dict(size=12),
+                         ticklen=5, zeroline=False, autorange='reversed')
+        fig.update_layout(
+            title_text=f"<b>{column} at {lmbda} nm</b>",
+            title_font=dict(size=16),
+            title=dict(y=0.97, x=0.5, xanchor='center', yanchor="top"),
+            legend_title='<b> Run </b>',
+            height=900, width=1200)
+
+        if fname is None:
+            fname = f"ensemble_{column}_{lmbda}nm"
+        self._save_figure(fig, fname, is_shown=is_shown)
+
+        return fig
+
+    def plot_spectra(self, column="calculated_Kd_HL", depths=(1, 5, 10),
+                     is_shown=False, fname=None):
+        """
+        Plot one kfunction of all runs in function of lambda, at the depths
+        of each run nearest to depths, one subplot for each depth. Only
+        lambda, depth and the column are read
+
+        Parameters
+        ----------
+            column: str
+                Name of the column (Default="calculated_Kd_HL")
+            depths: tuple
+                Depth values in meters (Default=(1, 5, 10))
+            is_shown: Boolean
+                Flag to show the plot (Default=False)
+            fname: str
+                Name of the html file without extension
+                (Default=None, "ensemble_<column>_spectra")
+
+        Return
+        ------
+            fig: plotly figure object
+        """
+        if len(self.runs) == 0:
+            raise ValueError("No runs added to the ensemble")
+
+        fig = make_subplots(
+            rows=len(depths), cols=1,
+            subplot_titles=[f"{column} at {depth} m" for depth in depths])
+
+        colors = plotly.colors.DEFAULT_PLOTLY_COLORS
+        for n, (name, path) in enumerate(
+                zip(self.runs['name'], self.runs['path'])):
+            df = self._read_columns(path, ['lambda', 'depth', column])
+            available = np.unique(df['depth'])
+            nearest = available[self._nearest(available, depths)]
+
+            for row, depth in enumerate(nearest, start=1):
+                spectrum = df[df['depth'] == depth]
+                trace = go.Scattergl(
+                    x=spectrum['lambda'], y=spectrum[column], mode="lines",
+                    name=str(name), legendgroup=str(name),
+                    showlegend=row == 1,
+                    line=dict(color=colors[n % len(colors)]),
+                    hovertext=f"depth: {depth}")
+                fig.add_trace(trace, row=row, col=1)
+
+        for row in range(1, len(depths) + 1):
+            fig.update_xaxes(title_text='lambda (nm)',
+                             title_font=dict(size=12), ticklen=5,
+                             zeroline=False, row=row, col=1)
+            fig.update_yaxes(title_text=column, title_font=dict(size=12),
+                             ticklen=5, zeroline=False, row=row, col=1)
+        fig.update_layout(
+            title_text=f"<b>{column} spectra</b>",
+            title_font=dict(size=16),
+            title=dict(y=0.97, x=0.5, xanchor='center', yanchor="top"),
+            legend_title='<b> Run </b>',
+            height=400 * len(depths), width=1200)
+
+        if fname is None:
+            fname = f"ensemble_{column}_spectra"
+        self._save_figure(fig, fname, is_shown=is_shown)
+
+        return fig
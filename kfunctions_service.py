@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running HTTP/JSON service to calculate and plot kfunctions. Parsed
+irradiances and calculated kfunctions are kept in a bounded LRU memory
+cache, so repeated requests of the same runs do not read and calculate
+again.
+
+Start the service:
+    python kfunctions_service.py --port 8000 --max-memory-mb 1024
+
+Requests (POST with a JSON body):
+    /kfunctions  {"file_name": "Lroot_calculated_irradiances.csv",
+                  "columns": ["calculated_Kd_HL"]}
+    /plot        {"file_name": "Lroot_calculated_irradiances.csv",
+                  "plot_calculated_Kd_HL": true}
+    /stats       (GET) cache statistics
+
+Files are read from the raw folder of the service and plots are saved in
+its images folders: paths of the requests are relative to them. NaN values
+are answered as null. Requests are answered by a fixed pool of threads.
+
+"""
+import os
+import argparse
+import collections
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from calculate_kfunctions import (
+    PLOTS, ProcessIrradFile, _file_stem, _resample_depths,
+    _resample_lambdas, compute_kfunctions)
+
+
+def _inside(root, *paths):
+    """
+    Join paths to a root folder and check that the result is inside it
+
+    Parameters
+    ----------
+        root: str
+            Root folder
+        paths: str
+            Paths relative to the root folder
+
+    Return
+    ------
+        path: str
+            Absolute path
+
+    Raises
+    ------
+        ValueError
+            If the path is outside the root folder
+    """
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, *paths))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(
+            f"Path {os.path.join(*paths)} is outside {root}")
+    return path
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache of dataframes, bounded by the
+    memory of the dataframes
+    """
+
+    def __init__(self, max_bytes=1024 * 2**20):
+
+        # class variables
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Get a dataframe of the cache
+
+        Parameters
+        ----------
+            key: tuple
+                Key of the dataframe
+
+        Return
+        ------
+            df: pandas dataframe object
+                dataframe, or None if it is not in the cache
+        """
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, df):
+        """
+        Add a dataframe to the cache, removing the least recently used
+        dataframes to keep the memory under max_bytes
+
+        Parameters
+        ----------
+            key: tuple
+                Key of the dataframe
+            df: pandas dataframe object
+                dataframe to add
+        """
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[1]
+            self._items[key] = (df, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                self.bytes -= self._items.popitem(last=False)[1][1]
+
+    def stats(self):
+        """
+        Statistics of the cache
+
+        Return
+        ------
+            stats: dict
+                Number of items, bytes, hits and misses
+        """
+        with self._lock:
+            return {'items': len(self._items), 'bytes': self.bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits,
+                    'misses': self.misses}
+
+
+class KfunctionsService:
+    """
+    Calculate and plot kfunctions of requests
+    Keep irradiances and kfunctions in an LRU cache
+    """
+
+    def __init__(self, max_bytes=1024 * 2**20, path_files_raw="files/raw",
+                 path_images_plotly="images/plotly",
+                 path_images_matplotlib="images/matplotlib"):
+
+        # class variables
+        self.path_files_raw = path_files_raw
+        self.path_images_plotly = path_images_plotly
+        self.path_images_matplotlib = path_images_matplotlib
+        self.cache = LRUCache(max_bytes=max_bytes)
+
+        # pyplot figures are not thread-safe, Plotly figures are
+        self._plot_lock = threading.Lock()
+
+    def _irradiances(self, path_file, file_name):
+        """
+        Get the dataframe of irradiances of a file, from the cache or
+        reading the file
+
+        Parameters
+        ----------
+            path_file: str
+                Path of the file
+            file_name: str
+                Name of the file
+
+        Return
+        ------
+            df: pandas dataframe object
+                dataframe with irradiances
+        """
+        f = os.path.join(path_file, file_name)
+        stat = os.stat(f)
+        key = ('irradiances', f, stat.st_mtime_ns, stat.st_size)
+
+        df = self.cache.get(key)
+        if df is None:
+            pirradf = ProcessIrradFile()
+            pirradf.open_file(file_name=file_name, path_file=path_file)
+            pirradf._create_dataframe_from_Lroot_calc_irrad()
+            pirradf.check_irradiances()
+            df = pirradf.df
+            self.cache.put(key, df)
+
+        return key, df
+
+    def kfunctions(self, file_name, path_file=None, invalid_policy="drop",
+                   clamp_value=1e-30, lambdas=None, depths=None):
+        """
+        Get the dataframe of kfunctions of a file, from the cache or
+        calculating them
+
+        Parameters
+        ----------
+            file_name: str
+                Name of the file
+            path_file: str
+                Path of the file inside self.path_files_raw
+                (Default=None, self.path_files_raw)
+            invalid_policy: str
+                Policy for non-positive or non-numeric irradiances
+                (Default="drop")
+            clamp_value: float
+                Irradiance of non-positive values with 'clamp' policy
+                (Default=1e-30)
+            lambdas: list
+                Lambda values to interpolate irradiances (Default=None)
+            depths: float or list
+                Depth step or depth values to interpolate irradiances
+                (Default=None)
+
+        Return
+        ------
+            df: pandas dataframe object
+                dataframe with irradiances and kfunctions
+        """
+        if path_file is None:
+            path_file = ""
+        path_file = _inside(self.path_files_raw, path_file)
+        _inside(path_file, file_name)
+
+        irradiances_key, irradiances = self._irradiances(path_file, file_name)
+        key = ('kfunctions',) + irradiances_key[1:] + (
+            invalid_policy, clamp_value, json.dumps(lambdas),
+            json.dumps(depths))
+
+        df = self.cache.get(key)
+        if df is None:
+            # cached irradiances are not modified
+            config = dict(invalid_policy=invalid_policy,
+                          clamp_value=clamp_value)
+            table = irradiances
+            if lambdas is not None:
+                table = _resample_lambdas(table, lambdas, config)
+            if depths is not None:
+                table = _resample_depths(table, depths, config)
+
+            df = compute_kfunctions(table, config)
+            self.cache.put(key, df)
+
+        return df
+
+    def plot(self, file_name, path_file=None, invalid_policy="drop",
+             clamp_value=1e-30, lambdas=None, depths=None, plotly=True,
+             matplotlib=False, path_images_plotly=None,
+             path_images_matplotlib=None, **plots):
+        """
+        Plot kfunctions of a file, calculated or from the cache
+
+        Parameters
+        ----------
+            file_name: str
+                Name of the file
+            path_file: str
+                Path of the file inside self.path_files_raw
+                (Default=None, self.path_files_raw)
+            invalid_policy, clamp_value, lambdas, depths:
+                Arguments of kfunctions()
+            plotly: Boolean
+                Boolean to plot with Plotly lib (Default=True)
+            matplotlib: Boolean
+                Boolean to plot with Matplotlib lib (Default=False)
+            path_images_plotly: str
+                Path of Plotly images inside self.path_images_plotly
+                (Default=None, self.path_images_plotly)
+            path_images_matplotlib: str
+                Path of Matplotlib images inside
+                self.path_images_matplotlib
+                (Default=None, self.path_images_matplotlib)
+            plots: dict
+                Plots to make, as plot_calculated_Kd_HL=True
+
+        Return
+        ------
+            output_files: list
+                Paths of the saved plots
+        """
+        unknown = set(plots) - set(PLOTS)
+        if unknown:
+            raise ValueError(f"plots must be in {PLOTS}, not {unknown}")
+
+        path_images_plotly = _inside(
+            self.path_images_plotly, path_images_plotly or "")
+        path_images_matplotlib = _inside(
+            self.path_images_matplotlib, path_images_matplotlib or "")
+
+        df = self.kfunctions(file_name, path_file=path_file,
+                             invalid_policy=invalid_policy,
+                             clamp_value=clamp_value, lambdas=lambdas,
+                             depths=depths)
+
+        # plots are saved in the images folders, not in folders of the
+        # file name
+        pirradf = ProcessIrradFile()
+        pirradf.df = df
+        pirradf.file_name_csv = (
+            f"{_file_stem(file_name)}_calculated_kfunctions.csv")
+        pirradf.path_images_plotly = path_images_plotly
+        pirradf.path_images_matplotlib = path_images_matplotlib
+
+        libraries = [name for name, used in (
+            ('plotly', plotly), ('matplotlib', matplotlib)) if used is True]
+        for plot, used in plots.items():
+            if used is not True:
+                continue
+            for library in libraries:
+                method = getattr(pirradf, f"{plot}_{library}")
+                if library == 'matplotlib':
+                    # only pyplot is locked, Plotly figures run in parallel
+                    with self._plot_lock:
+                        method()
+                else:
+                    method()
+
+        return pirradf.output_files
+
+
+class PooledHTTPServer(HTTPServer):
+    """
+    HTTP server that answers requests in a fixed pool of threads. Threads
+    are reused, and so are the Plotly figure templates of each thread
+    """
+
+    def __init__(self, server_address, handler, workers=8):
+        super().__init__(server_address, handler)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self._executor.submit(
+            self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self._executor.shutdown(wait=True)
+
+
+def _json_values(values):
+    """
+    Values of a column as a list for JSON, NaN as None (null)
+    """
+    return values.astype(object).where(values.notna(), None).tolist()
+
+
+class KfunctionsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answer JSON requests with the KfunctionsService of the server
+    """
+
+    def _send(self, status, content):
+        body = json.dumps(content, allow_nan=False).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send(200, self.server.service.cache.stats())
+        else:
+            self._send(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+
+            if self.path == '/kfunctions':
+                columns = request.pop('columns', None)
+                df = service.kfunctions(**request)
+                if columns is None:
+                    columns = list(df.columns)
+                self._send(200, {
+                    column: _json_values(df[column]) for column in columns})
+
+            elif self.path == '/plot':
+                self._send(200, {'files': service.plot(**request)})
+
+            else:
+                self._send(404, {'error': f"Unknown path {self.path}"})
+
+        except (TypeError, ValueError, KeyError, OSError) as er:
+            self._send(400, {'error': f"{type(er).__name__}: {er}"})
+
+
+def serve(host="127.0.0.1", port=8000, max_bytes=1024 * 2**20,
+          path_files_raw="files/raw", path_images_plotly="images/plotly",
+          path_images_matplotlib="images/matplotlib", workers=8):
+    """
+    Start the service until it is interrupted
+
+    Parameters
+    ----------
+        host: str
+            Host of the server (Default="127.0.0.1")
+        port: int
+            Port of the server (Default=8000)
+        max_bytes: int
+            Maximum memory of the cache in bytes (Default=1 GB)
+        path_files_raw: str
+            Path of the files, requests can not read outside it
+            (Default="files/raw")
+        path_images_plotly: str
+            Path of Plotly images, requests can not write outside it
+            (Default="images/plotly")
+        path_images_matplotlib: str
+            Path of Matplotlib images, requests can not write outside it
+            (Default="images/matplotlib")
+        workers: int
+            Number of threads to answer requests (Default=8)
+    """
+    server = PooledHTTPServer(
+        (host, port), KfunctionsRequestHandler, workers=workers)
+    server.service = KfunctionsService(
+        max_bytes=max_bytes, path_files_raw=path_files_raw,
+        path_images_plotly=path_images_plotly,
+        path_images_matplotlib=path_images_matplotlib)
+    print(f"Serving kfunctions on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-memory-mb', type=int, default=1024)
+    parser.add_argument('--path-files-raw', default="files/raw")
+    parser.add_argument('--path-images-plotly', default="images/plotly")
+    parser.add_argument('--path-images-matplotlib',
+                        default="images/matplotlib")
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    serve(host=args.host, port=args.port,
+          max_bytes=args.max_memory_mb * 2**20,
+          path_files_raw=args.path_files_raw,
+          path_images_plotly=args.path_images_plotly,
+          path_images_matplotlib=args.path_images_matplotlib,
+          workers=args.workers)
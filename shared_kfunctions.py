@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+"""
+Module to calculate kfunctions of one large run with a pool of worker
+processes. Irradiances and kfunctions are stored once in shared memory (or
+in a memory mapped .npy file): workers receive a small handle with the name
+of the memory, attach to it without copies, calculate kfunctions of their
+lambdas and write them in place. With a pool of threads, workers calculate
+kfunctions of their lambdas in the same arrays, releasing the GIL in NumPy
+operations and in the numba kernel.
+
+    from shared_kfunctions import calculate_shared
+    df = calculate_shared(df, workers=16)
+    df = calculate_shared(df, workers=4, pool="thread")
+
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+from calculate_kfunctions import (
+    KFUNCTIONS_COLUMNS, KFUNCTIONS_IRRADIANCES, REQUIRED_COLUMNS,
+    POOLS, LambdaIndex, ProcessIrradFile, _kfunctions_arrays,
+    _kfunctions_config)
+
+
+class SharedFrame:
+    """
+    Float columns of a dataframe in one shared memory block or memory
+    mapped .npy file, with shape (column, row)
+    Pickled as a handle with the name of the memory: processes that
+    unpickle it attach to the same memory without copies
+    """
+
+    def __init__(self, columns, rows, path=None):
+        """
+        Create the shared memory of the columns, filled with NaN
+
+        Parameters
+        ----------
+            columns: list
+                Names of the columns
+            rows: int
+                Number of rows
+            path: str
+                Path of a .npy file to use instead of shared memory
+                (Default=None, shared memory)
+        """
+        # class variables
+        self.columns = list(columns)
+        self.rows = rows
+        self.path = path
+        self.name = path
+        self._owner = True
+        self._shm = None
+        self._values = None
+
+        shape = (len(self.columns), rows)
+        if path is None:
+            self._shm = shared_memory.SharedMemory(
+                create=True, size=max(1, 8 * shape[0] * shape[1]))
+            self.name = self._shm.name
+        else:
+            self._values = np.lib.format.open_memmap(
+                path, mode='w+', dtype=float, shape=shape)
+        self.values()[:] = np.nan
+
+    @classmethod
+    def from_dataframe(cls, df, columns=None, extra_columns=(), path=None):
+        """
+        Copy columns of a dataframe to a new SharedFrame
+
+        Parameters
+        ----------
+            df: pandas dataframe object
+                dataframe with numeric columns
+            columns: list
+                Columns to copy (Default=None, all columns)
+            extra_columns: tuple
+                Names of columns to add filled with NaN, as the results of
+                the workers (Default=())
+            path: str
+                Path of a .npy file to use instead of shared memory
+                (Default=None, shared memory)
+
+        Return
+        ------
+            frame: SharedFrame object
+        """
+        if columns is None:
+            columns = list(df.columns)
+
+        frame = cls(list(columns) + list(extra_columns), len(df), path=path)
+        values = frame.values()
+        for n, column in enumerate(columns):
+            values[n] = df[column].to_numpy(dtype=float)
+        return frame
+
+    def __getstate__(self):
+        # only the handle is pickled, never the values
+        return {'columns': self.columns, 'rows': self.rows,
+                'path': self.path, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._owner = False
+        self._shm = None
+        self._values = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._owner:
+            self.unlink()
+        else:
+            self.close()
+
+    def values(self):
+        """
+        Get the values of all columns, attaching to the memory the first
+        time
+
+        Return
+        ------
+            values: numpy array
+                Values with shape (column, row), a view of the memory
+        """
+        if self._values is None:
+            shape = (len(self.columns), self.rows)
+            if self.path is None:
+                if self._shm is None:
+                    self._shm = shared_memory.SharedMemory(name=self.name)
+                self._values = np.ndarray(
+                    shape, dtype=float, buffer=self._shm.buf)
+            else:
+                self._values = np.load(self.path, mmap_mode='r+')
+        return self._values
+
+    def column(self, column):
+        """
+        Get the values of a column, a view of the memory
+        """
+        return self.values()[self.columns.index(column)]
+
+    def dataframe(self, start=0, end=None):
+        """
+        Get a dataframe of some rows of all columns without copies
+
+        Parameters
+        ----------
+            start: int
+                First row (Default=0)
+            end: int
+                End row (Default=None, last row)
+
+        Return
+        ------
+            df: pandas dataframe object
+                dataframe backed by the memory. It is not valid after
+                close()
+        """
+        return pd.DataFrame(self.values()[:, start:end].T,
+                            columns=self.columns, copy=False)
+
+    def close(self):
+        """
+        Release the memory of this process. Views of the values must not
+        be used after closing
+        """
+        self._values = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def unlink(self):
+        """
+        Close and free the memory. Only the process that created the
+        SharedFrame frees it
+        """
+        self.close()
+        if not self._owner:
+            return
+        if self.path is None:
+            shared_memory.SharedMemory(name=self.name).unlink()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        self._owner = False
+
+
+def kfunctions_columns():
+    """
+    Names of the kfunctions columns, in the order they are saved
+    """
+    return [f'{prefix}_{kfunction}_{method}'
+            for prefix, method in KFUNCTIONS_COLUMNS
+            for kfunction in KFUNCTIONS_IRRADIANCES]
+
+
+def lambda_partitions(index, partitions):
+    """
+    Split the lambda blocks of a dataframe in partitions of whole lambdas
+    with about the same number of rows
+
+    Parameters
+    ----------
+        index: LambdaIndex object
+            Lambda blocks of the dataframe
+        partitions: int
+            Maximum number of partitions
+
+    Return
+    ------
+        bounds: list
+            First and end row of each partition
+    """
+    if index.rows == 0:
+        return []
+
+    targets = np.arange(1, partitions) * index.rows / partitions
+    cuts = index.starts[np.searchsorted(index.starts, targets)
+                        .clip(max=len(index) - 1)]
+    cuts = np.unique(np.concatenate(([0], cuts, [index.rows])))
+    return [(int(start), int(end)) for start, end in zip(cuts[:-1], cuts[1:])
+            if end > start]
+
+
+def _compute_rows(frame, start, end, config):
+    """
+    Calculate kfunctions of the rows start:end of a SharedFrame and write
+    them in its kfunctions columns. Runs in a worker process
+
+    Return
+    ------
+        rows: int
+            Number of calculated rows
+    """
+    try:
+        df = frame.dataframe(start, end)
+        kfunctions = _kfunctions_arrays(
+            df, LambdaIndex.from_dataframe(df), config)
+        for column, values in kfunctions.items():
+            frame.column(column)[start:end] = values
+        del df
+    finally:
+        frame.close()
+    return end - start
+
+
+def _compute_rows_threaded(df, kfunctions, start, end, config):
+    """
+    Calculate kfunctions of the rows start:end of a dataframe and write
+    them in the kfunctions arrays. Runs in a worker thread
+
+    Return
+    ------
+        rows: int
+            Number of calculated rows
+    """
+    block = df.iloc[start:end]
+    for column, values in _kfunctions_arrays(
+            block, LambdaIndex.from_dataframe(block), config).items():
+        kfunctions[column][start:end] = values
+    return end - start
+
+
+def calculate_shared(df, workers=None, invalid_policy="drop",
+                     clamp_value=1e-30, kernel="numpy", path=None,
+                     partitions=None, pool="process"):
+    """
+    Calculate kfunctions of a dataframe of irradiances with a pool of
+    worker processes that share the irradiances and kfunctions arrays, or
+    with a pool of threads
+
+    Parameters
+    ----------
+        df: pandas dataframe object
+            dataframe with lambda, depth and irradiances, rows of a lambda
+            together and sorted by depth
+        workers: int
+            Number of processes (Default=None, number of CPUs)
+        invalid_policy: str
+            Policy for non-positive or non-numeric irradiances
+            (Default="drop")
+        clamp_value: float
+            Irradiance of non-positive values with 'clamp' policy
+            (Default=1e-30)
+        kernel: str
+            Kernel of ProcessIrradFile (Default="numpy")
+        path: str
+            Path of a .npy file to share the arrays instead of shared
+            memory (Default=None, shared memory). Not used by threads
+        partitions: int
+            Number of partitions of whole lambdas
+            (Default=None, 4 for each worker)
+        pool: str
+            'process' or 'thread' workers (Default="process")
+
+    Return
+    ------
+        df: pandas dataframe object
+            dataframe with irradiances and kfunctions
+    """
+    if pool not in POOLS:
+        raise ValueError(f"pool must be one of {POOLS}, not '{pool}'")
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if partitions is None:
+        partitions = 4 * workers
+
+    pirradf = ProcessIrradFile()
+    pirradf.df = df
+    pirradf._coerce_dataframe()
+    df = pirradf.df
+
+    # the same configuration in threads and processes
+    config = _kfunctions_config(dict(
+        invalid_policy=invalid_policy, clamp_value=clamp_value,
+        kernel=kernel))
+    columns = kfunctions_columns()
+    bounds = lambda_partitions(pirradf.lambda_index(), partitions)
+
+    if pool == 'thread':
+        kfunctions = {column: np.empty(len(df)) for column in columns}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_compute_rows_threaded, df,
+                                       kfunctions, start, end, config)
+                       for start, end in bounds]
+            for future in futures:
+                future.result()
+
+        for column in columns:
+            df[column] = kfunctions[column]
+        return df
+
+    with SharedFrame.from_dataframe(
+            df, columns=list(REQUIRED_COLUMNS), extra_columns=columns,
+            path=path) as frame, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_compute_rows, frame, start, end, config)
+                   for start, end in bounds]
+        for future in futures:
+            future.result()
+
+        for column in columns:
+            df[column] = frame.column(column).copy()
+
+    return df